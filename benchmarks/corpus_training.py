@@ -0,0 +1,57 @@
+import os
+import time
+from melodendron import MVVOMM, MidiFileParser, add_derived_viewpoint, reduce_dynamic, train_corpus
+
+# Train a model on a corpus (the bundled files, repeated) by inserting the files one after the other, then with
+# train_corpus for several numbers of workers, and check that every trained model is the serial one.
+viewpoints = ['pitches', 'total_duration', 'dynamic']
+joint_viewpoints = [('pitches', 'total_duration')]
+derived_viewpoints = [('dynamic', reduce_dynamic)]
+max_order = 8
+filepaths = ['midi/chpn_op27_2.mid', 'midi/gnossienne_3.mid', 'midi/bach_contrapunctus_i.mid',
+             'midi/bach_kyrie_eleison.mid'] * 4
+track_idxs = {filepath: list(range(len(MidiFileParser(filepath).tracks))) for filepath in set(filepaths)}
+
+
+def trie_paths(vomm):
+    """Returns {reversed context path: continuation indexes} for every node of a trie."""
+    paths = dict()
+    stack = [((node.value,), node) for node in vomm.roots.values()]
+    while stack:
+        path, node = stack.pop()
+        paths[path] = list(node.continuation_idxs)
+        stack.extend((path + (child.value,), child) for child in node.children.values())
+    return paths
+
+
+def check(model, reference):
+    assert model.state_sequence == reference.state_sequence
+    assert model.symbol_columns == reference.symbol_columns
+    assert model.context_lengths == reference.context_lengths
+    assert {key: alphabet.values for key, alphabet in model.alphabets.items()} == \
+           {key: alphabet.values for key, alphabet in reference.alphabets.items()}
+    assert {key: alphabet.values for key, alphabet in model.joint_alphabets.items()} == \
+           {key: alphabet.values for key, alphabet in reference.joint_alphabets.items()}
+    for (key, vomm), (_, reference_vomm) in zip(model._vomm_items(), reference._vomm_items()):
+        assert trie_paths(vomm) == trie_paths(reference_vomm), key
+
+
+if __name__ == '__main__':
+    # Workers are started with the main module imported again on some platforms
+    start = time.perf_counter()
+    reference = MVVOMM(viewpoints, joint_viewpoints=joint_viewpoints)
+    for filepath in filepaths:
+        state_sequence = MidiFileParser(filepath).get_states_from_tracks(track_idxs[filepath])
+        for viewpoint, reduction in derived_viewpoints:
+            add_derived_viewpoint(state_sequence, viewpoint, reduction)
+        reference.insert_sequence(state_sequence, max_order=max_order)
+    print('{} files, {} states, {} cpus'.format(len(filepaths), len(reference.state_sequence), os.cpu_count()))
+    print('serial insert_sequence: {:.3f}s'.format(time.perf_counter() - start))
+
+    for max_workers in (1, 2, 4):
+        start = time.perf_counter()
+        model = train_corpus(filepaths, viewpoints, track_idxs, max_order=max_order,
+                             derived_viewpoints=derived_viewpoints, max_workers=max_workers,
+                             joint_viewpoints=joint_viewpoints)
+        print('train_corpus with {} workers: {:.3f}s'.format(max_workers, time.perf_counter() - start))
+        check(model, reference)
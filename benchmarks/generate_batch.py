@@ -0,0 +1,35 @@
+import random
+import time
+import numpy as np
+from melodendron import MVVOMM, intersect_select, weighted_intersect_select, np_weighted_intersect_select
+from melodendron import MidiFileParser
+
+# Compare generate_batch with calling generate_n k times on the same model, then check that generation with a NumPy
+# selector and an rng is reproducible whatever the state of the random module.
+viewpoints = ['pitches', 'total_duration', 'dynamic']
+model = MVVOMM(viewpoints)
+midi_file_parser = MidiFileParser('midi/chpn_op27_2.mid')
+model.insert_sequence(midi_file_parser.get_states_from_tracks([1, 2]), max_order=8)
+k, n = 200, 100
+
+for selector in (intersect_select, weighted_intersect_select):
+    for order in (1, 3, 5):
+        start = time.perf_counter()
+        for _ in range(k):
+            model.generate_n(n, selector=selector, order=order)
+        serial_time = time.perf_counter() - start
+        start = time.perf_counter()
+        model.generate_batch(k, n, selector=selector, order=order)
+        batch_time = time.perf_counter() - start
+        print('{} order {}: generate_n x{} {:.3f}s, generate_batch {:.3f}s ({:.0f} states/s)'.format(
+            selector.__name__, order, k, serial_time, batch_time, k * n / batch_time))
+
+
+def generate(seed):
+    random.seed(seed)
+    rng = np.random.default_rng(0)
+    return (model.generate_n(n, np_weighted_intersect_select, order=3, rng=rng),
+            model.generate_batch(10, n, np_weighted_intersect_select, order=3, rng=rng))
+
+
+assert generate(1) == generate(2)
@@ -0,0 +1,73 @@
+import io
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+import mido
+from melodendron import MVVOMM, MidiFileParser, MidiFileWriter, intersect_select, load_model, save_model
+from melodendron import note_events_to_midi_track, states_to_midi_track
+
+# Generate a long piece and export it to a midi track, from decoded states (generate_n) and from state indexes
+# (generate_idxs), and check both give the same track.
+viewpoints = ['pitches', 'total_duration', 'on_duration', 'off_duration', 'dynamic']
+midi_file_parser = MidiFileParser('midi/chpn_op27_2.mid')
+ticks_per_beat = midi_file_parser.ticks_per_beat
+model = MVVOMM(viewpoints)
+model.insert_sequence(midi_file_parser.get_states_from_tracks([1, 2]), max_order=5)
+n = 50000
+
+
+def generate_states():
+    return model.generate_n(n, intersect_select, order=5)
+
+
+def export_states(states):
+    return states_to_midi_track(states, ticks_per_beat)
+
+
+def generate_idxs():
+    return model.generate_idxs(n, intersect_select, order=5)
+
+
+def export_idxs(idxs):
+    return note_events_to_midi_track(model.get_values(idxs, 'note_events'), model.get_values(idxs, 'off_duration'),
+                                     ticks_per_beat)
+
+
+tracks = list()
+for generate, export in ((generate_states, export_states), (generate_idxs, export_idxs)):
+    random.seed(0)
+    tracemalloc.start()
+    generated = generate()
+    generated_size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    random.seed(0)
+    start = time.perf_counter()
+    generated = generate()
+    generate_time = time.perf_counter() - start
+    tracks.append(export(generated))
+    export_time = time.perf_counter() - start - generate_time
+    print('{}: generation {:.3f}s ({:.1f} MB), export {:.3f}s'.format(
+        generate.__name__, generate_time, generated_size / 2 ** 20, export_time))
+assert tracks[0] == tracks[1]
+
+# Streamed export and loaded models read the same values
+random.seed(0)
+idxs = model.generate_idxs(1000, intersect_select, order=5)
+note_events, off_durations = model.get_values(idxs, 'note_events'), model.get_values(idxs, 'off_duration')
+file = io.BytesIO()
+with MidiFileWriter(file, ticks_per_beat) as writer:
+    for state_note_events, off_duration in zip(note_events, off_durations):
+        writer.write_note_events(state_note_events, off_duration)
+saved_file = io.BytesIO()
+midi_file = mido.MidiFile(ticks_per_beat=ticks_per_beat)
+midi_file.tracks.append(note_events_to_midi_track(note_events, off_durations, ticks_per_beat))
+midi_file.save(file=saved_file)
+assert file.getvalue() == saved_file.getvalue()
+with tempfile.TemporaryDirectory() as directory:
+    filepath = os.path.join(directory, 'model.mvvomm')
+    save_model(model, filepath)
+    loaded_model = load_model(filepath)
+    assert loaded_model.get_values(idxs, 'note_events') == note_events
+    assert loaded_model.get_values(idxs, 'pitches') == model.get_values(idxs, 'pitches')
@@ -0,0 +1,46 @@
+import json
+import random
+import time
+from melodendron import MVVOMM, MidiFileParser, hierarchical_backoff_select, intersect_select
+
+# Generate with instrumentation disabled, enabled, then disabled again, check the generated sequences are the same
+# and print the recorded metrics.
+viewpoints = ['pitches', 'total_duration', 'dynamic']
+midi_file_parser = MidiFileParser('midi/chpn_op27_2.mid')
+state_sequence = midi_file_parser.get_states_from_tracks([1, 2])
+model = MVVOMM(viewpoints)
+model.insert_sequence(state_sequence, max_order=5)
+
+
+def generate():
+    random.seed(0)
+    start = time.perf_counter()
+    generated = [model.generate_n(200, intersect_select, order=5) for _ in range(100)]
+    return generated, time.perf_counter() - start
+
+
+reference, duration = generate()
+print('disabled: {:.3f}s'.format(duration))
+instrumentation = model.enable_instrumentation()
+generated, duration = generate()
+print('enabled: {:.3f}s'.format(duration))
+assert generated == reference
+for state in state_sequence[:100]:
+    model.next(state_sequence[:5], intersect_select)
+# Back-off lookups are recorded too
+lookups = instrumentation.histograms['vomm.lookup_seconds.pitches'].count
+model.generate_n(200, hierarchical_backoff_select, order=5)
+assert instrumentation.histograms['vomm.lookup_seconds.pitches'].count > lookups
+model.disable_instrumentation()
+generated, duration = generate()
+print('disabled again: {:.3f}s'.format(duration))
+assert generated == reference
+print(instrumentation)
+print(json.dumps(instrumentation.export())[:200], '...')
+
+# Batch generation records its selections too
+instrumentation = model.enable_instrumentation()
+random.seed(0)
+model.generate_batch(10, 200, intersect_select, order=5)
+assert instrumentation.counters['select.calls'] == 10 * (200 - 5)
+print('generate_batch: {} memoized lookups'.format(instrumentation.counters.get('select.memoized_lookups', 0)))
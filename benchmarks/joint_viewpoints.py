@@ -0,0 +1,64 @@
+import os
+import random
+import tempfile
+import time
+from melodendron import MVVOMM, SuffixVOMM, VOMM, MidiFileParser, hierarchical_select, intersect_select, load_model, \
+    save_model, weighted_intersect_select
+
+# Generate with intersect_select with and without a joint VOMM on pitches and total_duration, and check that a joint
+# model built by insertion, by learning, by merging or loaded from a file generates the same sequences, and that
+# selectors generate the same sequences with and without joint VOMMs.
+viewpoints = ['pitches', 'total_duration', 'dynamic']
+joint_viewpoints = [('pitches', 'total_duration')]
+midi_file_parser = MidiFileParser('midi/chpn_op27_2.mid')
+state_sequence = midi_file_parser.get_states_from_tracks([1, 2])
+half = len(state_sequence) // 2
+k, n = 100, 200
+
+
+def generate(model, order, selector=intersect_select):
+    random.seed(0)
+    return [model.generate_n(n, selector, order=order) for _ in range(k)]
+
+
+for vomm_class in (VOMM, SuffixVOMM):
+    for order in (2, 8):
+        for joint in ((), joint_viewpoints):
+            model = MVVOMM(viewpoints, vomm_class=vomm_class, joint_viewpoints=joint)
+            model.insert_sequence(state_sequence, max_order=order)
+            start = time.perf_counter()
+            generate(model, order)
+            duration = time.perf_counter() - start
+            print('{} order {} joint viewpoints {}: {:.3f}s ({:.0f} states/s)'.format(
+                vomm_class.__name__, order, joint, duration, k * n / duration))
+        generated = generate(model, order)
+        # Joint continuations are only used where they are the intersection, other selectors ignore them
+        plain_model = MVVOMM(viewpoints, vomm_class=vomm_class)
+        plain_model.insert_sequence(state_sequence, max_order=order)
+        assert generated == generate(plain_model, order)
+        for selector in (weighted_intersect_select, hierarchical_select):
+            assert generate(model, order, selector) == generate(plain_model, order, selector), selector
+
+        merged_model = MVVOMM(viewpoints, vomm_class=vomm_class, joint_viewpoints=joint_viewpoints)
+        merged_model.insert_sequence(state_sequence[:half], max_order=order)
+        other_model = MVVOMM(viewpoints, vomm_class=vomm_class, joint_viewpoints=joint_viewpoints)
+        other_model.insert_sequence(state_sequence[half:], max_order=order)
+        merged_model.merge(other_model)
+        assert merged_model.symbol_columns == model.symbol_columns
+        # Contexts do not cross the boundary of the merged models
+        serial_model = MVVOMM(viewpoints, vomm_class=vomm_class, joint_viewpoints=joint_viewpoints)
+        serial_model.insert_sequence(state_sequence[:half], max_order=order)
+        serial_model.insert_sequence(state_sequence[half:], max_order=order)
+
+        learned_model = MVVOMM(viewpoints, vomm_class=vomm_class, joint_viewpoints=joint_viewpoints)
+        for state in state_sequence:
+            learned_model.learn(dict(state), max_order=order)
+        assert learned_model.symbol_columns == model.symbol_columns
+        if vomm_class is VOMM:
+            assert generate(merged_model, order) == generate(serial_model, order)
+            assert generate(learned_model, order) == generated
+
+        with tempfile.TemporaryDirectory() as directory:
+            filepath = os.path.join(directory, 'model.mvvomm')
+            save_model(model, filepath)
+            assert generate(load_model(filepath, use_mmap=False), order) == generated
@@ -0,0 +1,38 @@
+import io
+import random
+import time
+import mido
+from melodendron import MVVOMM, MidiFileParser, MidiFileWriter, states_to_midi_track, weighted_intersect_select
+
+# Export a long generated sequence through mido and through MidiFileWriter, and check both files are identical.
+midi_file_parser = MidiFileParser('midi/bach_kyrie_eleison.mid')
+model = MVVOMM(['pitches', 'total_duration', 'on_duration', 'off_duration'])
+model.insert_sequence(midi_file_parser.get_states_from_tracks(list(range(1, 14))), max_order=5)
+random.seed(0)
+new_sequence = model.generate_n(20000, weighted_intersect_select, order=4)
+ticks_per_beat = midi_file_parser.ticks_per_beat
+tempo_track = mido.MidiTrack([mido.MetaMessage('set_tempo', tempo=mido.bpm2tempo(midi_file_parser.tempo))])
+
+start = time.perf_counter()
+new_file = mido.MidiFile(ticks_per_beat=ticks_per_beat)
+new_file.tracks.append(tempo_track)
+new_file.tracks.append(states_to_midi_track(new_sequence, ticks_per_beat))
+mido_file = io.BytesIO()
+new_file.save(file=mido_file)
+print('mido export: {:.3f}s'.format(time.perf_counter() - start))
+
+start = time.perf_counter()
+writer_file = io.BytesIO()
+with MidiFileWriter(writer_file, ticks_per_beat, [tempo_track]) as writer:
+    writer.write_states(new_sequence)
+print('MidiFileWriter export: {:.3f}s'.format(time.perf_counter() - start))
+assert writer_file.getvalue() == mido_file.getvalue()
+
+# Stream states to the file while they are generated
+random.seed(0)
+start = time.perf_counter()
+streamed_file = io.BytesIO()
+with MidiFileWriter(streamed_file, ticks_per_beat, [tempo_track]) as writer:
+    writer.write_states(model.iter_generate(20000, weighted_intersect_select, order=4))
+print('Generation streamed to MidiFileWriter: {:.3f}s'.format(time.perf_counter() - start))
+assert streamed_file.getvalue() == mido_file.getvalue()
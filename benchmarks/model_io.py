@@ -0,0 +1,41 @@
+import os
+import random
+import tempfile
+import time
+from melodendron import MVVOMM, VOMM, SuffixVOMM, weighted_intersect_select, save_model, load_model
+from melodendron import MidiFileParser, add_derived_viewpoint, reduce_density
+
+# Compare retraining a model with loading it from disk, and check that loaded models generate the same sequences.
+viewpoints = ['pitches', 'total_duration', 'on_duration', 'off_duration', 'dynamic', 'density']
+midi_file_parser = MidiFileParser('midi/bach_kyrie_eleison.mid')
+state_sequences = [midi_file_parser.get_states_from_tracks([track_idx]) for track_idx in range(1, 14)]
+for state_sequence in state_sequences:
+    add_derived_viewpoint(state_sequence, 'density', reduce_density)
+
+for vomm_class in (VOMM, SuffixVOMM):
+    start = time.perf_counter()
+    model = MVVOMM(viewpoints, vomm_class=vomm_class)
+    for _ in range(4):
+        for state_sequence in state_sequences:
+            model.insert_sequence(state_sequence, max_order=8)
+    train_time = time.perf_counter() - start
+    with tempfile.TemporaryDirectory() as directory:
+        filepath = os.path.join(directory, 'model.mvvomm')
+        start = time.perf_counter()
+        save_model(model, filepath)
+        save_time = time.perf_counter() - start
+        for use_mmap in (True, False):
+            start = time.perf_counter()
+            loaded_model = load_model(filepath, use_mmap=use_mmap)
+            load_time = time.perf_counter() - start
+            random.seed(0)
+            expected = model.generate_n(200, weighted_intersect_select, order=4)
+            random.seed(0)
+            start = time.perf_counter()
+            generated = loaded_model.generate_n(200, weighted_intersect_select, order=4)
+            generation_time = time.perf_counter() - start
+            assert generated == expected, 'Loaded model does not generate the same sequence'
+            print('{} ({} states, {:.1f} MB): train {:.3f}s, save {:.3f}s, load (mmap={}) {:.4f}s, '
+                  'first generation {:.3f}s'.format(vomm_class.__name__, len(model.state_sequence),
+                                                    os.path.getsize(filepath) / 1e6, train_time, save_time,
+                                                    use_mmap, load_time, generation_time))
@@ -0,0 +1,23 @@
+import time
+import mido
+from melodendron import midi_track_to_states
+
+# Cluster synthetic dense chords (with a sustained pedal note per chord) and report the throughput.
+ticks_per_beat = 480
+for chord_size in (4, 16, 64, 128):
+    track = mido.MidiTrack()
+    n_chords = 20000 // chord_size
+    for chord in range(n_chords):
+        pitches = [(chord + i) % 128 for i in range(chord_size)]
+        for pitch in pitches:
+            track.append(mido.Message('note_on', note=pitch, velocity=64, time=0))
+        # Notes end one after the other, so each note off sees the whole chord still open
+        for i, pitch in enumerate(pitches):
+            track.append(mido.Message('note_off', note=pitch, velocity=0, time=1 if i else ticks_per_beat))
+    n_events = 2 * n_chords * chord_size
+    start = time.perf_counter()
+    state_sequence = midi_track_to_states(track, ticks_per_beat)
+    duration = time.perf_counter() - start
+    assert len(state_sequence) == n_chords
+    print('chord size {:>3}: {} states in {:.3f}s ({:.0f} events/s)'.format(chord_size, len(state_sequence), duration,
+                                                                             n_events / duration))
@@ -0,0 +1,65 @@
+import random
+import statistics
+import time
+import numpy as np
+from melodendron import MVVOMM, MidiFileParser, PlagiarismTracker, intersect_select
+from melodendron import get_plagiarism_infos, get_plagiarism_infos_array
+
+# Compare the plagiarism metrics computed on generated states, tracked during generation and computed on arrays of
+# generated ids, then limit plagiarism during generation by stopping or re-steering it.
+viewpoints = ['pitches', 'total_duration', 'dynamic']
+midi_file_parser = MidiFileParser('midi/chpn_op27_2.mid')
+state_sequence = midi_file_parser.get_states_from_tracks([1, 2])
+model = MVVOMM(viewpoints)
+model.insert_sequence(state_sequence, max_order=8)
+k, n, order = 200, 500, 4
+
+# Edge cases
+for ids in ([], [3], [3, 5], [3, 4], [3, 4, 5], [1, 2, 9, 10, 11, 4]):
+    states = [{'id': idx} for idx in ids]
+    tracker = PlagiarismTracker()
+    for idx in ids:
+        tracker.update(idx)
+    assert get_plagiarism_infos(states) == tracker.infos() == tuple(get_plagiarism_infos_array(ids)), ids
+
+random.seed(0)
+start = time.perf_counter()
+states_batch = [model.generate_n(n, intersect_select, order=order) for _ in range(k)]
+print('generate_n: {:.3f}s'.format(time.perf_counter() - start))
+random.seed(0)
+trackers = [PlagiarismTracker() for _ in range(k)]
+start = time.perf_counter()
+idxs_batch = [model.generate_idxs(n, intersect_select, order=order, plagiarism_tracker=tracker) for tracker in trackers]
+print('generate_idxs with a tracker: {:.3f}s'.format(time.perf_counter() - start))
+ids = np.array(idxs_batch, dtype=np.int64)
+assert ids.tolist() == [[state['id'] for state in states] for states in states_batch]
+
+start = time.perf_counter()
+infos = [get_plagiarism_infos(states) for states in states_batch]
+print('get_plagiarism_infos: {:.4f}s'.format(time.perf_counter() - start))
+start = time.perf_counter()
+infos_array = get_plagiarism_infos_array(ids)
+print('get_plagiarism_infos_array: {:.4f}s'.format(time.perf_counter() - start))
+assert np.allclose(infos_array, infos)
+for tracker, sequence_infos in zip(trackers, infos):
+    # The median is estimated
+    assert tracker.infos()[:3] == sequence_infos[:3]
+median_errors = [abs(tracker.median_run_length - sequence_infos[3]) for tracker, sequence_infos in zip(trackers, infos)]
+print('mean infos: {}, median estimate mean absolute error: {:.3f}'.format(
+    np.round(infos_array.mean(axis=0), 3).tolist(), statistics.mean(median_errors)))
+
+for on_exceed in ('stop', 'resteer'):
+    random.seed(0)
+    trackers = [PlagiarismTracker(max_run_length=4, max_proportion=.5, on_exceed=on_exceed) for _ in range(k)]
+    start = time.perf_counter()
+    states_batch = [model.generate_n(n, intersect_select, order=order, plagiarism_tracker=tracker)
+                    for tracker in trackers]
+    duration = time.perf_counter() - start
+    infos = [get_plagiarism_infos(states) for states in states_batch]
+    assert all(sequence_infos[1] <= 4 for sequence_infos in infos)
+    if on_exceed == 'resteer':
+        assert all(len(states) == n for states in states_batch)
+        assert all(sequence_infos[0] <= .5 for sequence_infos in infos)
+    print('{}: {:.3f}s, mean length {:.1f}, mean re-steers {:.1f}, mean infos {}'.format(
+        on_exceed, duration, statistics.mean(len(states) for states in states_batch),
+        statistics.mean(tracker.n_resteers for tracker in trackers), np.round(np.mean(infos, axis=0), 3).tolist()))
@@ -0,0 +1,23 @@
+import random
+from melodendron import MVVOMM, SuffixVOMM, VOMM, weighted_intersect_select
+from melodendron import MidiFileParser, add_derived_viewpoint, reduce_density
+
+# Stream states one by one into learn(), as a performer would play them, and report the per-insert latency.
+viewpoints = ['pitches', 'total_duration', 'on_duration', 'off_duration', 'dynamic', 'density']
+midi_file_parser = MidiFileParser('midi/bach_kyrie_eleison.mid')
+state_sequences = [midi_file_parser.get_states_from_tracks([track_idx]) for track_idx in range(1, 14)]
+for state_sequence in state_sequences:
+    add_derived_viewpoint(state_sequence, 'density', reduce_density)
+
+for vomm_class in (VOMM, SuffixVOMM):
+    model = MVVOMM(viewpoints, vomm_class=vomm_class)
+    for _ in range(4):
+        for state_sequence in state_sequences:
+            for state in state_sequence:
+                model.learn(dict(state), max_order=8)
+            model.end_learned_sequence()
+            # Generate a few states while learning, as in a live session
+            random.seed(0)
+            model.generate_n(16, weighted_intersect_select, order=4)
+    print('{} learn latency over {} states: {}'.format(vomm_class.__name__, len(model.state_sequence),
+                                                       model.learn_latency))
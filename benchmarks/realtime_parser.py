@@ -0,0 +1,33 @@
+import asyncio
+from melodendron import MVVOMM, MidiFileParser, RealtimeParser, scripted_source, midi_track_to_states
+
+# Play a track through the real time parser, learning the states and consuming them as they come, and check the
+# states are those parsed from the file.
+midi_file_parser = MidiFileParser('midi/chpn_op27_2.mid')
+track = midi_file_parser.get_track(1)
+ticks_per_beat = midi_file_parser.ticks_per_beat
+viewpoints = ['pitches', 'total_duration', 'on_duration', 'off_duration', 'dynamic']
+
+
+async def consume(queue, consumed_states):
+    while (state := await queue.get()) is not None:
+        consumed_states.append(state)
+
+
+async def main(speed):
+    model = MVVOMM(viewpoints)
+    realtime_parser = RealtimeParser(ticks_per_beat, tempo=500000, model=model)
+    consumed_states = list()
+    consumer = asyncio.create_task(consume(realtime_parser.subscribe(), consumed_states))
+    n_states = await realtime_parser.run(scripted_source(track, ticks_per_beat, tempo=500000, speed=speed))
+    await consumer
+    expected_states = midi_track_to_states(track, ticks_per_beat)
+    assert len(consumed_states) == len(expected_states)
+    for state, expected_state in zip(consumed_states, expected_states):
+        assert {key: state[key] for key in expected_state} == expected_state
+    print('speed {}: {} states, event latency: {}'.format(speed, n_states, realtime_parser.event_latency))
+    print('learn latency: {}'.format(model.learn_latency))
+
+
+asyncio.run(main(speed=None))
+asyncio.run(main(speed=100))
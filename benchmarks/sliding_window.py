@@ -0,0 +1,119 @@
+import gc
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+from melodendron import MVVOMM, RELEASED, LatencyStats, MidiFileParser, intersect_select, load_model, save_model
+
+# Learn a long live session (the bundled files played over and over, transposed) with a model bounded to the last
+# max_states states, and check that its memory and learn latency stay steady. The tries of the bounded model must be
+# those of a model holding only the kept states, each inserted with its context.
+viewpoints = ['pitches', 'total_duration', 'dynamic']
+joint_viewpoints = [('pitches', 'total_duration')]
+max_order = 8
+max_states = 2000
+states = list()
+for filepath in ('midi/chpn_op27_2.mid', 'midi/gnossienne_3.mid', 'midi/bach_contrapunctus_i.mid',
+                 'midi/bach_kyrie_eleison.mid'):
+    midi_file_parser = MidiFileParser(filepath)
+    states.extend(midi_file_parser.get_states_from_tracks(range(len(midi_file_parser.tracks))))
+
+
+def session(n_rounds):
+    for i in range(n_rounds):
+        shift = (7 * i + 6) % 12 - 6
+        for state in states:
+            yield dict(state, pitches={pitch + shift for pitch in state['pitches']})
+
+
+def trie_paths(vomm):
+    """Returns {reversed context path: continuation indexes} for every node of a trie."""
+    paths = dict()
+    stack = [((node.value,), node) for node in vomm.roots.values()]
+    while stack:
+        path, node = stack.pop()
+        paths[path] = set(node.continuation_idxs)
+        stack.extend((path + (child.value,), child) for child in node.children.values())
+    return paths
+
+
+def check(model):
+    assert model.end_idx - model.first_idx == min(max_states, model.end_idx)
+    for key, vomm in model._vomm_items():
+        reference = MVVOMM(viewpoints).vomms[viewpoints[0]]
+        symbol_column = model.symbol_columns[key]
+        for idx in range(model.first_idx, model.end_idx):
+            position = idx - model.storage_start
+            reference.insert(idx, symbol_column[position - model.context_lengths[position]:position])
+        assert trie_paths(vomm) == trie_paths(reference), key
+        counts = vomm.counts
+        vomm.counts = None
+        assert vomm.estimated_size() and vomm.counts == counts
+    if model.reclaim_symbols:
+        for key, counts in model.symbol_counts.items():
+            alphabet = model.joint_alphabets[key] if key in model.joint_alphabets else model.alphabets[key]
+            used_symbols = {symbol for symbol, value in enumerate(alphabet.values) if value is not RELEASED}
+            assert used_symbols == set(counts), key
+
+
+for reclaim_symbols in (False, True):
+    model = MVVOMM(viewpoints, joint_viewpoints=joint_viewpoints, max_states=max_states,
+                   reclaim_symbols=reclaim_symbols)
+    tracemalloc.start()
+    print('reclaim_symbols {}'.format(reclaim_symbols))
+    for i, state in enumerate(session(12), 1):
+        model.learn(state, max_order=max_order)
+        if i % len(states) == 0:
+            model.end_learned_sequence()
+            current_bytes, _ = tracemalloc.get_traced_memory()
+            print('  {:>6} states: {:>6} stored, estimated {:>6.2f} MB, traced {:>6.2f} MB, learn latency {}'.format(
+                i, len(model.state_sequence), model.estimated_size() / 2 ** 20, current_bytes / 2 ** 20,
+                model.learn_latency))
+            model.learn_latency = LatencyStats()
+    tracemalloc.stop()
+    check(model)
+    print('  alphabet sizes {}'.format({key: len(alphabet.values) for key, alphabet in model.alphabets.items()}))
+    random.seed(0)
+    start = time.perf_counter()
+    generated = model.generate_n(500, intersect_select, order=max_order)
+    print('  generate_n: {:.3f}s'.format(time.perf_counter() - start))
+    assert all(model.first_idx <= state['id'] < model.end_idx for state in generated)
+    # A loaded model keeps evicting states as the saved one does
+    with tempfile.TemporaryDirectory() as directory:
+        filepath = os.path.join(directory, 'model.mvvomm')
+        save_model(model, filepath)
+        loaded_model = load_model(filepath, use_mmap=False)
+    # Flat tries are accounted as the tries they were saved from
+    assert loaded_model.estimated_size() == model.estimated_size()
+    for state in states[:500]:
+        model.learn(dict(state), max_order=max_order)
+        loaded_model.learn(dict(state), max_order=max_order)
+    assert (loaded_model.first_idx, loaded_model.storage_start) == (model.first_idx, model.storage_start)
+    random.seed(0)
+    generated = model.generate_n(500, intersect_select, order=max_order)
+    random.seed(0)
+    assert loaded_model.generate_n(500, intersect_select, order=max_order) == generated
+
+# A memory budget bounds the estimated size instead of the number of states
+model = MVVOMM(viewpoints, memory_budget=2 * 2 ** 20)
+for state in session(2):
+    model.learn(state, max_order=max_order)
+assert model.estimated_size() <= 2 * 2 ** 20
+print('memory budget 2 MB: {} states kept, estimated {:.2f} MB'.format(model.end_idx - model.first_idx,
+                                                                        model.estimated_size() / 2 ** 20))
+
+# Learn latency with and without eviction. The cyclic garbage collector pauses learning for tens of milliseconds with
+# or without eviction, so it is disabled to time eviction itself.
+gc.disable()
+for bounds in (dict(), dict(max_states=max_states), dict(max_states=max_states, reclaim_symbols=True),
+               dict(memory_budget=2 * 2 ** 20)):
+    model = MVVOMM(viewpoints, joint_viewpoints=joint_viewpoints, **bounds)
+    model.learn_latency = LatencyStats(window=12 * len(states))
+    for i, state in enumerate(session(12), 1):
+        model.learn(state, max_order=max_order)
+        if i % len(states) == 0:
+            model.end_learned_sequence()
+    print('{} learn latency {}, p99.9: {:.3f}ms'.format(bounds or 'unbounded', model.learn_latency,
+                                                       model.learn_latency.percentile(99.9) * 1000))
+gc.enable()
@@ -0,0 +1,26 @@
+import time
+from melodendron import MVVOMM, MidiFileParser, StateSequence, add_derived_viewpoint, reduce_density, reduce_dynamic
+
+# Compare dict states and a columnar StateSequence on reductions and insertion, over a corpus of repeated tracks.
+midi_file_parser = MidiFileParser('midi/chpn_op27_2.mid')
+states = midi_file_parser.get_states_from_tracks([1, 2]) * 100
+state_sequence = StateSequence.from_states(states)
+viewpoints = ['pitches', 'total_duration', 'on_duration', 'off_duration', 'dynamic', 'density']
+print('{} states'.format(len(states)))
+
+start = time.perf_counter()
+add_derived_viewpoint(states, 'dynamic', reduce_dynamic)
+add_derived_viewpoint(states, 'density', reduce_density)
+print('dict reductions: {:.3f}s'.format(time.perf_counter() - start))
+start = time.perf_counter()
+add_derived_viewpoint(state_sequence, 'dynamic', reduce_dynamic)
+add_derived_viewpoint(state_sequence, 'density', reduce_density)
+print('columnar reductions: {:.3f}s'.format(time.perf_counter() - start))
+assert list(state_sequence) == states
+
+start = time.perf_counter()
+MVVOMM(viewpoints).insert_sequence([dict(state) for state in states], max_order=8)
+print('dict insert_sequence: {:.3f}s'.format(time.perf_counter() - start))
+start = time.perf_counter()
+MVVOMM(viewpoints).insert_sequence(state_sequence, max_order=8)
+print('columnar insert_sequence: {:.3f}s'.format(time.perf_counter() - start))
@@ -0,0 +1,198 @@
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from functools import partial
+import mido
+from melodendron import MVVOMM, MidiFileParser, midi_track_to_states, states_to_midi_track
+from melodendron import add_derived_viewpoint, reduce_density, reduce_dynamic
+from melodendron import random_select, intersect_select, weighted_intersect_select, exp_weighted_intersect_select
+from melodendron import hierarchical_select, hierarchical_backoff_select
+from melodendron import np_random_select, np_intersect_select, np_weighted_intersect_select, \
+    np_exp_weighted_intersect_select
+
+"""
+Benchmark suite.
+Times each stage of the pipeline separately, from opening a midi file to exporting states back to a midi track, on the
+bundled midi files and on synthetic corpora made of each file repeated scale times (each copy transposed so that the
+model does not only see exact repetitions). Each stage is timed repeat times, its best time is kept, then it is run
+once more under tracemalloc to record its peak memory.
+
+Results are written as JSON. Given a baseline, stages slower or larger than the baseline by more than the tolerance
+are reported as regressions and the script exits with status 1. Differences below the noise floor are ignored.
+
+    python benchmarks/suite.py --scales 1 10 --output results.json
+    python benchmarks/suite.py --scales 1 10 --baseline results.json --tolerance 0.25
+    python benchmarks/suite.py --files midi/gnossienne_3.mid --scales 100 1000 --repeat 1
+"""
+
+FORMAT_VERSION = 1
+MIDI_FILES = ['midi/chpn_op27_2.mid', 'midi/gnossienne_3.mid', 'midi/bach_contrapunctus_i.mid',
+              'midi/bach_kyrie_eleison.mid']
+VIEWPOINTS = ['pitches', 'total_duration', 'on_duration', 'off_duration', 'dynamic', 'density']
+SELECTORS = {
+    'random_select': random_select,
+    'intersect_select': intersect_select,
+    'weighted_intersect_select': weighted_intersect_select,
+    'exp_weighted_intersect_select': partial(exp_weighted_intersect_select, factor=1.2),
+    'hierarchical_select': hierarchical_select,
+    'hierarchical_backoff_select': hierarchical_backoff_select,
+    'np_random_select': np_random_select,
+    'np_intersect_select': np_intersect_select,
+    'np_weighted_intersect_select': np_weighted_intersect_select,
+    'np_exp_weighted_intersect_select': partial(np_exp_weighted_intersect_select, factor=1.2),
+}
+NOISE_FLOOR = dict(seconds=0.002, peak_bytes=64 * 1024)  # Absolute differences never reported as regressions
+
+
+def synthesize(filepath, scale, directory) -> str:
+    """Writes a midi file whose tracks are the tracks of filepath repeated scale times and returns its path.
+    The i-th copy of the notes is transposed by ((7 * i + 6) % 12) - 6 semitones, the first one is left as is."""
+    midi_file = mido.MidiFile(filepath)
+    synthetic_file = mido.MidiFile(type=midi_file.type, ticks_per_beat=midi_file.ticks_per_beat)
+    for track in midi_file.tracks:
+        synthetic_track = mido.MidiTrack()
+        for i in range(scale):
+            shift = (7 * i + 6) % 12 - 6
+            for msg in track:
+                if msg.type == 'end_of_track':
+                    continue
+                if msg.type in ('note_on', 'note_off'):
+                    msg = msg.copy(note=min(127, max(0, msg.note + shift)))
+                synthetic_track.append(msg)
+        synthetic_file.tracks.append(synthetic_track)
+    synthetic_filepath = os.path.join(directory, '{}_x{}.mid'.format(os.path.splitext(os.path.basename(filepath))[0],
+                                                                     scale))
+    synthetic_file.save(synthetic_filepath)
+    return synthetic_filepath
+
+
+def measure(func, repeat):
+    """Returns the result of func, its best time in seconds over repeat calls and the peak memory of one more call
+    in bytes."""
+    seconds = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        seconds = min(seconds, time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        result = func()
+        _, peak_bytes = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, seconds, peak_bytes
+
+
+def run_workload(filepath, repeat, n, order):
+    """Runs every stage on a midi file and returns {stage: measures}."""
+    results = dict()
+
+    def run(stage, func):
+        result, seconds, peak_bytes = measure(func, repeat)
+        results[stage] = dict(seconds=seconds, peak_bytes=peak_bytes)
+        print('  {:<48} {:>10.4f}s {:>10.1f} MB'.format(stage, seconds, peak_bytes / 2 ** 20), flush=True)
+        return result
+
+    def load():
+        midi_file_parser = MidiFileParser(filepath)
+        for track_idx in range(len(midi_file_parser.tracks)):
+            midi_file_parser.get_track(track_idx)
+        return midi_file_parser
+
+    midi_file_parser = run('MidiFileParser', load)
+    ticks_per_beat = midi_file_parser.ticks_per_beat
+    # All tracks are merged, as get_states_from_tracks does, before the conversion
+    track = mido.merge_tracks(midi_file_parser.tracks)
+    states = run('midi_track_to_states', lambda: midi_track_to_states(track, ticks_per_beat))
+    results['midi_track_to_states']['n_states'] = len(states)
+
+    def add_derived_viewpoints():
+        add_derived_viewpoint(states, 'dynamic', reduce_dynamic)
+        add_derived_viewpoint(states, 'density', reduce_density)
+
+    run('add_derived_viewpoint', add_derived_viewpoints)
+
+    def insert_sequence():
+        model = MVVOMM(VIEWPOINTS)
+        model.insert_sequence(states, max_order=order)
+        return model
+
+    model = run('insert_sequence', insert_sequence)
+    for name, selector in SELECTORS.items():
+        def generate_n():
+            # Every run starts with the same random state
+            random.seed(0)
+            return model.generate_n(n, selector=selector, order=order)
+
+        run('generate_n[{}]'.format(name), generate_n)
+    run('states_to_midi_track', lambda: states_to_midi_track(states, ticks_per_beat))
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Returns the regressions of results against a baseline as (workload, stage, measure, baseline, current)."""
+    regressions = list()
+    for workload, stages in results.items():
+        for stage, measures in stages.items():
+            baseline_measures = baseline.get(workload, dict()).get(stage)
+            if baseline_measures is None:
+                continue
+            for measure_name, noise_floor in NOISE_FLOOR.items():
+                value, baseline_value = measures[measure_name], baseline_measures[measure_name]
+                if value > baseline_value * (1 + tolerance) and value - baseline_value > noise_floor:
+                    regressions.append((workload, stage, measure_name, baseline_value, value))
+    return regressions
+
+
+def main():
+    argument_parser = argparse.ArgumentParser(description='Times and measures the memory of each pipeline stage.')
+    argument_parser.add_argument('--files', nargs='+', default=MIDI_FILES, help='midi files')
+    argument_parser.add_argument('--scales', nargs='+', type=int, default=[1, 10],
+                                 help='corpus scales, 1 is the file itself')
+    argument_parser.add_argument('--repeat', type=int, default=3, help='timed runs per stage, the best is kept')
+    argument_parser.add_argument('--n', type=int, default=500, help='length of generated sequences')
+    argument_parser.add_argument('--order', type=int, default=5, help='order of the model')
+    argument_parser.add_argument('--output', help='JSON file to write the results to')
+    argument_parser.add_argument('--baseline', help='JSON results to compare with')
+    argument_parser.add_argument('--tolerance', type=float, default=0.25,
+                                 help='relative increase over the baseline reported as a regression')
+    args = argument_parser.parse_args()
+
+    results = dict()
+    with tempfile.TemporaryDirectory() as directory:
+        for filepath in args.files:
+            for scale in args.scales:
+                workload = '{}:x{}'.format(os.path.basename(filepath), scale)
+                print(workload, flush=True)
+                workload_filepath = filepath if scale == 1 else synthesize(filepath, scale, directory)
+                results[workload] = run_workload(workload_filepath, args.repeat, args.n, args.order)
+    report = dict(format_version=FORMAT_VERSION, python=sys.version.split()[0], platform=platform.platform(),
+                  time=time.strftime('%Y-%m-%dT%H:%M:%S'), settings=dict(repeat=args.repeat, n=args.n,
+                                                                         order=args.order),
+                  results=results)
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+        print('Results were written to ' + args.output)
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        if baseline.get('settings') != report['settings']:
+            print('Warning: baseline settings {} differ from {}'.format(baseline.get('settings'), report['settings']))
+        regressions = compare(results, baseline['results'], args.tolerance)
+        for workload, stage, measure_name, baseline_value, value in regressions:
+            print('Regression {} {} {}: {:.4g} -> {:.4g} ({:+.0%})'.format(
+                workload, stage, measure_name, baseline_value, value, value / baseline_value - 1))
+        if regressions:
+            sys.exit(1)
+        print('No regression against ' + args.baseline)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,25 @@
+import random
+import time
+from melodendron import VOMM
+
+# Time VOMM insertion and lookup for increasing alphabet sizes.
+# With hashed children, both should stay roughly flat as the alphabet grows.
+sequence_length = 20000
+order = 8
+n_queries = 5000
+random.seed(0)
+
+print('{:>10} {:>14} {:>14}'.format('alphabet', 'insert (us)', 'query (us)'))
+for alphabet_size in (2, 8, 32, 128, 512, 2048):
+    sequence = [random.randrange(alphabet_size) for _ in range(sequence_length)]
+    vomm = VOMM()
+    start = time.perf_counter()
+    for i in range(len(sequence)):
+        vomm.insert(i, sequence[max(0, i - order):i])
+    insert_time = (time.perf_counter() - start) / len(sequence)
+    queries = [sequence[i - order:i] for i in random.sample(range(order, sequence_length), n_queries)]
+    start = time.perf_counter()
+    for query in queries:
+        vomm.get_continuation_idxs(query)
+    query_time = (time.perf_counter() - start) / n_queries
+    print('{:>10} {:>14.2f} {:>14.2f}'.format(alphabet_size, insert_time * 1e6, query_time * 1e6))
@@ -1,2 +1,3 @@
 from .model import *
-from .parser import *
\ No newline at end of file
+from .parser import *
+from .corpus import *
\ No newline at end of file
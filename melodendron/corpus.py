@@ -0,0 +1,59 @@
+from __future__ import annotations
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Dict, List, Sequence, Tuple, Type
+from melodendron.model import MVVOMM, VOMM, SuffixVOMM
+from melodendron.parser import MidiFileParser, StateSequenceCache, add_derived_viewpoint
+
+
+def train_file(filepath: str, track_idxs: List[int], viewpoints: List[str], max_order=8,
+               derived_viewpoints: Sequence[Tuple[str, Callable]] = (),
+               vomm_class: Type[VOMM | SuffixVOMM] = VOMM, cache: StateSequenceCache | None = None,
+               joint_viewpoints: Sequence[Sequence[str]] = ()) -> MVVOMM:
+    """Parses the given tracks of a midi file, adds the derived viewpoints and returns a MVVOMM trained on them.
+    With a cache, states of an unchanged file are read from it instead of being parsed."""
+    model = MVVOMM(viewpoints, vomm_class=vomm_class, joint_viewpoints=joint_viewpoints)
+    model.insert_sequence(_get_file_states(filepath, track_idxs, derived_viewpoints, cache), max_order=max_order)
+    return model
+
+
+def _get_file_states(filepath: str, track_idxs: List[int], derived_viewpoints: Sequence[Tuple[str, Callable]],
+                     cache: StateSequenceCache | None) -> List[Dict]:
+    """Returns the states of the given tracks of a midi file with the derived viewpoints, read from the cache if any."""
+    if cache is not None:
+        return cache.get_states_from_tracks(filepath, track_idxs, derived_viewpoints)
+    midi_file_parser = MidiFileParser(filepath)
+    state_sequence = midi_file_parser.get_states_from_tracks(track_idxs)
+    for viewpoint, reduction in derived_viewpoints:
+        add_derived_viewpoint(state_sequence, viewpoint, reduction)
+    return state_sequence
+
+
+def train_corpus(filepaths: List[str], viewpoints: List[str], track_idxs: List[int] | Dict[str, List[int]],
+                 max_order=8, derived_viewpoints: Sequence[Tuple[str, Callable]] = (),
+                 vomm_class: Type[VOMM | SuffixVOMM] = VOMM, max_workers: int | None = None,
+                 cache: StateSequenceCache | None = None, joint_viewpoints: Sequence[Sequence[str]] = ()) -> MVVOMM:
+    """Trains a MVVOMM on a corpus of midi files.
+    Files are parsed and trained in a process pool and the partial models are merged in file order, which gives the
+    same model as inserting the files one after the other. track_idxs is either used for all files or given by file.
+    Reduction functions of derived_viewpoints must be picklable (module level functions or partials of them).
+    With max_workers=1, files are inserted one after the other in the current process, without partial models to
+    merge. A cache skips parsing of unchanged files."""
+    n_files = len(filepaths)
+    if not isinstance(track_idxs, dict):
+        track_idxs = {filepath: track_idxs for filepath in filepaths}
+    model = MVVOMM(viewpoints, vomm_class=vomm_class, joint_viewpoints=joint_viewpoints)
+    if max_workers == 1:
+        for filepath in filepaths:
+            model.insert_sequence(_get_file_states(filepath, track_idxs[filepath], derived_viewpoints, cache),
+                                  max_order=max_order)
+        return model
+    jobs = (filepaths, [track_idxs[filepath] for filepath in filepaths], [viewpoints] * n_files,
+            [max_order] * n_files, [derived_viewpoints] * n_files, [vomm_class] * n_files, [cache] * n_files,
+            [joint_viewpoints] * n_files)
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        for partial_model in executor.map(train_file, *jobs):
+            model.merge(partial_model)
+    return model
+
+
+__all__ = ['train_file', 'train_corpus']
@@ -0,0 +1,181 @@
+from __future__ import annotations
+from typing import Any, Iterator, List, Sequence
+from array import array
+from bisect import bisect_left
+from melodendron.model.index_set import IndexSet
+from melodendron.model.VOMM import VOMM, VOMMNode, _trie_size
+
+
+class FlatVOMM:
+    """A Variable Order Markov Model trie stored as contiguous arrays.
+    Nodes are laid out breadth first, the children of a node are contiguous and sorted by value so that each trie
+    step is a binary search. The arrays can be memory mapped from a saved model (see serialization).
+    It answers queries without building any node. The first insert or merge converts it to a VOMM.
+    """
+
+    def __init__(self, root_count: int, values: Sequence[int], first_children: Sequence[int],
+                 child_counts: Sequence[int], idx_starts: Sequence[int], idx_counts: Sequence[int],
+                 idxs: Sequence[int]):
+        self.root_count = root_count
+        self.values = values                  # Value of each node
+        self.first_children = first_children  # Node index of the first child of each node
+        self.child_counts = child_counts      # Number of children of each node
+        self.idx_starts = idx_starts          # Start of the continuation indexes of each node in idxs
+        self.idx_counts = idx_counts          # Number of continuation indexes of each node
+        self.idxs = idxs                      # Sorted continuation indexes of all nodes, concatenated
+        self.vomm = None                      # The VOMM this FlatVOMM was converted to, once modified
+
+    @classmethod
+    def from_vomm(cls, vomm: VOMM) -> FlatVOMM:
+        """Flattens a VOMM, whose node values must be integer symbols."""
+        values, first_children, child_counts = array('I'), array('I'), array('I')
+        idx_starts, idx_counts, idxs = array('Q'), array('I'), array('I')
+        level = sorted(vomm.roots.items())
+        root_count = len(level)
+        while level:
+            next_level = list()
+            for value, node in level:
+                values.append(value)
+                first_children.append(0)
+                children = sorted(node.children.items())
+                child_counts.append(len(children))
+                idx_starts.append(len(idxs))
+                idx_counts.append(len(node.continuation_idxs))
+                idxs.extend(node.continuation_idxs)
+                next_level.extend(children)
+            level = next_level
+        # Children of each level follow the whole level, in the order of their parents
+        next_child = root_count
+        for node in range(len(values)):
+            first_children[node] = next_child
+            next_child += child_counts[node]
+        return cls(root_count, values, first_children, child_counts, idx_starts, idx_counts, idxs)
+
+    def __repr__(self):
+        return 'FlatVOMM()'
+
+    def __str__(self):
+        if self.vomm is not None:
+            return str(self.vomm)
+        return 'FlatVOMM(nodes={}, continuations={})'.format(len(self.values), len(self.idxs))
+
+    def __getstate__(self):
+        if self.vomm is not None:
+            return {'vomm': self.vomm}
+        return {'root_count': self.root_count, 'values': array('I', self.values),
+                'first_children': array('I', self.first_children), 'child_counts': array('I', self.child_counts),
+                'idx_starts': array('Q', self.idx_starts), 'idx_counts': array('I', self.idx_counts),
+                'idxs': array('I', self.idxs)}
+
+    def __setstate__(self, state):
+        if 'vomm' in state:
+            self.vomm = state['vomm']
+            return
+        self.__init__(**state)
+
+    def _find(self, start: int, count: int, value: Any) -> int | None:
+        """Returns the node with the given value among count consecutive sibling nodes, or None."""
+        if not isinstance(value, int) or count == 0:
+            return None
+        node = bisect_left(self.values, value, start, start + count)
+        if node == start + count or self.values[node] != value:
+            return None
+        return node
+
+    def to_vomm(self) -> VOMM:
+        """Builds a VOMM with the same nodes and continuation indexes."""
+        if self.vomm is not None:
+            return self.vomm
+        vomm = VOMM()
+        vomm.counts = None
+        level = [(vomm.roots, node) for node in range(self.root_count)]
+        while level:
+            next_level = list()
+            for children, node in level:
+                vomm_node = VOMMNode.__new__(VOMMNode)
+                vomm_node.value = self.values[node]
+                idx_start = self.idx_starts[node]
+                vomm_node.continuation_idxs = IndexSet.from_sorted(
+                    array('I', self.idxs[idx_start:idx_start + self.idx_counts[node]]))
+                vomm_node.children = dict()
+                children[vomm_node.value] = vomm_node
+                first_child = self.first_children[node]
+                next_level.extend((vomm_node.children, child)
+                                  for child in range(first_child, first_child + self.child_counts[node]))
+            level = next_level
+        return vomm
+
+    def insert(self, continuation_idx: int, context_values: List[Any]):
+        if self.vomm is None:
+            self.vomm = self.to_vomm()
+        self.vomm.insert(continuation_idx, context_values)
+
+    def merge(self, other: VOMM | FlatVOMM, symbol_map: List[int], offset: int):
+        if self.vomm is None:
+            self.vomm = self.to_vomm()
+        self.vomm.merge(other, symbol_map, offset)
+
+    def remove(self, continuation_idx: int, context_values: List[Any]):
+        if self.vomm is None:
+            self.vomm = self.to_vomm()
+        self.vomm.remove(continuation_idx, context_values)
+
+    def estimated_size(self) -> int:
+        """Returns the estimated size of the equivalent VOMM trie, not of the flat arrays: a FlatVOMM is converted to
+        a VOMM on its first modification, so a memory budget (see MVVOMM) is accounted the same way for both."""
+        if self.vomm is not None:
+            return self.vomm.estimated_size()
+        return _trie_size(len(self.values), len(self.idxs))
+
+    def get_continuation_idxs(self, context_values: List[Any]) -> IndexSet | None:
+        if self.vomm is not None:
+            return self.vomm.get_continuation_idxs(context_values)
+        if not context_values:
+            return None
+        node = self._find(0, self.root_count, context_values[-1])
+        if node is None:
+            return None
+        for context_value in context_values[-2::-1]:
+            next_node = self._find(self.first_children[node], self.child_counts[node], context_value)
+            if next_node is None:
+                break
+            node = next_node
+        idx_start = self.idx_starts[node]
+        return IndexSet.from_sorted(self.idxs[idx_start:idx_start + self.idx_counts[node]])
+
+    def matched_depth(self, context_values: List[Any]) -> int:
+        """Returns the length of the context suffix matched by get_continuation_idxs, 0 if there is none."""
+        if self.vomm is not None:
+            return self.vomm.matched_depth(context_values)
+        if not context_values:
+            return 0
+        node = self._find(0, self.root_count, context_values[-1])
+        if node is None:
+            return 0
+        depth = 1
+        for context_value in context_values[-2::-1]:
+            node = self._find(self.first_children[node], self.child_counts[node], context_value)
+            if node is None:
+                break
+            depth += 1
+        return depth
+
+    def iter_continuation_idxs_by_depth(self, context_values: List[Any]) -> Iterator[IndexSet]:
+        """Yields the continuation indexes of each matched context suffix, from the longest to the shortest."""
+        if self.vomm is not None:
+            yield from self.vomm.iter_continuation_idxs_by_depth(context_values)
+            return
+        if not context_values:
+            return
+        node = self._find(0, self.root_count, context_values[-1])
+        if node is None:
+            return
+        nodes = [node]
+        for context_value in context_values[-2::-1]:
+            node = self._find(self.first_children[node], self.child_counts[node], context_value)
+            if node is None:
+                break
+            nodes.append(node)
+        for node in reversed(nodes):
+            idx_start = self.idx_starts[node]
+            yield IndexSet.from_sorted(self.idxs[idx_start:idx_start + self.idx_counts[node]])
@@ -1,8 +1,21 @@
 from __future__ import annotations
 
-from typing import List, Any, Dict, Callable, Set
+from typing import List, Any, Dict, Callable, Set, Iterable, Iterator, Sequence, Tuple, Type
+from array import array
+from collections import Counter, deque
+from functools import partial
 from melodendron.model.VOMM import VOMM
+from melodendron.model.SuffixVOMM import SuffixVOMM
+from melodendron.model.alphabet import Alphabet
+from melodendron.model.stats import Instrumentation, LatencyStats
+import inspect
 import random
+import sys
+import time
+
+
+_EXPLICIT_CONTEXT = 0xFFFFFFFF  # Context length of a state inserted with a context given to insert
+_TRIM_SIZE = 256                # Number of evicted states dropped from the sequence at once
 
 
 class MVVOMM:
@@ -16,87 +29,662 @@ class MVVOMM:
     Based on "The Continuator: Musical Interaction With Style"
     by F. Pachet (2010) and "Multiple Viewpoints Systems for
     Music Prediction" by I. Witten and D. Conklin (1993).
+
+    The VOMM engine is selected with vomm_class: VOMM (a trie bounded by
+    the insertion order) or SuffixVOMM (a suffix automaton matching
+    contexts of any length in linear memory).
+
+    Viewpoints always used together can be given as joint_viewpoints: each
+    combination gets its own VOMM on tuples of symbols, so that selectors in
+    the intersection of the viewpoints (intersect_select) get its joint
+    continuations in a single lookup. Other selectors are not affected.
+
+    Instrumentation is opt-in (see enable_instrumentation).
+
+    For long live sessions, the model can be bounded by a maximum number of
+    states (max_states) or an estimated memory budget in bytes (memory_budget,
+    see estimated_size). The oldest states are then evicted from the VOMMs,
+    which must be VOMM tries, and nodes left empty are pruned. State indexes
+    keep growing: evicted indexes are never returned again. With
+    reclaim_symbols, symbols no longer used by any kept state are released
+    from the alphabets and reused. Eviction keeps learn O(order): a learned
+    state evicts about one state. Evicted states leave the storage by batches
+    of 256, releasing their symbols with reclaim_symbols, which adds about a
+    millisecond to one learn call in 256 (see benchmarks/sliding_window.py).
     """
 
-    def __init__(self, viewpoints: List[str], verbose=False):
+    def __init__(self, viewpoints: List[str], verbose=False, vomm_class: Type[VOMM | SuffixVOMM] = VOMM,
+                 joint_viewpoints: Sequence[Sequence[str]] = (), max_states: int | None = None,
+                 memory_budget: int | None = None, reclaim_symbols=False):
         self.viewpoints = viewpoints                                  # A list of viewpoints
-        self.alphabets = {}
+        self.joint_viewpoints = [tuple(joint_viewpoint) for joint_viewpoint in joint_viewpoints]  # Combinations
+        for joint_viewpoint in self.joint_viewpoints:
+            if len(joint_viewpoint) < 2 or not set(joint_viewpoint) <= set(viewpoints):
+                raise ValueError('Joint viewpoint {} is not a combination of {}'.format(joint_viewpoint, viewpoints))
+        self.alphabets = {}                                           # A dict of Alphabet with their viewpoint as key
+        self.joint_alphabets = {joint_viewpoint: Alphabet() for joint_viewpoint in self.joint_viewpoints}
         self.state_sequence = list()                                  # An ordered sequence of all states
-        self.vomms = {viewpoint: VOMM() for viewpoint in viewpoints}  # A dict of VOMM with their viewpoint as key
+        self.symbol_columns = {viewpoint: array('I') for viewpoint in [*viewpoints, *self.joint_viewpoints]}
+        self.vomms = {viewpoint: vomm_class() for viewpoint in viewpoints}  # A VOMM for each viewpoint
+        self.joint_vomms = {joint_viewpoint: vomm_class() for joint_viewpoint in self.joint_viewpoints}
         self.verbose = verbose
+        self.learning_start = None                                    # Index of the first state of the learned sequence
+        self.learn_latency = LatencyStats()                           # Latency of each learn call
+        self.instrumentation = None                                   # Counters and histograms, when enabled
+        self.instrumented_vomms = dict()                              # Timed VOMMs, when instrumentation is enabled
+        if (max_states is not None or memory_budget is not None) and not issubclass(vomm_class, VOMM):
+            raise ValueError('Evicting states requires {} tries, not {}'.format(VOMM.__name__, vomm_class.__name__))
+        if max_states is not None and max_states < 1:
+            raise ValueError('max_states must be positive')
+        self.max_states = max_states                                  # Maximum number of kept states
+        self.memory_budget = memory_budget                            # Maximum estimated bytes (see estimated_size)
+        self.reclaim_symbols = reclaim_symbols                        # Release symbols of evicted states
+        self.storage_start = 0                                        # Index of the first stored state
+        self.first_idx = 0                                            # Index of the oldest state not evicted
+        self.context_lengths = array('I')                             # Length of the context of each stored state
+        self.max_context_length = 0
+        self.explicit_contexts = dict()                               # Contexts given to insert, when bounded
+        self.symbol_counts = dict()                                   # Uses of each symbol, with reclaim_symbols
 
     def __repr__(self):
         return 'VOMM(viewpoints={})'.format(self.viewpoints)
 
-    def _state_to_mapped_state(self, state):
+    @property
+    def bounded(self) -> bool:
+        return self.max_states is not None or self.memory_budget is not None
+
+    @property
+    def end_idx(self) -> int:
+        """The index of the next inserted state."""
+        return self.storage_start + len(self.state_sequence)
+
+    def _mapped_state(self, idx: int) -> Dict[str, Any]:
+        return self.state_sequence[idx - self.storage_start]
+
+    def enable_instrumentation(self, instrumentation: Instrumentation | None = None) -> Instrumentation:
+        """Starts recording counters and histograms of next, insert and of the VOMM lookups, and returns them.
+        - next: encode, lookup, select and decode seconds, candidates by viewpoint, selections falling back to a random
+          state because the selector returned None. Selections of generate_n and generate_batch record the same
+          select metrics,
+        - insert: encode and VOMM insertion seconds,
+        - VOMM lookups: seconds, matched context depth and number of continuations by viewpoint. For
+          back-off selectors, each depth given to the selector is a lookup.
+        Disabled instrumentation costs a test per call."""
+        self.instrumentation = instrumentation if instrumentation is not None else Instrumentation()
+        self.instrumented_vomms = {key: _InstrumentedVOMM(vomms, key, self.instrumentation)
+                                   for vomms in (self.vomms, self.joint_vomms) for key in vomms}
+        return self.instrumentation
+
+    def disable_instrumentation(self):
+        self.instrumentation = None
+        self.instrumented_vomms = dict()
+
+    def _state_to_mapped_state(self, state, read_only=False):
+        """Maps each state value to its symbol in the viewpoint alphabet.
+        In read_only mode, unseen values are mapped to None instead of being added to the alphabets."""
         mapped_state = {'id': state['id']}
         for viewpoint in (viewpoint for viewpoint in state if viewpoint != 'id'):
-            if viewpoint not in self.alphabets:
-                self.alphabets[viewpoint] = {0: state[viewpoint]}
-            else:
-                alphabet = self.alphabets[viewpoint]
-                key, value = next(((key, value) for key, value in alphabet.items()
-                                   if state[viewpoint] == value), (None, None))
-                if key is None:
-                    key = len(alphabet)
-                    value = state[viewpoint]
-                    alphabet[key] = value
-                mapped_state[viewpoint] = key
+            alphabet = self.alphabets.get(viewpoint)
+            if alphabet is None:
+                if read_only:
+                    mapped_state[viewpoint] = None
+                    continue
+                alphabet = self.alphabets[viewpoint] = Alphabet()
+            mapped_state[viewpoint] = alphabet.encode(state[viewpoint], read_only=read_only)
         return mapped_state
 
     def _mapped_state_to_state(self, mapped_state):
         state = {'id': mapped_state['id']}
         for viewpoint in (viewpoint for viewpoint in mapped_state if viewpoint != 'id'):
-            state[viewpoint] = self.alphabets[viewpoint][mapped_state[viewpoint]]
+            state[viewpoint] = self.alphabets[viewpoint].decode(mapped_state[viewpoint])
         return state
 
-    def insert(self, state: Dict[str, Any], context_states: List[Dict[str, Any]]):
-        """Inserts a new state into the sequence and updates the VOMMs."""
+    def _append_state(self, state: Dict[str, Any]) -> int:
+        """Encodes a state, appends it to the sequence and to the symbol columns and returns its index."""
         # Add an id to the state (useful to compute plagiarism related metrics)
-        state['id'] = len(self.state_sequence)
+        state['id'] = self.end_idx
+        position = len(self.state_sequence)
         mapped_state = self._state_to_mapped_state(state)
         self.state_sequence.append(mapped_state)
-        # Insert the continuation index with context in each viewpoints VOMM
-        continuation_idx = len(self.state_sequence) - 1
         for viewpoint in self.viewpoints:
-            vomm = self.vomms[viewpoint]
-            mapped_context_states = [self._state_to_mapped_state(state) for state in context_states]
-            mapped_context_values = [mapped_state[viewpoint] for mapped_state in mapped_context_states]
-            vomm.insert(continuation_idx, mapped_context_values)
+            self.symbol_columns[viewpoint].append(mapped_state[viewpoint])
+        self._append_joint_symbols(position)
+        if self.reclaim_symbols:
+            self._count_symbols(position)
+        return state['id']
+
+    def _append_factorized_states(self, factorized_columns: Dict[str, tuple]):
+        """Appends states given as factorized columns (see StateSequence.factorize), encoding distinct values once."""
+        start = len(self.state_sequence)
+        symbol_columns = dict()
+        for key, (values, codes) in factorized_columns.items():
+            if key == 'id':
+                continue
+            alphabet = self.alphabets.setdefault(key, Alphabet())
+            symbol_map = [alphabet.encode(value) for value in values]
+            symbol_columns[key] = [symbol_map[code] for code in codes]
+        keys = list(symbol_columns)
+        for idx, symbols in enumerate(zip(*symbol_columns.values()), self.storage_start + start):
+            mapped_state = {'id': idx}
+            mapped_state.update(zip(keys, symbols))
+            self.state_sequence.append(mapped_state)
+        for viewpoint in self.viewpoints:
+            self.symbol_columns[viewpoint].extend(symbol_columns[viewpoint])
+        self._append_joint_symbols(start)
+        if self.reclaim_symbols:
+            self._count_symbols(start)
 
-    def insert_sequence(self, state_sequence, max_order=8):
-        for i, state in enumerate(state_sequence):
-            self.insert(state, state_sequence[i - max_order:i])
+    def _append_joint_symbols(self, start: int):
+        """Encodes the tuples of viewpoint symbols of the states from start into the joint symbol columns."""
+        for joint_viewpoint in self.joint_viewpoints:
+            encode = self.joint_alphabets[joint_viewpoint].encode
+            symbols = zip(*(self.symbol_columns[viewpoint][start:] for viewpoint in joint_viewpoint))
+            self.symbol_columns[joint_viewpoint].extend(encode(joint_symbols) for joint_symbols in symbols)
 
-    def next(self, context_states: List[Dict[str, Any]],
-             selector: Callable[[Dict[str: Set[Any]]], int | None]) -> Dict[str, Any]:
-        """Returns a state given a context sequence and a selector."""
-        # Find all potential continuations for each viewpoint
+    def _count_symbols(self, start: int):
+        """Counts the uses of the symbols of the stored states from position start."""
+        for mapped_state in self.state_sequence[start:]:
+            for key, symbol in mapped_state.items():
+                if key != 'id':
+                    self.symbol_counts.setdefault(key, Counter())[symbol] += 1
+        for joint_viewpoint in self.joint_viewpoints:
+            self.symbol_counts.setdefault(joint_viewpoint, Counter()).update(
+                self.symbol_columns[joint_viewpoint][start:])
+
+    def _release_symbols(self, key, symbols: Iterable[int]):
+        """Removes uses of symbols and releases those no longer used."""
+        counts = self.symbol_counts[key]
+        alphabet = self.joint_alphabets[key] if key in self.joint_alphabets else self.alphabets[key]
+        for symbol in symbols:
+            counts[symbol] -= 1
+            if counts[symbol] == 0:
+                del counts[symbol]
+                alphabet.release(symbol)
+
+    def estimated_size(self) -> int:
+        """Returns an estimate in bytes of the memory taken by the VOMMs and the stored states, alphabets excluded.
+        The VOMMs must be VOMM or FlatVOMM, both are accounted as VOMM tries (see FlatVOMM.estimated_size)."""
+        size = sum(vomm.estimated_size() for _, vomm in self._vomm_items())
+        if self.state_sequence:
+            state_size = sys.getsizeof(self.state_sequence[-1]) + 4 * (len(self.symbol_columns) + 1)
+            size += len(self.state_sequence) * state_size
+        return size
+
+    def _evict(self):
+        """Evicts the oldest states while the model has more than max_states states or exceeds its memory budget."""
+        while self.first_idx < self.end_idx and (
+                self.max_states is not None and self.end_idx - self.first_idx > self.max_states
+                or self.memory_budget is not None and self.estimated_size() > self.memory_budget):
+            self._evict_oldest()
+        self._trim_storage()
+
+    def _evict_oldest(self):
+        """Removes the oldest state from the VOMMs, with the context it was inserted with."""
+        idx = self.first_idx
+        position = idx - self.storage_start
+        context_length = self.context_lengths[position]
+        if context_length == _EXPLICIT_CONTEXT:
+            context_symbols = self.explicit_contexts.pop(idx)
+        else:
+            context_symbols = {key: symbol_column[position - context_length:position]
+                               for key, symbol_column in self.symbol_columns.items()}
+        for key, vomm in self._vomm_items():
+            context = context_symbols[key]
+            if context:
+                vomm.remove(idx, context)
+        if context_length == _EXPLICIT_CONTEXT and self.reclaim_symbols:
+            for key, context in context_symbols.items():
+                self._release_symbols(key, context)
+        self.first_idx += 1
+
+    def _trim_storage(self):
+        """Drops evicted states from the sequence and the symbol columns, by batches of _TRIM_SIZE states.
+        The last max_context_length evicted states are kept: they can be in the context of kept states."""
+        n_trimmed = self.first_idx - self.max_context_length - self.storage_start
+        if n_trimmed < _TRIM_SIZE:
+            return
+        if self.reclaim_symbols:
+            for mapped_state in self.state_sequence[:n_trimmed]:
+                for key, symbol in mapped_state.items():
+                    if key != 'id':
+                        self._release_symbols(key, (symbol,))
+            for joint_viewpoint in self.joint_viewpoints:
+                self._release_symbols(joint_viewpoint, self.symbol_columns[joint_viewpoint][:n_trimmed])
+        del self.state_sequence[:n_trimmed]
+        for symbol_column in self.symbol_columns.values():
+            del symbol_column[:n_trimmed]
+        del self.context_lengths[:n_trimmed]
+        self.storage_start += n_trimmed
+
+    def _joint_context_symbols(self, joint_viewpoint: Tuple[str, ...], context_symbols: Dict[str, List[int | None]],
+                               read_only=False) -> List[int | None]:
+        """Encodes the contexts of the viewpoints of a combination into a joint context."""
+        alphabet = self.joint_alphabets[joint_viewpoint]
+        return [None if None in joint_symbols else alphabet.encode(joint_symbols, read_only=read_only)
+                for joint_symbols in zip(*(context_symbols[viewpoint] for viewpoint in joint_viewpoint))]
+
+    def _context_symbols(self, context_idxs: Iterable[int]) -> Dict[Any, List[int]]:
+        """Reads the contexts of the viewpoints and of their combinations from the symbol columns."""
+        positions = [idx - self.storage_start for idx in context_idxs]
+        return {viewpoint: [symbol_column[position] for position in positions]
+                for viewpoint, symbol_column in self.symbol_columns.items()}
+
+    def _vomm_items(self):
+        """The VOMM of each viewpoint then of each combination, with their key in symbol_columns."""
+        return [*self.vomms.items(), *self.joint_vomms.items()]
+
+    def _get_continuation_idxs_by_viewpoints(self, context_symbols: Dict[str, List[int | None]], joint=False):
+        """Returns the continuation indexes of each viewpoint VOMM given encoded contexts.
+        With joint, a combination of viewpoints with a joint VOMM replaces its viewpoints, at the place of the first
+        one, when its joint context is matched as deep as the context of each of its viewpoints: its continuations are
+        then the intersection of theirs. Otherwise its viewpoints are looked up one by one."""
+        vomms, joint_vomms = self.vomms, self.joint_vomms
+        if self.instrumentation is not None:
+            vomms = joint_vomms = self.instrumented_vomms
+        joint_viewpoint_by_viewpoint = dict()
+        for joint_viewpoint in self.joint_viewpoints if joint else ():
+            if any(viewpoint in joint_viewpoint_by_viewpoint for viewpoint in joint_viewpoint):
+                continue
+            depth = self.joint_vomms[joint_viewpoint].matched_depth(context_symbols[joint_viewpoint])
+            if depth and all(self.vomms[viewpoint].matched_depth(context_symbols[viewpoint]) == depth
+                             for viewpoint in joint_viewpoint):
+                joint_viewpoint_by_viewpoint.update(dict.fromkeys(joint_viewpoint, joint_viewpoint))
         continuation_idxs_by_viewpoints = dict()
         for viewpoint in self.viewpoints:
-            vomm = self.vomms[viewpoint]
-            mapped_context_states = [self._state_to_mapped_state(state) for state in context_states]
-            mapped_context_values = [mapped_state[viewpoint] for mapped_state in mapped_context_states]
-            continuation_idxs_by_viewpoints[viewpoint] = vomm.get_continuation_idxs(mapped_context_values)
-        # Select a continuation index using the selector
+            joint_viewpoint = joint_viewpoint_by_viewpoint.get(viewpoint)
+            if joint_viewpoint is None:
+                continuation_idxs_by_viewpoints[viewpoint] = vomms[viewpoint].get_continuation_idxs(
+                    context_symbols[viewpoint])
+            elif joint_viewpoint not in continuation_idxs_by_viewpoints:
+                continuation_idxs_by_viewpoints[joint_viewpoint] = joint_vomms[joint_viewpoint].get_continuation_idxs(
+                    context_symbols[joint_viewpoint])
+        return continuation_idxs_by_viewpoints
+
+    def _get_continuation_idxs_chains_by_viewpoints(self, context_symbols: Dict[str, List[int | None]]):
+        """Returns, for each viewpoint, an iterator on its continuation indexes from the longest to the shortest
+        matched context.
+        Joint viewpoints are not used: back-off selectors are hierarchical and skip viewpoints one by one."""
+        vomms = self.vomms if self.instrumentation is None else self.instrumented_vomms
+        return {viewpoint: vomms[viewpoint].iter_continuation_idxs_by_depth(context_symbols[viewpoint])
+                for viewpoint in self.viewpoints}
+
+    def _selector_lookup(self, selector: Callable) -> Callable[[Dict[str, List[int | None]]], Dict[Any, Any]]:
+        """Returns the lookup giving a selector its input: continuation indexes by decreasing depth for back-off
+        selectors, continuation indexes with joint viewpoints for selectors in the intersection of the viewpoints, and
+        per viewpoint continuation indexes otherwise."""
+        if _uses_depth_chains(selector):
+            return self._get_continuation_idxs_chains_by_viewpoints
+        if _uses_intersection(selector):
+            return partial(self._get_continuation_idxs_by_viewpoints, joint=True)
+        return self._get_continuation_idxs_by_viewpoints
+
+    def _select_idx(self, context_symbols: Dict[str, List[int | None]],
+                    selector: Callable[[Dict[str: Set[Any]]], int | None], rng=None) -> int:
+        """Returns a continuation index given encoded contexts and a selector."""
+        if self.instrumentation is not None:
+            return self._instrumented_select_idx(context_symbols, selector, rng)
+        continuation_idxs_by_viewpoints = self._selector_lookup(selector)(context_symbols)
         selected_continuation_idx = selector(continuation_idxs_by_viewpoints)
-        # If nothing was selected, return a random state
+        # If nothing was selected, return a random index
+        if selected_continuation_idx is None:
+            return self._random_idx(rng)
+        return selected_continuation_idx
+
+    def _instrumented_select_idx(self, context_symbols: Dict[str, List[int | None]],
+                                 selector: Callable[[Dict[str: Set[Any]]], int | None], rng=None) -> int:
+        """_select_idx, recording the lookup and selector seconds, the candidates and the random fallbacks."""
+        instrumentation = self.instrumentation
+        start_time = time.perf_counter()
+        depth_chains = _uses_depth_chains(selector)
+        continuation_idxs_by_viewpoints = self._selector_lookup(selector)(context_symbols)
+        lookup_time = time.perf_counter()
+        selected_continuation_idx = selector(continuation_idxs_by_viewpoints)
+        self._record_selection(continuation_idxs_by_viewpoints, depth_chains, selected_continuation_idx,
+                               lookup_time - start_time, time.perf_counter() - lookup_time)
+        if selected_continuation_idx is None:
+            return self._random_idx(rng)
+        return selected_continuation_idx
+
+    def _record_selection(self, continuation_idxs_by_viewpoints: Dict[Any, Any], depth_chains: bool,
+                          selected_continuation_idx: int | None, lookup_seconds: float, selector_seconds: float):
+        instrumentation = self.instrumentation
+        instrumentation.observe('select.lookup_seconds', lookup_seconds)
+        instrumentation.observe('select.selector_seconds', selector_seconds)
+        instrumentation.count('select.calls')
+        if not depth_chains:
+            # Depth chains are iterators consumed by the selector
+            for key, continuation_idxs in continuation_idxs_by_viewpoints.items():
+                instrumentation.observe('select.candidates.' + _metric_name(key),
+                                        len(continuation_idxs) if continuation_idxs is not None else 0)
         if selected_continuation_idx is None:
-            selected_mapped_state = random.choice(self.state_sequence)
-            return self._mapped_state_to_state(selected_mapped_state)
-        # Else return the state corresponding to the selected continuation index
-        selected_mapped_state = self.state_sequence[selected_continuation_idx]
-        return self._mapped_state_to_state(selected_mapped_state)
+            instrumentation.count('select.random_fallbacks')
+
+    def insert(self, state: Dict[str, Any], context_states: List[Dict[str, Any]]):
+        """Inserts a new state into the sequence and updates the VOMMs."""
+        instrumentation = self.instrumentation
+        if instrumentation is not None:
+            start_time = time.perf_counter()
+        self.learning_start = None
+        continuation_idx = self._append_state(state)
+        # Encode the context once and insert the continuation index with context in each viewpoints VOMM
+        mapped_context_states = [self._state_to_mapped_state(state) for state in context_states]
+        context_symbols = {viewpoint: [mapped_state[viewpoint] for mapped_state in mapped_context_states]
+                           for viewpoint in self.viewpoints}
+        for joint_viewpoint in self.joint_viewpoints:
+            context_symbols[joint_viewpoint] = self._joint_context_symbols(joint_viewpoint, context_symbols)
+        self.context_lengths.append(_EXPLICIT_CONTEXT)
+        if self.bounded:
+            self.explicit_contexts[continuation_idx] = context_symbols
+            if self.reclaim_symbols:
+                for key, context in context_symbols.items():
+                    self.symbol_counts.setdefault(key, Counter()).update(context)
+        if instrumentation is not None:
+            encode_time = time.perf_counter()
+        for viewpoint, vomm in self._vomm_items():
+            mapped_context_values = context_symbols[viewpoint]
+            vomm.insert(continuation_idx, mapped_context_values)
+        if self.bounded:
+            self._evict()
+        if instrumentation is not None:
+            instrumentation.observe('insert.encode_seconds', encode_time - start_time)
+            instrumentation.observe('insert.vomm_seconds', time.perf_counter() - encode_time)
+            instrumentation.count('insert.calls')
+
+    def insert_sequence(self, state_sequence: Iterable[Dict[str, Any]], max_order=8):
+        """Inserts a sequence of states.
+        The whole sequence is encoded once into the symbol columns, then each VOMM is fed with slices of its column.
+        Contexts do not cross the boundary with previously inserted sequences.
+        Columnar sequences (see StateSequence) are encoded column by column, without building state dicts."""
+        self.learning_start = None
+        start = len(self.state_sequence)
+        if hasattr(state_sequence, 'factorize'):
+            self._append_factorized_states(state_sequence.factorize())
+        else:
+            for state in state_sequence:
+                self._append_state(state)
+        end = len(self.state_sequence)
+        self.context_lengths.extend(min(position - start, max_order) for position in range(start, end))
+        if end > start:
+            self.max_context_length = max(self.max_context_length, min(end - start - 1, max_order))
+        for viewpoint, vomm in self._vomm_items():
+            symbol_column = self.symbol_columns[viewpoint]
+            for position in range(start, end):
+                vomm.insert(self.storage_start + position, symbol_column[max(start, position - max_order):position])
+        if self.bounded:
+            self._evict()
+
+    def learn(self, state: Dict[str, Any], max_order=8) -> int:
+        """Inserts a state streamed in real time and returns its index.
+        The context is the last max_order learned states, read from the symbol columns, so each call is O(order).
+        The latency of each call is recorded in learn_latency."""
+        start_time = time.perf_counter()
+        continuation_idx = self._append_state(state)
+        if self.learning_start is None:
+            self.learning_start = continuation_idx
+        # Contexts do not reach evicted states
+        context_start = max(self.learning_start, continuation_idx - max_order, self.first_idx)
+        self.context_lengths.append(continuation_idx - context_start)
+        self.max_context_length = max(self.max_context_length, continuation_idx - context_start)
+        position, context_position = continuation_idx - self.storage_start, context_start - self.storage_start
+        for viewpoint, vomm in self._vomm_items():
+            context_symbols = self.symbol_columns[viewpoint][context_position:position]
+            vomm.insert(continuation_idx, context_symbols)
+        if self.bounded:
+            self._evict()
+        self.learn_latency.record(time.perf_counter() - start_time)
+        return continuation_idx
+
+    def end_learned_sequence(self):
+        """Ends the learned sequence: the next learned state starts a new sequence without context."""
+        self.learning_start = None
+
+    def merge(self, other: MVVOMM):
+        """Appends the states of another MVVOMM with the same viewpoints and merges its VOMMs.
+        Symbols of the other model are remapped into this model alphabets and its continuation indexes are shifted
+        after this model states, so merging models built on consecutive sequences gives the same model as inserting
+        the sequences one after the other."""
+        if other.viewpoints != self.viewpoints or other.joint_viewpoints != self.joint_viewpoints:
+            raise ValueError('Cannot merge MVVOMM with viewpoints {} into {}'.format(other.viewpoints, self.viewpoints))
+        if other.storage_start != 0:
+            raise ValueError('Cannot merge a MVVOMM with evicted states')
+        if self.bounded and _EXPLICIT_CONTEXT in other.context_lengths:
+            raise ValueError('Cannot evict states merged from a MVVOMM built with insert')
+        self.learning_start = None
+        start = len(self.state_sequence)
+        offset = self.end_idx
+        symbol_maps = dict()
+        for viewpoint, other_alphabet in other.alphabets.items():
+            alphabet = self.alphabets.setdefault(viewpoint, Alphabet())
+            symbol_maps[viewpoint] = [alphabet.encode(value) for value in other_alphabet.values]
+        for other_mapped_state in other.state_sequence:
+            mapped_state = {'id': other_mapped_state['id'] + offset}
+            for viewpoint in (viewpoint for viewpoint in other_mapped_state if viewpoint != 'id'):
+                mapped_state[viewpoint] = symbol_maps[viewpoint][other_mapped_state[viewpoint]]
+            self.state_sequence.append(mapped_state)
+            for viewpoint in self.viewpoints:
+                self.symbol_columns[viewpoint].append(mapped_state[viewpoint])
+        for viewpoint in self.viewpoints:
+            self.vomms[viewpoint].merge(other.vomms[viewpoint], symbol_maps.get(viewpoint, []), offset)
+        for joint_viewpoint in self.joint_viewpoints:
+            # Joint symbols are tuples of viewpoint symbols, remapped component by component
+            alphabet = self.joint_alphabets[joint_viewpoint]
+            joint_symbol_map = [alphabet.encode(tuple(symbol_maps[viewpoint][symbol]
+                                                      for viewpoint, symbol in zip(joint_viewpoint, joint_symbols)))
+                                for joint_symbols in other.joint_alphabets[joint_viewpoint].values]
+            self.symbol_columns[joint_viewpoint].extend(
+                joint_symbol_map[symbol] for symbol in other.symbol_columns[joint_viewpoint])
+            self.joint_vomms[joint_viewpoint].merge(other.joint_vomms[joint_viewpoint], joint_symbol_map, offset)
+        self.context_lengths.extend(other.context_lengths)
+        self.max_context_length = max(self.max_context_length, other.max_context_length)
+        if self.reclaim_symbols:
+            self._count_symbols(start)
+        if self.bounded:
+            self._evict()
+
+    def next(self, context_states: List[Dict[str, Any]],
+             selector: Callable[[Dict[str: Set[Any]]], int | None], rng=None) -> Dict[str, Any]:
+        """Returns a state given a context sequence and a selector.
+        With a numpy.random.Generator as rng, random contexts and fallbacks draw from it, and so do selectors taking an
+        rng (see vectorized_selectors): generation with them is reproducible without seeding the random module. Other
+        selectors still draw from the random module."""
+        instrumentation = self.instrumentation
+        if instrumentation is not None:
+            start_time = time.perf_counter()
+        # Encode the context once, without adding unseen values to the alphabets
+        mapped_context_states = [self._state_to_mapped_state(state, read_only=True) for state in context_states]
+        context_symbols = {viewpoint: [mapped_state.get(viewpoint) for mapped_state in mapped_context_states]
+                           for viewpoint in self.viewpoints}
+        for joint_viewpoint in self.joint_viewpoints:
+            context_symbols[joint_viewpoint] = self._joint_context_symbols(joint_viewpoint, context_symbols,
+                                                                           read_only=True)
+        if instrumentation is not None:
+            encode_time = time.perf_counter()
+        selected_continuation_idx = self._select_idx(context_symbols, _bind_rng(selector, rng), rng)
+        if instrumentation is None:
+            return self._mapped_state_to_state(self._mapped_state(selected_continuation_idx))
+        select_time = time.perf_counter()
+        state = self._mapped_state_to_state(self._mapped_state(selected_continuation_idx))
+        instrumentation.observe('next.encode_seconds', encode_time - start_time)
+        instrumentation.observe('next.decode_seconds', time.perf_counter() - select_time)
+        instrumentation.count('next.calls')
+        return state
         # Should the algorithm use the depth traversed in order to bias for longer depth ?
 
-    def random_states(self, n=8):
+    def _random_idx(self, rng=None) -> int:
+        """Returns a random state index, drawn from rng when given, from the random module otherwise."""
+        if rng is None:
+            return random.randrange(self.first_idx, self.end_idx)
+        return int(rng.integers(self.first_idx, self.end_idx))
+
+    def _random_idxs(self, n, rng=None) -> List[int]:
+        """Returns n distinct random state indexes, drawn from rng when given, from the random module otherwise."""
+        if rng is None:
+            return random.sample(range(self.first_idx, self.end_idx), n)
+        return (rng.choice(self.end_idx - self.first_idx, n, replace=False) + self.first_idx).tolist()
+
+    def random_states(self, n=8, rng=None):
         """Returns a random sample of n states taken from the internal sequence."""
-        return [self._mapped_state_to_state(mapped_state) for mapped_state in random.sample(self.state_sequence, n)]
+        return [self._mapped_state_to_state(self._mapped_state(idx)) for idx in self._random_idxs(n, rng)]
+
+    def _iter_generate_idxs(self, n, selector, order, plagiarism_tracker=None, rng=None):
+        selector = _bind_rng(selector, rng)
+        # Only the context indexes are kept, so that index generation takes constant memory
+        context_idxs = deque(self._random_idxs(order, rng), maxlen=order)
+        if plagiarism_tracker is not None:
+            for idx in context_idxs:
+                plagiarism_tracker.update(idx)
+        yield from context_idxs
+        for _ in range(order, n):
+            selected_continuation_idx = self._select_idx(self._context_symbols(context_idxs), selector, rng)
+            if plagiarism_tracker is not None:
+                if plagiarism_tracker.would_exceed(selected_continuation_idx):
+                    if plagiarism_tracker.on_exceed == 'stop':
+                        return
+                    selected_continuation_idx = self._resteer_idx(selected_continuation_idx, rng)
+                    plagiarism_tracker.n_resteers += 1
+                plagiarism_tracker.update(selected_continuation_idx)
+            context_idxs.append(selected_continuation_idx)
+            yield selected_continuation_idx
+
+    def _resteer_idx(self, copied_idx: int, rng=None) -> int:
+        """Returns a random state index other than copied_idx, which ends the current plagiarism run."""
+        if self.end_idx - self.first_idx < 2:
+            return copied_idx
+        if rng is None:
+            idx = random.randrange(self.first_idx, self.end_idx - 1)
+        else:
+            idx = int(rng.integers(self.first_idx, self.end_idx - 1))
+        return idx + 1 if idx >= copied_idx else idx
 
-    def generate_n(self, n, selector, order=8):
-        new_sequence = self.random_states(order)
+    def generate_idxs(self, n, selector, order=8, plagiarism_tracker=None, rng=None) -> array:
+        """Generates the indexes of n states as generate_n does, without decoding any state.
+        Values of the generated states are then read column by column with get_values."""
+        return array('I', self._iter_generate_idxs(n, selector, order, plagiarism_tracker, rng))
+
+    def get_values(self, idxs: Sequence[int], key: str) -> List[Any]:
+        """Returns the value of a key for each state index, None where a state has no such key.
+        Values are returned by reference from the alphabet of the key: they are shared with the model and must not be
+        modified."""
+        positions = [idx - self.storage_start for idx in idxs]
+        if key in self.viewpoints:
+            symbol_column = self.symbol_columns[key]
+            symbols = [symbol_column[position] for position in positions]
+        elif hasattr(self.state_sequence, 'get_symbols'):
+            symbols = self.state_sequence.get_symbols(positions, key)
+        else:
+            symbols = [self.state_sequence[position].get(key) for position in positions]
+        values = self.alphabets[key].values
+        return [None if symbol is None else values[symbol] for symbol in symbols]
+
+    def generate_n(self, n, selector, order=8, plagiarism_tracker=None, rng=None):
+        """Generates a sequence of n states starting from order random states.
+        Generation works on state indexes and reads contexts from the symbol columns, states are decoded at the end.
+        A PlagiarismTracker tracks the generated states and can stop or re-steer the generation past its thresholds.
+        rng is used as in next."""
+        new_idxs = list(self._iter_generate_idxs(n, selector, order, plagiarism_tracker, rng))
+        return [self._mapped_state_to_state(self._mapped_state(idx)) for idx in new_idxs]
+
+    def iter_generate(self, n, selector, order=8, plagiarism_tracker=None, rng=None):
+        """A generator yielding the states of generate_n as they are generated, to stream them (see MidiFileWriter)."""
+        for idx in self._iter_generate_idxs(n, selector, order, plagiarism_tracker, rng):
+            yield self._mapped_state_to_state(self._mapped_state(idx))
+
+    def generate_batch(self, k, n, selector, order=8, rng=None):
+        """Generates k sequences of n states, each starting from order random states.
+        The sequences advance in lockstep on state indexes. VOMM lookups are memoized on the context indexes. States
+        are only decoded at the end, once per distinct index.
+        When instrumented, selections are recorded as in next, and lookups answered by the memo are counted in
+        select.memoized_lookups. rng is used as in next."""
+        instrumentation = self.instrumentation
+        selector = _bind_rng(selector, rng)
+        batch_idxs = [self._random_idxs(order, rng) for _ in range(k)]
+        lookups_by_context_idxs = dict()
+        depth_chains = _uses_depth_chains(selector)
+        lookup = self._selector_lookup(selector)
         for i in range(order, n):
-            new_state = self.next(new_sequence[i - order:i], selector)
-            new_sequence.append(new_state)
-        return new_sequence
+            for new_idxs in batch_idxs:
+                if instrumentation is not None:
+                    start_time = time.perf_counter()
+                context_idxs = tuple(new_idxs[i - order:i])
+                if depth_chains:
+                    # Iterators are consumed by the selector, so they are not memoized
+                    continuation_idxs_by_viewpoints = lookup(self._context_symbols(context_idxs))
+                else:
+                    continuation_idxs_by_viewpoints = lookups_by_context_idxs.get(context_idxs)
+                    if continuation_idxs_by_viewpoints is None:
+                        continuation_idxs_by_viewpoints = lookup(self._context_symbols(context_idxs))
+                        lookups_by_context_idxs[context_idxs] = continuation_idxs_by_viewpoints
+                    elif instrumentation is not None:
+                        instrumentation.count('select.memoized_lookups')
+                if instrumentation is None:
+                    selected_continuation_idx = selector(continuation_idxs_by_viewpoints)
+                else:
+                    lookup_time = time.perf_counter()
+                    selected_continuation_idx = selector(continuation_idxs_by_viewpoints)
+                    self._record_selection(continuation_idxs_by_viewpoints, depth_chains, selected_continuation_idx,
+                                           lookup_time - start_time, time.perf_counter() - lookup_time)
+                if selected_continuation_idx is None:
+                    selected_continuation_idx = self._random_idx(rng)
+                new_idxs.append(selected_continuation_idx)
+        states = {idx: self._mapped_state_to_state(self._mapped_state(idx))
+                  for idx in set().union(*batch_idxs)}
+        return [[dict(states[idx]) for idx in new_idxs] for new_idxs in batch_idxs]
+
+
+class _InstrumentedVOMM:
+    """Stands for the VOMM of a model in its lookups, recording their seconds, matched depth and continuations."""
+
+    def __init__(self, vomms: Dict[Any, VOMM | SuffixVOMM], key, instrumentation: Instrumentation):
+        self.vomms = vomms  # Read on each lookup, the VOMM may be replaced (see load_model)
+        self.key = key
+        self.instrumentation = instrumentation
+        name = _metric_name(key)
+        self.seconds_name = 'vomm.lookup_seconds.' + name
+        self.depth_name = 'vomm.matched_depth.' + name
+        self.continuations_name = 'vomm.continuations.' + name
+
+    def get_continuation_idxs(self, context_values: List[Any]):
+        vomm = self.vomms[self.key]
+        start_time = time.perf_counter()
+        continuation_idxs = vomm.get_continuation_idxs(context_values)
+        self.instrumentation.observe(self.seconds_name, time.perf_counter() - start_time)
+        self.instrumentation.observe(self.depth_name, vomm.matched_depth(context_values))
+        self.instrumentation.observe(self.continuations_name,
+                                     len(continuation_idxs) if continuation_idxs is not None else 0)
+        return continuation_idxs
+
+    def iter_continuation_idxs_by_depth(self, context_values: List[Any]) -> Iterator[Any]:
+        """Records each depth as a lookup, as the selector consumes them."""
+        vomm = self.vomms[self.key]
+        self.instrumentation.observe(self.depth_name, vomm.matched_depth(context_values))
+        start_time = time.perf_counter()
+        for continuation_idxs in vomm.iter_continuation_idxs_by_depth(context_values):
+            self.instrumentation.observe(self.seconds_name, time.perf_counter() - start_time)
+            self.instrumentation.observe(self.continuations_name, len(continuation_idxs))
+            yield continuation_idxs
+            start_time = time.perf_counter()
+
+
+def _metric_name(key) -> str:
+    """The name of a viewpoint, or of a joint viewpoint as its viewpoints joined by '+', in metric names."""
+    return '+'.join(key) if isinstance(key, tuple) else str(key)
+
+
+def _uses_depth_chains(selector: Callable) -> bool:
+    """Returns whether a selector, or the function of a partial, takes continuation indexes by decreasing depth."""
+    return getattr(getattr(selector, 'func', selector), 'depth_chains', False)
+
+
+def _bind_rng(selector: Callable, rng) -> Callable:
+    """Returns the selector drawing from rng, when rng is given and the selector takes an rng not already bound."""
+    if rng is None or 'rng' in getattr(selector, 'keywords', ()):
+        return selector
+    if 'rng' not in inspect.signature(getattr(selector, 'func', selector)).parameters:
+        return selector
+    return partial(selector, rng=rng)
+
 
+def _uses_intersection(selector: Callable) -> bool:
+    """Returns whether a selector, or the function of a partial, only selects in the intersection of the viewpoints,
+    which the continuation indexes of joint viewpoints can stand for."""
+    return getattr(getattr(selector, 'func', selector), 'intersection', False)
@@ -0,0 +1,245 @@
+from __future__ import annotations
+from typing import Any, Dict, Iterator, List
+from array import array
+import heapq
+from melodendron.model.index_set import IndexSet
+
+
+_STATE_IDXS_CACHE_SIZE = 1024
+
+
+class SuffixVOMM:
+    """A Variable Order Markov Model built on a generalized suffix automaton.
+    Each inserted continuation index appends the last context value to the symbol stream, so memory is linear in the
+    number of insertions and there is no maximum order: the longest context suffix seen in the stream is matched.
+
+    It shares the VOMM insert / get_continuation_idxs contract, with one constraint: within a sequence, continuation
+    indexes must be inserted in order, each context ending with the values inserted before it in the sequence, e.g.
+    its last max_order values. An empty context starts a new sequence. Only the last context value extends the
+    automaton, so insert raises ValueError for a context which does not continue the sequence, including a context of
+    several values right after a sequence start.
+    """
+
+    def __init__(self):
+        self.lengths = [0]               # Length of the longest string of each automaton state
+        self.links = [-1]                # Suffix link of each automaton state
+        self.transitions = [dict()]      # Outgoing transitions of each automaton state
+        self.link_children = [set()]     # Reverse suffix links, to enumerate end positions
+        self.continuation_idxs = dict()  # Continuation indexes ending at each automaton state
+        self.last = 0
+        self.last_continuation_idx = None
+        self.sequence_length = 0           # Number of values inserted since the last sequence start
+        self.sequence_starts = array('I')  # Continuation indexes inserted with an empty context
+        self.inserted_idxs = array('I')    # Continuation indexes that extended the automaton
+        self.inserted_values = list()      # and the value they extended it with, kept to replay merges
+        self.state_idxs_cache = dict()     # Gathered continuation indexes of recently queried states
+
+    def __repr__(self):
+        return 'SuffixVOMM()'
+
+    def __str__(self):
+        return 'SuffixVOMM(states={}, continuations={})'.format(len(self.lengths), self.last_continuation_idx)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['state_idxs_cache']
+        return state
+
+    def __setstate__(self, state):
+        state.setdefault('sequence_length', 0)
+        self.__dict__.update(state)
+        self.state_idxs_cache = dict()
+
+    def _new_state(self, length: int, transitions: Dict[Any, int]) -> int:
+        self.lengths.append(length)
+        self.links.append(-1)
+        self.transitions.append(transitions)
+        self.link_children.append(set())
+        return len(self.lengths) - 1
+
+    def _set_link(self, state: int, link: int):
+        if self.links[state] != -1:
+            self.link_children[self.links[state]].discard(state)
+        self.links[state] = link
+        self.link_children[link].add(state)
+
+    def _clone(self, p: int, q: int, value: Any) -> int:
+        """Splits state q so that the strings of length lengths[p] + 1 get their own state."""
+        clone = self._new_state(self.lengths[p] + 1, dict(self.transitions[q]))
+        self._set_link(clone, self.links[q])
+        while p != -1 and self.transitions[p].get(value) == q:
+            self.transitions[p][value] = clone
+            p = self.links[p]
+        self._set_link(q, clone)
+        return clone
+
+    def _extend(self, value: Any, continuation_idx: int):
+        self.state_idxs_cache.clear()
+        last = self.last
+        q = self.transitions[last].get(value)
+        if q is not None:
+            # The value already follows this sequence prefix (generalized automaton case)
+            if self.lengths[last] + 1 != self.lengths[q]:
+                q = self._clone(last, q, value)
+            self.continuation_idxs.setdefault(q, []).append(continuation_idx)
+            self.last = q
+            return
+        current = self._new_state(self.lengths[last] + 1, dict())
+        self.continuation_idxs[current] = [continuation_idx]
+        p = last
+        while p != -1 and value not in self.transitions[p]:
+            self.transitions[p][value] = current
+            p = self.links[p]
+        if p == -1:
+            self._set_link(current, 0)
+        else:
+            q = self.transitions[p][value]
+            if self.lengths[p] + 1 == self.lengths[q]:
+                self._set_link(current, q)
+            else:
+                self._set_link(current, self._clone(p, q, value))
+        self.last = current
+
+    def insert(self, continuation_idx: int, context_values: List[Any]):
+        """Inserts a new value idx in the automaton.
+        Raises ValueError when the context does not continue the current sequence."""
+        if len(context_values) == 0:
+            self.last = 0
+            self.sequence_length = 0
+            self.sequence_starts.append(continuation_idx)
+        elif self.last != 0 and continuation_idx != self.last_continuation_idx + 1:
+            raise ValueError('SuffixVOMM requires continuation indexes to be inserted in order within a sequence')
+        elif not self._continues_sequence(context_values):
+            raise ValueError('SuffixVOMM requires the context of {} to end with the values inserted in its sequence, '
+                             'got {}'.format(continuation_idx, list(context_values)))
+        else:
+            self._extend(context_values[-1], continuation_idx)
+            self.inserted_idxs.append(continuation_idx)
+            self.inserted_values.append(context_values[-1])
+            self.sequence_length += 1
+        self.last_continuation_idx = continuation_idx
+
+    def _continues_sequence(self, context_values: List[Any]) -> bool:
+        """Returns whether the context, but its last value, are the last values inserted in the current sequence."""
+        n_values = len(context_values) - 1
+        if n_values > self.sequence_length:
+            return False
+        return n_values == 0 or self.inserted_values[-n_values:] == list(context_values[:-1])
+
+    def merge(self, other: SuffixVOMM, symbol_map: List[int], offset: int):
+        """Merges another SuffixVOMM into this one by replaying its insertions.
+        Values of the other SuffixVOMM are remapped with symbol_map and its continuation indexes are shifted by
+        offset."""
+        sequence_starts = ((continuation_idx, None) for continuation_idx in other.sequence_starts)
+        insertions = zip(other.inserted_idxs, other.inserted_values)
+        self.last = 0
+        self.sequence_length = 0
+        for continuation_idx, value in heapq.merge(sequence_starts, insertions, key=lambda insertion: insertion[0]):
+            context_values = [] if value is None else [symbol_map[value]]
+            self.insert(continuation_idx + offset, context_values)
+
+    def _match(self, context_values: List[Any]) -> int:
+        """Returns the state of the longest context suffix present in the automaton, 0 if there is none."""
+        state = 0
+        for context_value in context_values:
+            while state != 0 and context_value not in self.transitions[state]:
+                state = self.links[state]
+            state = self.transitions[state].get(context_value, 0)
+        return state
+
+    def _state_continuation_idxs(self, state: int) -> IndexSet:
+        """Returns the continuation indexes of a state, cached until the next insertion."""
+        state_idxs = self.state_idxs_cache.get(state)
+        if state_idxs is not None:
+            return state_idxs
+        # All strings of a state share the same end positions: those of the states below it in the suffix link tree
+        continuation_idxs = list()
+        stack = [state]
+        while stack:
+            linked_state = stack.pop()
+            continuation_idxs.extend(self.continuation_idxs.get(linked_state, ()))
+            stack.extend(self.link_children[linked_state])
+        if len(self.state_idxs_cache) >= _STATE_IDXS_CACHE_SIZE:
+            self.state_idxs_cache.clear()
+        state_idxs = self.state_idxs_cache[state] = IndexSet(continuation_idxs)
+        return state_idxs
+
+    def get_continuation_idxs(self, context_values: List[Any]) -> IndexSet | None:
+        """Returns the continuation indexes of the longest context suffix present in the automaton."""
+        state = self._match(context_values)
+        if state == 0:
+            return None
+        return self._state_continuation_idxs(state)
+
+    def matched_depth(self, context_values: List[Any]) -> int:
+        """Returns the length of the longest context suffix present in the automaton, 0 if there is none."""
+        state = 0
+        depth = 0
+        for context_value in context_values:
+            while state != 0 and context_value not in self.transitions[state]:
+                state = self.links[state]
+                depth = self.lengths[state]
+            state = self.transitions[state].get(context_value, 0)
+            depth = depth + 1 if state != 0 else 0
+        return depth
+
+    def iter_continuation_idxs_by_depth(self, context_values: List[Any]) -> Iterator[IndexSet]:
+        """Yields the continuation indexes of matched context suffixes, from the longest to the shortest.
+        Shorter suffixes are those of the states up the suffix links, each gathered only when requested."""
+        state = self._match(context_values)
+        while state != 0:
+            yield self._state_continuation_idxs(state)
+            state = self.links[state]
+
+
+if __name__ == '__main__':
+    # Check that the automaton returns the same continuations as the trie for contexts up to the trie order
+    import random
+    from melodendron.model.VOMM import VOMM
+    random.seed(0)
+    max_order = 6
+    trie, automaton = VOMM(), SuffixVOMM()
+    sequences = [[random.randrange(4) for _ in range(random.randrange(1, 300))] for _ in range(20)]
+    start = 0
+    for sequence in sequences:
+        for i in range(len(sequence)):
+            trie.insert(start + i, sequence[max(0, i - max_order):i])
+            automaton.insert(start + i, sequence[:i])
+        start += len(sequence)
+    for _ in range(2000):
+        context = [random.randrange(5) for _ in range(random.randrange(max_order + 1))]
+        assert trie.get_continuation_idxs(context) == automaton.get_continuation_idxs(context), context
+        assert trie.matched_depth(context) == automaton.matched_depth(context), context
+    print('SuffixVOMM matches VOMM on 2000 random contexts')
+
+    # Same check through MVVOMM.insert with explicit contexts, each the last max_order states of its sequence
+    from melodendron.model.MVVOMM import MVVOMM
+    trie_model = MVVOMM(['value', 'parity'], vomm_class=VOMM)
+    automaton_model = MVVOMM(['value', 'parity'], vomm_class=SuffixVOMM)
+    for sequence in sequences:
+        states = [{'value': value, 'parity': value % 2} for value in sequence]
+        for i in range(len(states)):
+            for model in (trie_model, automaton_model):
+                model.insert(states[i], states[max(0, i - max_order):i])
+    for _ in range(2000):
+        context = [random.randrange(5) for _ in range(random.randrange(max_order + 1))]
+        for viewpoint in ('value', 'parity'):
+            trie, automaton = trie_model.vomms[viewpoint], automaton_model.vomms[viewpoint]
+            assert trie.get_continuation_idxs(context) == automaton.get_continuation_idxs(context), context
+            assert trie.matched_depth(context) == automaton.matched_depth(context), context
+    # A context which does not continue the sequence is refused
+    for context in ([4, 0], [automaton.inserted_values[-1], 4, 0]):
+        try:
+            automaton.insert(automaton.last_continuation_idx + 1, context)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError(context)
+    automaton.insert(automaton.last_continuation_idx + 1, [])
+    try:
+        automaton.insert(automaton.last_continuation_idx + 1, [0, 1])
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('context of several values after a sequence start')
+    print('SuffixVOMM matches VOMM through MVVOMM.insert with explicit contexts')
@@ -1,38 +1,52 @@
 from __future__ import annotations
-from typing import Any, List, Set
+from typing import Any, Iterator, List
+from array import array
+import sys
+from melodendron.model.index_set import IndexSet
 
 
 class VOMMNode:
-    """A node for a variable order markov model."""
+    """A node for a variable order markov model.
+    Children are indexed by their value for constant time lookup."""
+
+    __slots__ = ('value', 'continuation_idxs', 'children')
 
     def __init__(self, value: Any, continuation_idx: int):
         self.value = value
-        self.continuation_idxs = {continuation_idx}
-        self.children = set()
+        self.continuation_idxs = IndexSet((continuation_idx,))
+        self.children = dict()
 
     def __repr__(self):
         return 'VOMMNode({})'.format(self.value)
 
     def __str__(self):
-        format_children = ', '.join(str(child) for child in self.children)
+        format_children = ', '.join(str(child) for child in self.children.values())
         if len(format_children) == 0:
             format_children = 'None'
         format_str = 'VOMMNode(value={}, continuation_idxs={}, children={})'
         return format_str.format(self.value, self.continuation_idxs, format_children)
 
     def __getitem__(self, key):
-        for child in self.children:
-            if child.value == key:
-                return child
-        return None
+        return self.children.get(key)
 
     def add_child(self, child: VOMMNode):
-        self.children.add(child)
+        self.children[child.value] = child
 
     def add_continuation_idx(self, continuation_idx: int):
         self.continuation_idxs.add(continuation_idx)
 
 
+# Approximate size in bytes of a node without continuation indexes, and of each continuation index
+_NODE_SIZE = (sys.getsizeof(VOMMNode(0, 0)) + sys.getsizeof(IndexSet()) + sys.getsizeof(array('I'))
+              + sys.getsizeof(dict()) + 16)
+_IDX_SIZE = array('I').itemsize
+
+
+def _trie_size(n_nodes: int, n_idxs: int) -> int:
+    """The estimated size in bytes of a VOMM trie, the accounting basis of estimated_size for every engine."""
+    return n_nodes * _NODE_SIZE + n_idxs * _IDX_SIZE
+
+
 class VOMM:
     """A Variable Order Markov Model.
     Designed for fast retrieval by building a trie upside down
@@ -40,52 +54,189 @@ class VOMM:
     """
 
     def __init__(self):
-        self.roots = set()
+        self.roots = dict()
+        self.counts = [0, 0]  # Numbers of nodes and of continuation indexes, None until recounted after a merge or load
 
     def __repr__(self):
         return 'VOMM()'
 
     def __str__(self):
-        format_roots = ', '.join(str(root) for root in self.roots)
+        format_roots = ', '.join(str(root) for root in self.roots.values())
         return 'VOMM({})'.format(format_roots)
 
+    def __getstate__(self):
+        """Flattens the trie in depth first order into arrays, which pickle much faster than nested nodes."""
+        values, child_counts, idx_counts, idxs = list(), array('I'), array('I'), array('I')
+        stack = list(reversed(self.roots.values()))
+        while stack:
+            node = stack.pop()
+            values.append(node.value)
+            child_counts.append(len(node.children))
+            idx_counts.append(len(node.continuation_idxs))
+            idxs.extend(node.continuation_idxs.idxs)
+            stack.extend(reversed(node.children.values()))
+        return dict(root_count=len(self.roots), values=values, child_counts=child_counts, idx_counts=idx_counts,
+                    idxs=idxs)
+
+    def __setstate__(self, state):
+        self.roots = dict()
+        self.counts = None
+        idxs = state['idxs']
+        idx_start = 0
+        stack = [[self.roots, state['root_count']]]  # Children to fill and number of children left to fill
+        for value, child_count, idx_count in zip(state['values'], state['child_counts'], state['idx_counts']):
+            while stack[-1][1] == 0:
+                stack.pop()
+            node = VOMMNode.__new__(VOMMNode)
+            node.value = value
+            node.continuation_idxs = IndexSet.from_sorted(idxs[idx_start:idx_start + idx_count])
+            node.children = dict()
+            idx_start += idx_count
+            stack[-1][0][value] = node
+            stack[-1][1] -= 1
+            if child_count:
+                stack.append([node.children, child_count])
+
     def insert(self, continuation_idx: int, context_values: List[Any]):
         """Inserts a new value idx in the trie."""
 
         if len(context_values) == 0:
             return
-        context_values.reverse()
+        context_values = context_values[::-1]
         last_context_value = context_values[0]
-        if last_context_value not in (root.value for root in self.roots):
+        new_nodes = 0
+        current_node = self.roots.get(last_context_value)
+        if current_node is None:
             current_node = VOMMNode(last_context_value, continuation_idx)
-            self.roots.add(current_node)
+            self.roots[last_context_value] = current_node
+            new_nodes += 1
         else:
-            current_node = next((root for root in self.roots if root.value == last_context_value))
             current_node.add_continuation_idx(continuation_idx)
         for context_value in context_values[1:]:
-            next_node = current_node[context_value]
+            next_node = current_node.children.get(context_value)
             if next_node is None:
                 next_node = VOMMNode(context_value, continuation_idx)
                 current_node.add_child(next_node)
+                new_nodes += 1
             else:
                 next_node.add_continuation_idx(continuation_idx)
             current_node = next_node
+        counts = self.counts
+        if counts is not None:
+            counts[0] += new_nodes
+            counts[1] += len(context_values)
+
+    def remove(self, continuation_idx: int, context_values: List[Any]):
+        """Removes a continuation index inserted with context_values.
+        Nodes left without continuation indexes are pruned. The continuation indexes of a node include those of its
+        descendants, so pruning a node prunes the rest of the context path and nothing else."""
+        children = self.roots
+        removed_idxs = 0
+        pruned_nodes = 0
+        for depth, context_value in enumerate(reversed(context_values)):
+            node = children.get(context_value)
+            if node is None:
+                break
+            continuation_idxs = node.continuation_idxs
+            if len(continuation_idxs) == 1 and continuation_idxs.idxs[0] == continuation_idx:
+                del children[context_value]
+                # The nodes below on the context path only hold this continuation index too
+                while node is not None:
+                    pruned_nodes += 1
+                    depth += 1
+                    node = node.children.get(context_values[-depth - 1]) if depth < len(context_values) else None
+                removed_idxs += pruned_nodes
+                break
+            size = len(continuation_idxs)
+            continuation_idxs.discard(continuation_idx)
+            removed_idxs += size - len(continuation_idxs)
+            children = node.children
+        counts = self.counts
+        if counts is not None:
+            counts[0] -= pruned_nodes
+            counts[1] -= removed_idxs
+
+    def estimated_size(self) -> int:
+        """Returns an estimate of the memory taken by the trie in bytes.
+        Nodes and continuation indexes are counted on the first call, then kept up to date."""
+        if self.counts is None:
+            counts = [0, 0]
+            stack = list(self.roots.values())
+            while stack:
+                node = stack.pop()
+                counts[0] += 1
+                counts[1] += len(node.continuation_idxs)
+                stack.extend(node.children.values())
+            self.counts = counts
+        return _trie_size(*self.counts)
+
+    def merge(self, other: VOMM, symbol_map: List[int], offset: int):
+        """Merges another VOMM into this one.
+        Node values of the other VOMM are remapped with symbol_map and its continuation indexes are shifted by
+        offset. Other VOMM implementations are converted with their to_vomm method."""
+        if not isinstance(other, VOMM):
+            other = other.to_vomm()
+        self.counts = None
+        stack = [(self.roots, other_node) for other_node in other.roots.values()]
+        while stack:
+            children, other_node = stack.pop()
+            value = symbol_map[other_node.value]
+            shifted_idxs = IndexSet.from_sorted(array('I', [idx + offset for idx in other_node.continuation_idxs.idxs]))
+            node = children.get(value)
+            if node is None:
+                node = children[value] = VOMMNode.__new__(VOMMNode)
+                node.value = value
+                node.continuation_idxs = shifted_idxs
+                node.children = dict()
+            else:
+                node.continuation_idxs.update(shifted_idxs)
+            stack.extend((node.children, other_child) for other_child in other_node.children.values())
 
-    def get_continuation_idxs(self, context_values: List[Any]) -> Set[int] | None:
+    def get_continuation_idxs(self, context_values: List[Any]) -> IndexSet | None:
         if not context_values:
             return None
-        last_context_value = context_values[-1]
-        if last_context_value not in (root.value for root in self.roots):
+        current_node = self.roots.get(context_values[-1])
+        if current_node is None:
             return None
-        current_node = next((root for root in self.roots if root.value == last_context_value))
         context_sequence = context_values[-2::-1]
         for context_value in context_sequence:
-            next_node = current_node[context_value]
+            next_node = current_node.children.get(context_value)
             if next_node is None:
                 return current_node.continuation_idxs
             current_node = next_node
         return current_node.continuation_idxs
 
+    def matched_depth(self, context_values: List[Any]) -> int:
+        """Returns the length of the context suffix matched by get_continuation_idxs, 0 if there is none."""
+        if not context_values:
+            return 0
+        current_node = self.roots.get(context_values[-1])
+        if current_node is None:
+            return 0
+        depth = 1
+        for context_value in context_values[-2::-1]:
+            current_node = current_node.children.get(context_value)
+            if current_node is None:
+                break
+            depth += 1
+        return depth
+
+    def iter_continuation_idxs_by_depth(self, context_values: List[Any]) -> Iterator[IndexSet]:
+        """Yields the continuation indexes of each matched context suffix, from the longest to the shortest."""
+        if not context_values:
+            return
+        current_node = self.roots.get(context_values[-1])
+        if current_node is None:
+            return
+        nodes = [current_node]
+        for context_value in context_values[-2::-1]:
+            current_node = current_node.children.get(context_value)
+            if current_node is None:
+                break
+            nodes.append(current_node)
+        for node in reversed(nodes):
+            yield node.continuation_idxs
+
 
 if __name__ == '__main__':
     sequence1 = ['A', 'B', 'C', 'D']
@@ -1,4 +1,11 @@
+from .alphabet import *
+from .index_set import *
+from .FlatVOMM import FlatVOMM
 from .MVVOMM import MVVOMM
 from .selectors import *
+from .vectorized_selectors import *
+from .serialization import *
+from .stats import *
+from .SuffixVOMM import SuffixVOMM
 from .VOMM import VOMM
 from .utils import *
@@ -0,0 +1,122 @@
+from __future__ import annotations
+from typing import Any, Dict, Hashable, Iterable, List
+import pickle
+
+
+_LIST = object()  # Tags the canonical forms of lists
+_DICT = object()  # Tags the canonical forms of dicts
+
+
+def canonical_key(value: Any) -> Hashable:
+    """Returns a hashable canonical form of a value.
+    Sets become frozensets, tuples become tuples, lists become tagged tuples and dicts tagged frozensets of their
+    items. Two values have equal canonical forms if and only if they are equal, so a list and a tuple, or a dict and
+    a set of pairs, are different symbols and decode back to their own type."""
+    if isinstance(value, (set, frozenset)):
+        return frozenset(canonical_key(item) for item in value)
+    if isinstance(value, tuple):
+        return tuple(canonical_key(item) for item in value)
+    if isinstance(value, list):
+        return _LIST, tuple(canonical_key(item) for item in value)
+    if isinstance(value, dict):
+        return _DICT, frozenset((key, canonical_key(item)) for key, item in value.items())
+    return value
+
+
+class _Released:
+    """The value of a released symbol, equal to no other value."""
+
+    def __repr__(self):
+        return 'RELEASED'
+
+    def __reduce__(self):
+        return 'RELEASED'
+
+
+RELEASED = _Released()
+
+
+class Alphabet:
+    """An interned alphabet mapping values to integer symbols.
+    Encoding goes through a dict keyed by canonical values and decoding indexes a list, so both are O(1).
+    Unhashable values (sets, lists, dicts) are supported through their canonical form.
+    The encoding dict is only built when first needed, so alphabets loaded for decoding stay cheap.
+    Symbols no longer used can be released, their value is then RELEASED until the symbol is reused."""
+
+    def __init__(self, values: Iterable[Any] = ()):
+        self._values: List[Any] | None = list(values)   # symbol -> first inserted value
+        self._symbols: Dict[Hashable, int] | None = None  # canonical value -> symbol
+        self._free_symbols: List[int] | None = None       # released symbols, built with _symbols
+        self._pickled_values: bytes | None = None
+
+    @classmethod
+    def from_pickled_values(cls, pickled_values: bytes) -> Alphabet:
+        """Returns an alphabet whose values are only unpickled when first accessed."""
+        alphabet = cls()
+        alphabet._values = None
+        alphabet._symbols = None
+        alphabet._free_symbols = None
+        alphabet._pickled_values = pickled_values
+        return alphabet
+
+    @property
+    def values(self) -> List[Any]:
+        if self._values is None:
+            self._values = pickle.loads(self._pickled_values)
+            self._pickled_values = None
+        return self._values
+
+    @property
+    def symbols(self) -> Dict[Hashable, int]:
+        if self._symbols is None:
+            self._symbols = {canonical_key(value): symbol for symbol, value in enumerate(self.values)
+                             if value is not RELEASED}
+            self._free_symbols = [symbol for symbol, value in enumerate(self.values) if value is RELEASED]
+        return self._symbols
+
+    def __getstate__(self):
+        return {'values': self.values}
+
+    def __setstate__(self, state):
+        self._values = state['values']
+        self._symbols = None
+        self._free_symbols = None
+        self._pickled_values = None
+
+    def __repr__(self):
+        return 'Alphabet(size={})'.format(len(self.values))
+
+    def __len__(self):
+        return len(self.values)
+
+    def __contains__(self, value):
+        return canonical_key(value) in self.symbols
+
+    def encode(self, value: Any, read_only=False) -> int | None:
+        """Returns the symbol of a value.
+        Unseen values are added to the alphabet, unless read_only is set in which case None is returned."""
+        key = canonical_key(value)
+        symbols = self.symbols
+        symbol = symbols.get(key)
+        if symbol is None and not read_only:
+            if self._free_symbols:
+                symbol = self._free_symbols.pop()
+                self.values[symbol] = value
+            else:
+                symbol = len(self.values)
+                self.values.append(value)
+            symbols[key] = symbol
+        return symbol
+
+    def decode(self, symbol: int) -> Any:
+        """Returns the value of a symbol."""
+        return self.values[symbol]
+
+    def release(self, symbol: int):
+        """Releases a symbol that is no longer used: its value is forgotten and the symbol is reused by encode."""
+        del self.symbols[canonical_key(self.values[symbol])]
+        self.values[symbol] = RELEASED
+        self._free_symbols.append(symbol)
+
+
+__all__ = ['Alphabet', 'canonical_key', 'RELEASED']
@@ -0,0 +1,112 @@
+from __future__ import annotations
+from typing import Iterable, Iterator
+from array import array
+from bisect import bisect_left
+
+
+class IndexSet:
+    """A compact set of continuation indexes stored as a sorted array of unsigned ints.
+    Indexes use 4 bytes each instead of a boxed int in a hash table. Appending an index greater than all others,
+    which is what happens when a sequence is inserted in order, is amortized O(1) and membership is O(log n).
+    Supports indexing so that random.choice can be used directly on it."""
+
+    __slots__ = ('idxs',)
+
+    def __init__(self, idxs: Iterable[int] = ()):
+        self.idxs = array('I', sorted(set(idxs)))
+
+    @classmethod
+    def from_sorted(cls, idxs: array) -> IndexSet:
+        """Wraps an already sorted array of unique indexes without copying it."""
+        index_set = cls.__new__(cls)
+        index_set.idxs = idxs
+        return index_set
+
+    def __repr__(self):
+        return 'IndexSet({})'.format(list(self.idxs))
+
+    def __str__(self):
+        return '{' + ', '.join(str(idx) for idx in self.idxs) + '}'
+
+    def __len__(self):
+        return len(self.idxs)
+
+    def __bool__(self):
+        return len(self.idxs) != 0
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self.idxs)
+
+    def __getitem__(self, item):
+        return self.idxs[item]
+
+    def __contains__(self, idx):
+        i = bisect_left(self.idxs, idx)
+        return i != len(self.idxs) and self.idxs[i] == idx
+
+    def __eq__(self, other):
+        if isinstance(other, IndexSet):
+            return self.idxs == other.idxs
+        if isinstance(other, (set, frozenset)):
+            return len(self) == len(other) and all(idx in other for idx in self.idxs)
+        return NotImplemented
+
+    def __and__(self, other):
+        return self.intersection(other)
+
+    def __or__(self, other):
+        return self.union(other)
+
+    def add(self, idx: int):
+        idxs = self.idxs
+        if not idxs or idx > idxs[-1]:
+            idxs.append(idx)
+            return
+        i = bisect_left(idxs, idx)
+        if idxs[i] != idx:
+            idxs.insert(i, idx)
+
+    def update(self, idxs: Iterable[int]):
+        """Adds indexes. Indexes of another IndexSet all greater than the current ones are appended without sorting."""
+        if isinstance(idxs, IndexSet):
+            if not idxs.idxs:
+                return
+            if not self.idxs or idxs.idxs[0] > self.idxs[-1]:
+                self.idxs.extend(idxs.idxs)
+                return
+        self.idxs = array('I', sorted(set(self.idxs).union(idxs)))
+
+    def discard(self, idx: int):
+        i = bisect_left(self.idxs, idx)
+        if i != len(self.idxs) and self.idxs[i] == idx:
+            del self.idxs[i]
+
+    def copy(self) -> IndexSet:
+        return IndexSet.from_sorted(array('I', self.idxs))
+
+    def union(self, *others: Iterable[int]) -> IndexSet:
+        return IndexSet(set(self.idxs).union(*others))
+
+    def intersection(self, *others: Iterable[int]) -> IndexSet:
+        return intersection(self, *others)
+
+
+def intersection(*idx_sets) -> IndexSet:
+    """Returns the intersection of index sets (or any sized containers) as an IndexSet.
+    Sets are intersected from the smallest outward. Small candidate sets are probed into large index sets by binary
+    search, other cases are left to the C set implementation."""
+    if not idx_sets:
+        return IndexSet()
+    idx_sets = sorted(idx_sets, key=len)
+    result = set(idx_sets[0])
+    for other in idx_sets[1:]:
+        if not result:
+            break
+        if isinstance(other, IndexSet) and len(result) * 16 < len(other):
+            result = {idx for idx in result if idx in other}
+        else:
+            result.intersection_update(other)
+    return IndexSet(result)
+
+
+__all__ = ['IndexSet']
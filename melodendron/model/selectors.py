@@ -1,5 +1,7 @@
 from __future__ import annotations
-from typing import Dict, Set, Any
+from typing import Dict, Iterable, Iterator, Set, Any
+from bisect import bisect_left
+from melodendron.model.index_set import IndexSet, intersection
 import random
 import math
 
@@ -27,17 +29,21 @@ def random_select(continuation_idxs_by_viewpoints: Dict[str: Set[Any]], verbose=
 
 def intersect_select(continuation_idxs_by_viewpoints: Dict[str: Set[Any]], verbose=False) -> int | None:
     """Returns a continuation index by randomly selecting in continuation indexes present in all viewpoints."""
-    all_continuation_idxs = (continuation_idxs for continuation_idxs in continuation_idxs_by_viewpoints.values()
-                             if continuation_idxs is not None)
-    continuation_idxs_intersection = set.intersection(*all_continuation_idxs)
+    all_continuation_idxs = [continuation_idxs for continuation_idxs in continuation_idxs_by_viewpoints.values()
+                             if continuation_idxs is not None]
+    continuation_idxs_intersection = intersection(*all_continuation_idxs)
     if not continuation_idxs_intersection:
         return None
-    state_selected = random.choice(list(continuation_idxs_intersection))
+    state_selected = random.choice(continuation_idxs_intersection)
     if verbose:
         str_format = '{} was selected among {}'.format(state_selected, continuation_idxs_intersection)
         print(str_format)
     return state_selected
 
+
+intersect_select.intersection = True  # Joint viewpoints can stand for the intersection of their viewpoints
+
+
 def weighted_intersect_select(continuation_idxs_by_viewpoints: Dict[str: Set[Any]], verbose=False) -> int | None:
     """Returns a continuation index by assigning a weight to each continuation index and randomly selecting using the
     weights.
@@ -46,11 +52,12 @@ def weighted_intersect_select(continuation_idxs_by_viewpoints: Dict[str: Set[Any
     all_weighted_continuation_idxs = dict()
     for continuation_idxs in continuation_idxs_by_viewpoints.values():
         if continuation_idxs is not None:
+            weight = 1 / len(continuation_idxs)
             for continuation_idx in continuation_idxs:
                 if continuation_idx in all_weighted_continuation_idxs:
-                    all_weighted_continuation_idxs[continuation_idx] += 1 / len(continuation_idxs)
+                    all_weighted_continuation_idxs[continuation_idx] += weight
                 else:
-                    all_weighted_continuation_idxs[continuation_idx] = 1 / len(continuation_idxs)
+                    all_weighted_continuation_idxs[continuation_idx] = weight
     if not all_weighted_continuation_idxs:
         return None
     state_selected = random.choices(list(all_weighted_continuation_idxs.keys()),
@@ -67,11 +74,12 @@ def exp_weighted_intersect_select(continuation_idxs_by_viewpoints: Dict[str: Set
     all_weighted_continuation_idxs = dict()
     for continuation_idxs in continuation_idxs_by_viewpoints.values():
         if continuation_idxs is not None:
+            weight = 1 / len(continuation_idxs)
             for continuation_idx in continuation_idxs:
                 if continuation_idx in all_weighted_continuation_idxs:
-                    all_weighted_continuation_idxs[continuation_idx] += 1 / len(continuation_idxs)
+                    all_weighted_continuation_idxs[continuation_idx] += weight
                 else:
-                    all_weighted_continuation_idxs[continuation_idx] = 1 / len(continuation_idxs)
+                    all_weighted_continuation_idxs[continuation_idx] = weight
     for continuation_idx, weight in all_weighted_continuation_idxs.items():
         all_weighted_continuation_idxs[continuation_idx] = math.exp(weight * factor) - 1
     if not all_weighted_continuation_idxs:
@@ -84,7 +92,67 @@ def exp_weighted_intersect_select(continuation_idxs_by_viewpoints: Dict[str: Set
     return state_selected
 
 
-#TODO: Hierarchical select
+def _narrow(candidates, continuation_idxs) -> Set[int]:
+    """Returns the intersection of two sets of continuation indexes in time bounded by the smallest one, except when
+    both are large index sets which are then intersected by the C set implementation."""
+    smallest, largest = sorted((candidates, continuation_idxs), key=len)
+    if isinstance(largest, (set, frozenset)):
+        return largest.intersection(smallest)
+    if len(smallest) * 16 < len(largest):
+        if isinstance(largest, IndexSet):
+            # Binary search in the sorted indexes, inlined
+            largest_idxs, n_idxs = largest.idxs, len(largest.idxs)
+            return {idx for idx in smallest
+                    if (position := bisect_left(largest_idxs, idx)) < n_idxs and largest_idxs[position] == idx}
+        return {idx for idx in smallest if idx in largest}
+    return set(smallest).intersection(largest)
+
+
+def _hierarchical_select(continuation_idxs_chains: Iterable[Iterator[Any]], verbose=False) -> int | None:
+    """Narrows candidates viewpoint by viewpoint, each viewpoint giving its continuation indexes by decreasing depth.
+    A viewpoint is intersected at the deepest depth leaving candidates and skipped if there is none. Candidate sets
+    are never built larger than the smallest intersected set and narrowing stops once a single candidate is left."""
+    candidates = None
+    for continuation_idxs_chain in continuation_idxs_chains:
+        for continuation_idxs in continuation_idxs_chain:
+            if not continuation_idxs:
+                continue
+            if candidates is None:
+                candidates = continuation_idxs
+                break
+            narrowed_candidates = _narrow(candidates, continuation_idxs)
+            if narrowed_candidates:
+                candidates = narrowed_candidates
+                break
+        if candidates is not None and len(candidates) == 1:
+            break
+    if candidates is None:
+        return None
+    state_selected = random.choice(candidates if isinstance(candidates, IndexSet) else tuple(candidates))
+    if verbose:
+        str_format = '{} was selected among {}'.format(state_selected, candidates)
+        print(str_format)
+    return state_selected
+
+
+def hierarchical_select(continuation_idxs_by_viewpoints: Dict[str: Set[Any]], verbose=False) -> int | None:
+    """Returns a continuation index by narrowing continuation indexes in the viewpoints priority order.
+    Each viewpoint restricts the candidates left by the previous ones, unless it would leave none in which case it is
+    skipped. The first viewpoint of the MVVOMM has the highest priority."""
+    return _hierarchical_select(((continuation_idxs,) for continuation_idxs in continuation_idxs_by_viewpoints.values()
+                                 if continuation_idxs is not None), verbose=verbose)
+
+
+def hierarchical_backoff_select(continuation_idxs_chains_by_viewpoints: Dict[str: Iterator[Set[Any]]],
+                                verbose=False) -> int | None:
+    """Similar to hierarchical_select except that a viewpoint which would leave no candidate backs off to shorter
+    contexts before being skipped.
+    The MVVOMM passes it the continuation indexes of each viewpoint by decreasing depth (see depth_chains)."""
+    return _hierarchical_select(continuation_idxs_chains_by_viewpoints.values(), verbose=verbose)
+
+
+hierarchical_backoff_select.depth_chains = True  # The MVVOMM passes continuation indexes by decreasing depth
 
 
-__all__ = ['random_select', 'intersect_select', 'weighted_intersect_select', 'exp_weighted_intersect_select']
+__all__ = ['random_select', 'intersect_select', 'weighted_intersect_select', 'exp_weighted_intersect_select',
+           'hierarchical_select', 'hierarchical_backoff_select']
@@ -0,0 +1,221 @@
+from __future__ import annotations
+from collections import Counter
+from collections.abc import Sequence
+from typing import Any, Dict, List, Tuple
+from array import array
+import mmap
+import pickle
+import struct
+import sys
+from melodendron.model.alphabet import Alphabet
+from melodendron.model.FlatVOMM import FlatVOMM
+from melodendron.model.MVVOMM import MVVOMM, _EXPLICIT_CONTEXT
+from melodendron.model.SuffixVOMM import SuffixVOMM
+from melodendron.model.VOMM import VOMM
+
+
+"""
+Model serialization.
+A saved MVVOMM is a single binary file:
+- a preamble: magic bytes, format version, offset and length of the header,
+- sections: pickled alphabet values, one symbol column per state key and, for each viewpoint, the trie flattened into
+  contiguous arrays (see FlatVOMM) aligned on 8 bytes, and the same for each joint viewpoint,
+- a pickled header describing the model and where each section is.
+Loading memory maps the file: tries are queried in place and alphabets are only unpickled when first used, so a large
+model opens in milliseconds and several processes loading the same file share its pages.
+"""
+
+
+MAGIC = b'MVVOMM\x00\x00'
+FORMAT_VERSION = 1
+_PREAMBLE = struct.Struct('<8sIQQ')  # magic, version, header offset, header length
+_MISSING = 0xFFFFFFFF                # Symbol of a key missing from a state
+_FLAT_VOMM_ARRAYS = ('values', 'first_children', 'child_counts', 'idx_starts', 'idx_counts', 'idxs')
+
+
+class MappedStateSequence(Sequence):
+    """A sequence of mapped states stored as one symbol column per state key.
+    Mapped state dicts are built on access, which avoids building one dict per state when a model is loaded.
+    Columns can be read-only views of a loaded file, they are copied into arrays before the sequence is modified."""
+
+    def __init__(self, keys: List[str], columns: Dict[str, array], length: int):
+        self.keys = keys
+        self.columns = columns
+        self.length = length
+
+    def __repr__(self):
+        return 'MappedStateSequence(keys={}, length={})'.format(self.keys, len(self))
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        if not -self.length <= idx < self.length:
+            raise IndexError('MappedStateSequence index out of range')
+        mapped_state = dict()
+        for key in self.keys:
+            symbol = self.columns[key][idx]
+            if symbol != _MISSING:
+                mapped_state[key] = symbol
+        return mapped_state
+
+    def get_symbols(self, idxs: Sequence[int], key: str) -> List[int | None]:
+        """Returns the symbol of a key for each index, None where the state has no such key."""
+        column = self.columns.get(key)
+        if column is None:
+            return [None] * len(idxs)
+        return [None if symbol == _MISSING else symbol for symbol in (column[idx] for idx in idxs)]
+
+    def _copy_views(self):
+        for key, column in self.columns.items():
+            if not isinstance(column, array):
+                self.columns[key] = array('I', column)
+
+    def __delitem__(self, idx):
+        if not isinstance(idx, slice):
+            raise TypeError('MappedStateSequence only deletes slices')
+        self._copy_views()
+        for column in self.columns.values():
+            del column[idx]
+        self.length -= len(range(*idx.indices(self.length)))
+
+    def append(self, mapped_state: Dict[str, Any]):
+        self._copy_views()
+        for key in mapped_state:
+            if key not in self.columns:
+                self.keys.append(key)
+                self.columns[key] = array('I', [_MISSING]) * len(self)
+        for key in self.keys:
+            self.columns[key].append(mapped_state.get(key, _MISSING))
+        self.length += 1
+
+
+class _SectionWriter:
+    def __init__(self, file):
+        self.file = file
+
+    def write(self, data) -> Tuple[int, int]:
+        """Writes an 8 bytes aligned section and returns its offset and length."""
+        offset = self.file.tell()
+        padding = -offset % 8
+        self.file.write(b'\x00' * padding)
+        data = memoryview(data).cast('B')
+        self.file.write(data)
+        return offset + padding, len(data)
+
+
+def save_model(model: MVVOMM, filepath: str):
+    """Saves a MVVOMM to a binary file that can be loaded with load_model."""
+    keys = list()
+    for mapped_state in model.state_sequence:
+        keys.extend(key for key in mapped_state if key not in keys)
+    header = dict(byteorder=sys.byteorder, viewpoints=model.viewpoints, keys=keys, length=len(model.state_sequence),
+                  alphabets=dict(), state_columns=dict(), vomms=dict(), joint_viewpoints=model.joint_viewpoints,
+                  joint_alphabets=dict(), joint_columns=dict(), joint_vomms=dict(), storage_start=model.storage_start,
+                  first_idx=model.first_idx, max_context_length=model.max_context_length, max_states=model.max_states,
+                  memory_budget=model.memory_budget, reclaim_symbols=model.reclaim_symbols,
+                  explicit_contexts=model.explicit_contexts)
+    with open(filepath, 'wb') as file:
+        file.write(_PREAMBLE.pack(MAGIC, FORMAT_VERSION, 0, 0))
+        writer = _SectionWriter(file)
+        for key, alphabet in model.alphabets.items():
+            header['alphabets'][key] = writer.write(pickle.dumps(alphabet.values, protocol=pickle.HIGHEST_PROTOCOL))
+        for key in keys:
+            column = array('I', (mapped_state.get(key, _MISSING) for mapped_state in model.state_sequence))
+            header['state_columns'][key] = writer.write(column)
+        for viewpoint, vomm in model.vomms.items():
+            header['vomms'][viewpoint] = _write_vomm(writer, vomm)
+        for joint_viewpoint in model.joint_viewpoints:
+            header['joint_alphabets'][joint_viewpoint] = writer.write(pickle.dumps(
+                model.joint_alphabets[joint_viewpoint].values, protocol=pickle.HIGHEST_PROTOCOL))
+            header['joint_columns'][joint_viewpoint] = writer.write(model.symbol_columns[joint_viewpoint])
+            header['joint_vomms'][joint_viewpoint] = _write_vomm(writer, model.joint_vomms[joint_viewpoint])
+        header['context_lengths'] = writer.write(model.context_lengths)
+        header['vomm_class'] = type(next(iter(model.vomms.values()), VOMM())).__name__
+        header_offset, header_length = writer.write(pickle.dumps(header))
+        file.seek(0)
+        file.write(_PREAMBLE.pack(MAGIC, FORMAT_VERSION, header_offset, header_length))
+
+
+def load_model(filepath: str, use_mmap=True) -> MVVOMM:
+    """Loads a MVVOMM saved with save_model.
+    With use_mmap, the file is memory mapped and tries are queried in place. Otherwise it is read in memory."""
+    with open(filepath, 'rb') as file:
+        if use_mmap:
+            buffer = memoryview(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))
+        else:
+            buffer = memoryview(file.read())
+    magic, version, header_offset, header_length = _PREAMBLE.unpack_from(buffer)
+    if magic != MAGIC:
+        raise ValueError('{} is not a saved MVVOMM'.format(filepath))
+    if version != FORMAT_VERSION:
+        raise ValueError('Unsupported MVVOMM format version {} (expected {})'.format(version, FORMAT_VERSION))
+    header = pickle.loads(buffer[header_offset:header_offset + header_length])
+    if header['byteorder'] != sys.byteorder:
+        raise ValueError('{} was saved with a {} endian byte order'.format(filepath, header['byteorder']))
+
+    def section(offset, length, typecode='B'):
+        return buffer[offset:offset + length].cast(typecode)
+
+    vomm_class = SuffixVOMM if header['vomm_class'] == SuffixVOMM.__name__ else VOMM
+    model = MVVOMM(header['viewpoints'], vomm_class=vomm_class, joint_viewpoints=header.get('joint_viewpoints', ()),
+                   max_states=header.get('max_states'), memory_budget=header.get('memory_budget'),
+                   reclaim_symbols=header.get('reclaim_symbols', False))
+    model.alphabets = {key: Alphabet.from_pickled_values(section(*location))
+                       for key, location in header['alphabets'].items()}
+    # State columns are read in place until the model is modified, viewpoint columns are copied once so that the model
+    # can keep learning, tries stay in place until modified
+    columns = {key: section(*location, 'I') for key, location in header['state_columns'].items()}
+    model.state_sequence = MappedStateSequence(header['keys'], columns, header['length'])
+    model.symbol_columns = {viewpoint: array('I', columns[viewpoint]) if viewpoint in columns else array('I')
+                            for viewpoint in model.viewpoints}
+    for viewpoint, vomm_header in header['vomms'].items():
+        model.vomms[viewpoint] = _read_vomm(section, vomm_header)
+    for joint_viewpoint in model.joint_viewpoints:
+        model.joint_alphabets[joint_viewpoint] = Alphabet.from_pickled_values(
+            section(*header['joint_alphabets'][joint_viewpoint]))
+        model.symbol_columns[joint_viewpoint] = array('I', section(*header['joint_columns'][joint_viewpoint], 'I'))
+        model.joint_vomms[joint_viewpoint] = _read_vomm(section, header['joint_vomms'][joint_viewpoint])
+    model.storage_start = header.get('storage_start', 0)
+    model.first_idx = header.get('first_idx', 0)
+    if 'context_lengths' in header:
+        model.context_lengths = array('I', section(*header['context_lengths'], 'I'))
+        model.max_context_length = header['max_context_length']
+    else:
+        # Contexts of models saved without context lengths are unknown, they are treated as given to insert
+        model.context_lengths = array('I', [_EXPLICIT_CONTEXT]) * header['length']
+    model.explicit_contexts = header.get('explicit_contexts', dict())
+    if model.reclaim_symbols:
+        model._count_symbols(0)
+        for context_symbols in model.explicit_contexts.values():
+            for key, context in context_symbols.items():
+                model.symbol_counts.setdefault(key, Counter()).update(context)
+    return model
+
+
+def _write_vomm(writer: _SectionWriter, vomm) -> Dict[str, Any]:
+    """Writes a trie as flat arrays, or pickled for other VOMM engines, and returns its header."""
+    if isinstance(vomm, FlatVOMM) and vomm.vomm is not None:
+        vomm = vomm.vomm
+    if isinstance(vomm, VOMM):
+        vomm = FlatVOMM.from_vomm(vomm)
+    if isinstance(vomm, FlatVOMM):
+        sections = {name: writer.write(array(_typecode(name), getattr(vomm, name))) for name in _FLAT_VOMM_ARRAYS}
+        return dict(root_count=vomm.root_count, sections=sections)
+    return dict(pickled=writer.write(pickle.dumps(vomm)))
+
+
+def _read_vomm(section, vomm_header: Dict[str, Any]):
+    if 'pickled' in vomm_header:
+        return pickle.loads(section(*vomm_header['pickled']))
+    arrays = {name: section(*location, _typecode(name)) for name, location in vomm_header['sections'].items()}
+    return FlatVOMM(vomm_header['root_count'], **arrays)
+
+
+def _typecode(name: str) -> str:
+    return 'Q' if name == 'idx_starts' else 'I'
+
+
+__all__ = ['save_model', 'load_model', 'MappedStateSequence']
@@ -0,0 +1,210 @@
+from __future__ import annotations
+from collections import deque
+from typing import Any, Dict, List, Tuple
+import bisect
+import math
+
+
+class LatencyStats:
+    """Running latency statistics.
+    Count, mean and maximum cover every recorded latency, percentiles cover the most recent ones."""
+
+    def __init__(self, window=1000):
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+        self.recent = deque(maxlen=window)
+
+    def __repr__(self):
+        return 'LatencyStats(count={})'.format(self.count)
+
+    def __str__(self):
+        if self.count == 0:
+            return 'No latency recorded'
+        summary = self.summary()
+        return 'count: {}, mean: {:.3f}ms, p50: {:.3f}ms, p99: {:.3f}ms, max: {:.3f}ms'.format(
+            summary['count'], summary['mean_ms'], summary['p50_ms'], summary['p99_ms'], summary['max_ms'])
+
+    def record(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+        self.recent.append(seconds)
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.
+
+    def percentile(self, p: float) -> float:
+        """Returns the p-th percentile (0 to 100) of the recent latencies, in seconds."""
+        if not self.recent:
+            return 0.
+        recent = sorted(self.recent)
+        return recent[min(len(recent) - 1, int(p / 100 * len(recent)))]
+
+    def summary(self) -> Dict[str, float]:
+        return dict(count=self.count, mean_ms=self.mean * 1000, p50_ms=self.percentile(50) * 1000,
+                    p99_ms=self.percentile(99) * 1000, max_ms=self.max * 1000)
+
+
+class Histogram:
+    """Count, sum, minimum and maximum of observed values, with counts by power of two buckets.
+    A positive value v falls in the bucket with upper bound 2 ** math.frexp(v)[1], the smallest power of two greater
+    than v, so that seconds and sizes of any magnitude share the same buckets. Other values fall in the bucket 0."""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.
+        self.min = math.inf
+        self.max = -math.inf
+        self.buckets = dict()  # Exponent of the upper bound (None for the bucket 0) -> count
+
+    def __repr__(self):
+        return 'Histogram(count={})'.format(self.count)
+
+    def record(self, value: float):
+        self.count += 1
+        self.total += value
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+        exponent = math.frexp(value)[1] if value > 0 else None
+        self.buckets[exponent] = self.buckets.get(exponent, 0) + 1
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.
+
+    def bucket_counts(self) -> List[Tuple[float, int]]:
+        """Returns the (upper bound, count) of the non empty buckets, by increasing upper bound."""
+        return sorted((0. if exponent is None else math.ldexp(1., exponent), count)
+                      for exponent, count in self.buckets.items())
+
+    def quantile(self, q: float) -> float:
+        """Returns an upper bound of the q-th quantile (0 to 1): the upper bound of the bucket containing it."""
+        rank = q * self.count
+        cumulative_count = 0
+        for upper_bound, count in self.bucket_counts():
+            cumulative_count += count
+            if cumulative_count >= rank:
+                return min(upper_bound, self.max)
+        return self.max if self.count else 0.
+
+    def summary(self) -> Dict[str, Any]:
+        if self.count == 0:
+            return dict(count=0)
+        return dict(count=self.count, sum=self.total, mean=self.mean, min=self.min, max=self.max,
+                    p50=self.quantile(.5), p99=self.quantile(.99), buckets=self.bucket_counts())
+
+
+class P2Quantile:
+    """Streaming estimate of the p-th quantile (0 to 1) with the P-square algorithm (Jain and Chlamtac, 1985).
+    Five markers are kept and moved towards their desired positions with parabolic interpolation, so each value is
+    added in constant time and memory. The estimate is exact for the first five values."""
+
+    def __init__(self, p=.5):
+        self.p = p
+        self.count = 0
+        self.heights = list()                                  # Sorted values, then marker heights
+        self.positions = [1, 2, 3, 4, 5]                       # Marker positions
+        self.desired_positions = [1, 1 + 2 * p, 1 + 4 * p, 3 + 2 * p, 5]
+        self.increments = [0, p / 2, p, (1 + p) / 2, 1]        # Increments of the desired positions
+
+    def __repr__(self):
+        return 'P2Quantile(p={}, count={})'.format(self.p, self.count)
+
+    def copy(self) -> P2Quantile:
+        estimator = P2Quantile(self.p)
+        estimator.count = self.count
+        estimator.heights = list(self.heights)
+        estimator.positions = list(self.positions)
+        estimator.desired_positions = list(self.desired_positions)
+        return estimator
+
+    def add(self, value: float):
+        self.count += 1
+        heights, positions = self.heights, self.positions
+        if self.count <= 5:
+            bisect.insort(heights, value)
+            return
+        if value < heights[0]:
+            heights[0] = value
+            k = 0
+        elif value >= heights[4]:
+            heights[4] = value
+            k = 3
+        else:
+            k = bisect.bisect_right(heights, value) - 1
+        for i in range(k + 1, 5):
+            positions[i] += 1
+        for i in range(5):
+            self.desired_positions[i] += self.increments[i]
+        for i in range(1, 4):
+            d = self.desired_positions[i] - positions[i]
+            if d >= 1 and positions[i + 1] - positions[i] > 1 or d <= -1 and positions[i - 1] - positions[i] < -1:
+                d = 1 if d > 0 else -1
+                height = heights[i] + d / (positions[i + 1] - positions[i - 1]) * (
+                    (positions[i] - positions[i - 1] + d) * (heights[i + 1] - heights[i])
+                    / (positions[i + 1] - positions[i])
+                    + (positions[i + 1] - positions[i] - d) * (heights[i] - heights[i - 1])
+                    / (positions[i] - positions[i - 1]))
+                if not heights[i - 1] < height < heights[i + 1]:
+                    # The parabolic prediction would break the order of the markers, fall back to a linear one
+                    height = heights[i] + d * (heights[i + d] - heights[i]) / (positions[i + d] - positions[i])
+                heights[i] = height
+                positions[i] += d
+
+    @property
+    def value(self) -> float:
+        """The estimated quantile, 0 when no value was added."""
+        if self.count == 0:
+            return 0.
+        if self.count <= 5:
+            # Linear interpolation between the closest ranks, as statistics.median for p = 0.5
+            rank = self.p * (self.count - 1)
+            lower = int(rank)
+            upper = min(lower + 1, self.count - 1)
+            return self.heights[lower] + (rank - lower) * (self.heights[upper] - self.heights[lower])
+        return self.heights[2]
+
+
+class Instrumentation:
+    """Counters and histograms recorded by an instrumented MVVOMM (see MVVOMM.enable_instrumentation).
+    Names are dotted, with the viewpoint last for per viewpoint metrics. export gives plain dicts and lists, ready
+    for json.dump."""
+
+    def __init__(self):
+        self.counters = dict()
+        self.histograms = dict()
+
+    def __repr__(self):
+        return 'Instrumentation(counters={}, histograms={})'.format(len(self.counters), len(self.histograms))
+
+    def __str__(self):
+        lines = ['{}: {}'.format(name, count) for name, count in sorted(self.counters.items())]
+        for name, histogram in sorted(self.histograms.items()):
+            lines.append('{}: count {}, mean {:.4g}, p50 <= {:.4g}, p99 <= {:.4g}, max {:.4g}'.format(
+                name, histogram.count, histogram.mean, histogram.quantile(.5), histogram.quantile(.99), histogram.max))
+        return '\n'.join(lines)
+
+    def count(self, name: str, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe(self, name: str, value: float):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        histogram.record(value)
+
+    def reset(self):
+        self.counters.clear()
+        self.histograms.clear()
+
+    def export(self) -> Dict[str, Any]:
+        return dict(counters=dict(self.counters),
+                    histograms={name: histogram.summary() for name, histogram in self.histograms.items()})
+
+
+__all__ = ['LatencyStats', 'Histogram', 'P2Quantile', 'Instrumentation']
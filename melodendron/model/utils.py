@@ -1,7 +1,19 @@
+from __future__ import annotations
+from typing import Any, Dict, List, Sequence, Tuple
 import statistics
+import numpy as np
+from melodendron.model.stats import P2Quantile
 
 
-def get_plagiarism_counts(state_sequence):
+"""
+Plagiarism metrics.
+A generated state is a copy when it follows, in the corpus, the state generated before it. A plagiarism run is a
+maximal sequence of consecutive copies, its length is its number of copies.
+"""
+
+
+def get_plagiarism_counts(state_sequence: Sequence[Dict[str, Any]]) -> List[int]:
+    """Returns the length of each run of copies, with a 0 between two states which are not a copy."""
     counts = list()
     count = 0
     for i in range(len(state_sequence) - 1):
@@ -10,18 +22,19 @@ def get_plagiarism_counts(state_sequence):
         else:
             counts.append(count)
             count = 0
+    if count:
+        counts.append(count)
     return counts
 
 
-def get_plagiarism_infos(state_sequence):
-    plagiarism_counts = get_plagiarism_counts(state_sequence)
-    plagiarism_proportion = sum(count for count in plagiarism_counts if count != 0) / len(state_sequence)
-    longest_plagiarism = max(plagiarism_counts)
-    mean_plagiarism_length_without_0 = statistics.mean(count for count in plagiarism_counts if count != 0)
-    median_plagiarism_length_without_0 = statistics.median(count for count in plagiarism_counts if count != 0)
-    infos = (plagiarism_proportion, longest_plagiarism, mean_plagiarism_length_without_0,
-             median_plagiarism_length_without_0)
-    return infos
+def get_plagiarism_infos(state_sequence: Sequence[Dict[str, Any]]) -> Tuple[float, int, float, float]:
+    """Returns the proportion of copies, the longest run and the mean and median length of runs.
+    Metrics of a sequence without states or without copies are 0."""
+    run_lengths = [count for count in get_plagiarism_counts(state_sequence) if count != 0]
+    if not run_lengths:
+        return 0., 0, 0., 0.
+    total = sum(run_lengths)
+    return total / len(state_sequence), max(run_lengths), total / len(run_lengths), statistics.median(run_lengths)
 
 
 def print_plagiarism_infos(state_sequence):
@@ -31,4 +44,122 @@ def print_plagiarism_infos(state_sequence):
     print('Mean plagiarism length: {}'.format(round(infos[2], 2)))
     print('Median plagiarism length: {}'.format(round(infos[3], 2)))
 
-__all__ = ['get_plagiarism_infos', 'print_plagiarism_infos']
+
+def get_plagiarism_infos_array(ids) -> np.ndarray:
+    """get_plagiarism_infos on arrays of state ids, e.g. of MVVOMM.generate_idxs.
+    A (k, n) array of k generated sequences gives a (k, 4) array of their infos, a (n,) array gives a (4,) array. Runs
+    of all sequences are found at once from the edges of the copies, each row padded so that runs do not span rows."""
+    ids = np.asarray(ids, dtype=np.int64)
+    squeeze = ids.ndim == 1
+    ids = np.atleast_2d(ids)
+    k, n = ids.shape
+    infos = np.zeros((k, 4))
+    if n > 1:
+        padded_copies = np.zeros((k, n + 1), dtype=np.int8)
+        padded_copies[:, 1:n] = np.diff(ids, axis=1) == 1
+        edges = np.diff(padded_copies.ravel())
+        starts = np.flatnonzero(edges == 1)
+        run_lengths = np.flatnonzero(edges == -1) - starts
+        rows = starts // (n + 1)
+        n_runs = np.bincount(rows, minlength=k)
+        totals = np.bincount(rows, weights=run_lengths, minlength=k)
+        longest = np.zeros(k, dtype=np.int64)
+        np.maximum.at(longest, rows, run_lengths)
+        # Runs are sorted by row, then by length within each row
+        sorted_lengths = run_lengths[np.lexsort((run_lengths, rows))]
+        offsets = np.concatenate(([0], np.cumsum(n_runs)[:-1]))
+        has_runs = n_runs > 0
+        lower = offsets[has_runs] + (n_runs[has_runs] - 1) // 2
+        upper = offsets[has_runs] + n_runs[has_runs] // 2
+        infos[:, 0] = totals / n
+        infos[:, 1] = longest
+        infos[has_runs, 2] = totals[has_runs] / n_runs[has_runs]
+        infos[has_runs, 3] = (sorted_lengths[lower] + sorted_lengths[upper]) / 2
+    return infos[0] if squeeze else infos
+
+
+class PlagiarismTracker:
+    """Plagiarism metrics of a sequence updated with each state index, in constant time and memory.
+    The median run length is a P-square estimate (see P2Quantile), exact up to five runs, other metrics are those of
+    get_plagiarism_infos.
+
+    Given to MVVOMM.generate_n, it tracks the generated states. With max_run_length or max_proportion, a selected
+    continuation which would make a run longer than max_run_length or the proportion of copies higher than
+    max_proportion either stops the generation (on_exceed='stop', fewer states are generated) or is replaced by a
+    random state which is not a copy (on_exceed='resteer'). The proportion is only checked from min_states states."""
+
+    def __init__(self, max_run_length: int | None = None, max_proportion: float | None = None, on_exceed='resteer',
+                 min_states=32):
+        if on_exceed not in ('stop', 'resteer'):
+            raise ValueError('on_exceed must be stop or resteer, not {}'.format(on_exceed))
+        self.max_run_length = max_run_length
+        self.max_proportion = max_proportion
+        self.on_exceed = on_exceed
+        self.min_states = min_states
+        self.reset()
+
+    def __repr__(self):
+        return 'PlagiarismTracker(states={}, copies={})'.format(self.n_states, self.n_copies)
+
+    def __str__(self):
+        return 'proportion: {:.2%}, longest: {}, mean: {:.2f}, median: {:.2f}'.format(*self.infos())
+
+    def reset(self):
+        self.last_idx = None
+        self.n_states = 0
+        self.n_copies = 0
+        self.run_length = 0              # Length of the current run
+        self.longest_run = 0
+        self.n_runs = 0                  # Number of ended runs
+        self.median_estimator = P2Quantile(.5)  # Of the lengths of ended runs
+        self.n_resteers = 0
+
+    def update(self, idx: int):
+        """Tracks the next state index of the sequence."""
+        if self.last_idx is not None and idx == self.last_idx + 1:
+            self.n_copies += 1
+            self.run_length += 1
+            if self.run_length > self.longest_run:
+                self.longest_run = self.run_length
+        elif self.run_length:
+            self.n_runs += 1
+            self.median_estimator.add(self.run_length)
+            self.run_length = 0
+        self.last_idx = idx
+        self.n_states += 1
+
+    def would_exceed(self, idx: int) -> bool:
+        """Returns whether tracking idx next would cross a threshold."""
+        if self.last_idx is None or idx != self.last_idx + 1:
+            return False
+        if self.max_run_length is not None and self.run_length + 1 > self.max_run_length:
+            return True
+        n_states = self.n_states + 1
+        return (self.max_proportion is not None and n_states >= self.min_states
+                and (self.n_copies + 1) / n_states > self.max_proportion)
+
+    @property
+    def proportion(self) -> float:
+        return self.n_copies / self.n_states if self.n_states else 0.
+
+    @property
+    def mean_run_length(self) -> float:
+        n_runs = self.n_runs + (self.run_length > 0)
+        return self.n_copies / n_runs if n_runs else 0.
+
+    @property
+    def median_run_length(self) -> float:
+        if not self.run_length:
+            return self.median_estimator.value
+        # The current run is counted as if it ended now
+        median_estimator = self.median_estimator.copy()
+        median_estimator.add(self.run_length)
+        return median_estimator.value
+
+    def infos(self) -> Tuple[float, int, float, float]:
+        """Returns the metrics of get_plagiarism_infos."""
+        return self.proportion, self.longest_run, self.mean_run_length, self.median_run_length
+
+
+__all__ = ['get_plagiarism_counts', 'get_plagiarism_infos', 'print_plagiarism_infos', 'get_plagiarism_infos_array',
+           'PlagiarismTracker']
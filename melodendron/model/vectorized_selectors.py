@@ -0,0 +1,109 @@
+from __future__ import annotations
+from typing import Dict, List, Any, Tuple
+import numpy as np
+from melodendron.model.index_set import IndexSet
+
+
+"""
+Vectorized selectors.
+NumPy versions of the selectors operating on continuation index arrays. Weights are computed with bincount and
+sampling uses a supplied numpy.random.Generator so that generation can be reproduced.
+Pass the generator with a partial: partial(np_weighted_intersect_select, rng=numpy.random.default_rng(seed)).
+"""
+
+
+_default_rng = np.random.default_rng()
+
+
+def _to_arrays(continuation_idxs_by_viewpoints: Dict[str: Any]) -> List[np.ndarray]:
+    """Converts the continuation indexes of each viewpoint to uint32 arrays, skipping missing viewpoints."""
+    arrays = list()
+    for continuation_idxs in continuation_idxs_by_viewpoints.values():
+        if continuation_idxs is None:
+            continue
+        if isinstance(continuation_idxs, IndexSet):
+            arrays.append(np.frombuffer(continuation_idxs.idxs, dtype=np.uint32).copy())
+        else:
+            arrays.append(np.fromiter(continuation_idxs, dtype=np.uint32, count=len(continuation_idxs)))
+    return arrays
+
+
+def _weights(arrays: List[np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+    """Returns the unique continuation indexes and their weight: sum(1 / len(continuation_idxs)) over viewpoints."""
+    all_idxs = np.concatenate(arrays)
+    all_weights = np.concatenate([np.full(len(array), 1 / len(array)) for array in arrays])
+    unique_idxs, inverse = np.unique(all_idxs, return_inverse=True)
+    return unique_idxs, np.bincount(inverse.ravel(), weights=all_weights, minlength=len(unique_idxs))
+
+
+def _weighted_choice(idxs: np.ndarray, weights: np.ndarray, rng: np.random.Generator, verbose) -> int | None:
+    total = weights.sum()
+    if total <= 0:
+        return None
+    state_selected = int(idxs[rng.choice(len(idxs), p=weights / total)])
+    if verbose:
+        print('{} was selected among {} weighted continuations'.format(state_selected, len(idxs)))
+    return state_selected
+
+
+def np_random_select(continuation_idxs_by_viewpoints: Dict[str: Any], rng: np.random.Generator = None,
+                     verbose=False) -> int | None:
+    """Returns a continuation index by randomly selecting in all continuation indexes."""
+    rng = rng or _default_rng
+    arrays = [array for array in _to_arrays(continuation_idxs_by_viewpoints) if len(array) != 0]
+    if not arrays:
+        return None
+    all_idxs = np.concatenate(arrays)
+    state_selected = int(all_idxs[rng.integers(len(all_idxs))])
+    if verbose:
+        print('{} was selected among {} continuations'.format(state_selected, len(all_idxs)))
+    return state_selected
+
+
+def np_intersect_select(continuation_idxs_by_viewpoints: Dict[str: Any], rng: np.random.Generator = None,
+                        verbose=False) -> int | None:
+    """Returns a continuation index by randomly selecting in continuation indexes present in all viewpoints."""
+    rng = rng or _default_rng
+    arrays = sorted(_to_arrays(continuation_idxs_by_viewpoints), key=len)
+    if not arrays:
+        return None
+    intersection = arrays[0]
+    for array in arrays[1:]:
+        if len(intersection) == 0:
+            break
+        intersection = np.intersect1d(intersection, array, assume_unique=True)
+    if len(intersection) == 0:
+        return None
+    state_selected = int(intersection[rng.integers(len(intersection))])
+    if verbose:
+        print('{} was selected among {}'.format(state_selected, intersection))
+    return state_selected
+
+
+np_intersect_select.intersection = True  # Joint viewpoints can stand for the intersection of their viewpoints
+
+
+def np_weighted_intersect_select(continuation_idxs_by_viewpoints: Dict[str: Any], rng: np.random.Generator = None,
+                                 verbose=False) -> int | None:
+    """Vectorized weighted_intersect_select.
+    weight = sum(1 / len(continuation_idxs)) for viewpoints if continuation_idx in viewpoint
+    """
+    arrays = [array for array in _to_arrays(continuation_idxs_by_viewpoints) if len(array) != 0]
+    if not arrays:
+        return None
+    unique_idxs, weights = _weights(arrays)
+    return _weighted_choice(unique_idxs, weights, rng or _default_rng, verbose)
+
+
+def np_exp_weighted_intersect_select(continuation_idxs_by_viewpoints: Dict[str: Any], factor=1,
+                                     rng: np.random.Generator = None, verbose=False) -> int | None:
+    """Vectorized exp_weighted_intersect_select."""
+    arrays = [array for array in _to_arrays(continuation_idxs_by_viewpoints) if len(array) != 0]
+    if not arrays:
+        return None
+    unique_idxs, weights = _weights(arrays)
+    return _weighted_choice(unique_idxs, np.expm1(weights * factor), rng or _default_rng, verbose)
+
+
+__all__ = ['np_random_select', 'np_intersect_select', 'np_weighted_intersect_select',
+           'np_exp_weighted_intersect_select']
@@ -1,3 +1,8 @@
-from .midi_file_parser import MidiFileParser, states_to_midi_track
+from .midi_file_parser import MidiFileParser, StateClusterer, TimedMessagesClusterer, states_to_midi_track, \
+    midi_track_to_states, iter_track_states, note_events_to_midi_track
+from .midi_writer import MidiFileWriter
+from .realtime import RealtimeParser, scripted_source, port_source
+from .cache import StateSequenceCache
+from .state_sequence import StateSequence, reduce_dynamic_columns, reduce_density_columns
 from .reduction_functions import *
 from .utils import *
@@ -0,0 +1,207 @@
+from __future__ import annotations
+from array import array
+from typing import Any, Callable, List, Sequence, Tuple
+import functools
+import hashlib
+import marshal
+import math
+import os
+import pickle
+import tempfile
+import zlib
+from melodendron.model.alphabet import canonical_key
+from .midi_file_parser import PARSER_VERSION, MidiFileParser
+from .reduction_functions import add_derived_viewpoint
+
+
+"""
+On disk cache of parsed state sequences.
+An entry is keyed by the sha256 of the midi file content, the parsed tracks, the parser version and the code of the
+derived viewpoints reductions, so any change to one of them misses the cache and the stale entry ages out.
+Entries are zlib compressed and columnar: note events are stored as pitch, velocity, start and end arrays and every
+other state key as a column of interned value symbols.
+"""
+
+
+CACHE_FORMAT_VERSION = 1
+_NOTE_EVENT_KEYS = ('pitch', 'velocity', 'start_delta', 'end_delta')
+_MISSING = 0xFFFFFFFF  # Symbol of a key missing from a state
+
+
+def _reduction_key(reduction: Callable) -> Any:
+    """Returns a key identifying a reduction function and its code."""
+    if isinstance(reduction, functools.partial):
+        return _reduction_key(reduction.func), reduction.args, sorted(reduction.keywords.items())
+    code = getattr(reduction, '__code__', None)
+    code_hash = hashlib.sha256(marshal.dumps(code)).hexdigest() if code is not None else None
+    return getattr(reduction, '__module__', None), getattr(reduction, '__qualname__', repr(reduction)), code_hash
+
+
+def encode_states(state_sequence: List[dict]) -> bytes:
+    """Encodes a state sequence to compact bytes."""
+    note_counts, pitches, velocities = array('I'), array('B'), array('B')
+    start_deltas, end_deltas = array('d'), array('d')
+    state_keys = list()
+    for state in state_sequence:
+        state_keys.extend(key for key in state if key not in state_keys)
+    keys = [key for key in state_keys if key != 'note_events']
+    columns = {key: array('I') for key in keys}
+    values = {key: list() for key in keys}
+    symbols = {key: dict() for key in keys}
+    for state in state_sequence:
+        note_events = state.get('note_events')
+        if note_events is None or any(tuple(note_event) != _NOTE_EVENT_KEYS for note_event in note_events):
+            # States that do not come from the parser are pickled as is
+            return zlib.compress(pickle.dumps(('pickled', state_sequence), protocol=pickle.HIGHEST_PROTOCOL))
+        note_counts.append(len(note_events))
+        for note_event in note_events:
+            pitches.append(note_event['pitch'])
+            velocities.append(note_event['velocity'])
+            start_deltas.append(note_event['start_delta'])
+            end_delta = note_event['end_delta']
+            end_deltas.append(math.nan if end_delta is None else end_delta)
+        for key in keys:
+            if key not in state:
+                columns[key].append(_MISSING)
+                continue
+            value = state[key]
+            # Interned by type too, so that 1, 1.0 and True are kept apart
+            interned_key = type(value), canonical_key(value)
+            symbol = symbols[key].get(interned_key)
+            if symbol is None:
+                symbol = symbols[key][interned_key] = len(values[key])
+                values[key].append(value)
+            columns[key].append(symbol)
+    columnar = dict(note_counts=note_counts.tobytes(), pitches=pitches.tobytes(), velocities=velocities.tobytes(),
+                    start_deltas=start_deltas.tobytes(), end_deltas=end_deltas.tobytes(),
+                    state_keys=state_keys, columns={key: (values[key], columns[key].tobytes()) for key in keys})
+    return zlib.compress(pickle.dumps(('columnar', columnar), protocol=pickle.HIGHEST_PROTOCOL))
+
+
+def decode_states(data: bytes) -> List[dict]:
+    """Decodes a state sequence encoded with encode_states."""
+    kind, content = pickle.loads(zlib.decompress(data))
+    if kind == 'pickled':
+        return content
+    note_counts = array('I', content['note_counts'])
+    pitches, velocities = array('B', content['pitches']), array('B', content['velocities'])
+    start_deltas, end_deltas = array('d', content['start_deltas']), array('d', content['end_deltas'])
+    end_deltas = [None if math.isnan(end_delta) else end_delta for end_delta in end_deltas]
+    columns = dict()
+    for key, (values, column) in content['columns'].items():
+        # Mutable values are copied so that states do not share them
+        mutable = any(isinstance(value, (set, list, dict)) for value in values)
+        columns[key] = values, array('I', column), mutable
+    state_sequence = list()
+    note_idx = 0
+    for i, note_count in enumerate(note_counts):
+        state = dict()
+        for key in content['state_keys']:
+            if key == 'note_events':
+                note_end = note_idx + note_count
+                state['note_events'] = [
+                    dict(pitch=pitch, velocity=velocity, start_delta=start_delta, end_delta=end_delta)
+                    for pitch, velocity, start_delta, end_delta in zip(
+                        pitches[note_idx:note_end], velocities[note_idx:note_end],
+                        start_deltas[note_idx:note_end], end_deltas[note_idx:note_end])]
+                note_idx = note_end
+                continue
+            values, column, mutable = columns[key]
+            symbol = column[i]
+            if symbol != _MISSING:
+                state[key] = values[symbol].copy() if mutable else values[symbol]
+        state_sequence.append(state)
+    return state_sequence
+
+
+class StateSequenceCache:
+    """A directory of cached state sequences, evicted least recently used first above max_size bytes.
+    It is picklable, so it can be passed to train_corpus workers sharing the same directory."""
+
+    def __init__(self, directory: str, max_size=256 * 2 ** 20):
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def __repr__(self):
+        return 'StateSequenceCache({!r}, max_size={})'.format(self.directory, self.max_size)
+
+    def key(self, filepath: str, track_idxs: Sequence[int],
+            derived_viewpoints: Sequence[Tuple[str, Callable]] = ()) -> str:
+        key = hashlib.sha256()
+        with open(filepath, 'rb') as file:
+            key.update(file.read())
+        key.update(repr((PARSER_VERSION, CACHE_FORMAT_VERSION, list(track_idxs),
+                         [(viewpoint, _reduction_key(reduction)) for viewpoint, reduction in derived_viewpoints]))
+                   .encode())
+        return key.hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key + '.states')
+
+    def get_states_from_tracks(self, filepath: str, track_idxs: Sequence[int],
+                               derived_viewpoints: Sequence[Tuple[str, Callable]] = ()) -> List[dict]:
+        """Returns the states of the given tracks of a midi file with their derived viewpoints.
+        They are parsed and cached on a miss."""
+        path = self._path(self.key(filepath, track_idxs, derived_viewpoints))
+        try:
+            with open(path, 'rb') as file:
+                state_sequence = decode_states(file.read())
+            os.utime(path)
+            self.hits += 1
+            return state_sequence
+        except (OSError, EOFError, ValueError, pickle.UnpicklingError, zlib.error):
+            self.misses += 1
+        state_sequence = MidiFileParser(filepath).get_states_from_tracks(track_idxs)
+        for viewpoint, reduction in derived_viewpoints:
+            add_derived_viewpoint(state_sequence, viewpoint, reduction)
+        self._write(path, encode_states(state_sequence))
+        self.evict()
+        return state_sequence
+
+    def _write(self, path: str, data: bytes):
+        # Written to a temporary file then renamed, so concurrent readers never see partial entries
+        fd, temporary_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as file:
+            file.write(data)
+        os.replace(temporary_path, path)
+
+    def _entries(self) -> List[Tuple[float, int, str]]:
+        entries = list()
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.states'):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def size(self) -> int:
+        """Returns the size in bytes of the cached entries."""
+        return sum(size for _, size, _ in self._entries())
+
+    def evict(self):
+        """Removes the least recently used entries until the cache fits in max_size."""
+        entries = sorted(self._entries())
+        size = sum(size for _, size, _ in entries)
+        for _, entry_size, path in entries:
+            if size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            size -= entry_size
+
+    def clear(self):
+        for _, _, path in self._entries():
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+__all__ = ['StateSequenceCache', 'encode_states', 'decode_states']
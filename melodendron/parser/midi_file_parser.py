@@ -1,145 +1,414 @@
+from typing import Iterable, List, Tuple
+from collections import defaultdict, deque
+import heapq
+import io
+import struct
 import mido
-import itertools
-import queue
+from mido.messages.specs import SPEC_BY_STATUS
+from mido.midifiles.meta import build_meta_message
+from mido.midifiles.midifiles import read_track
 from .reduction_functions import *
-from .utils import force_note_off, keep_only_messages_by_type, prioritize_note_offs
+from .state_sequence import StateSequence
+
+
+PARSER_VERSION = 1  # Bumped whenever the parsed states change, invalidating cached state sequences (see cache)
 
 
 def delta_to_beat(delta, ticks_per_beat):
     return round(delta / ticks_per_beat, 6)
 
 
+def _new_state():
+    return dict(pitches=set(), note_events=list(), on_duration=None, off_duration=None, total_duration=None)
+
+
+class StateClusterer:
+    """Clusters note on and note off events into states.
+    Events are fed one at a time with their delta in ticks and completed states are returned as soon as they are
+    known, that is when a note starts after all notes of the current state have ended.
+    Open notes are counted and pending note events are queued by pitch, so each event is processed in O(1)."""
+
+    def __init__(self, ticks_per_beat):
+        self.ticks_per_beat = ticks_per_beat
+        self.delta_accum = 0
+        self.state = _new_state()
+        self.first_event = True
+        self.open_notes = 0                          # Number of note events of the current state without end
+        self.pending_note_events = defaultdict(deque)  # Note events without end of the current state by pitch
+
+    def note_on(self, delta, pitch, velocity):
+        """Adds a note on event and returns the state it completed, if any."""
+        self.delta_accum += delta
+        completed_state = None
+        # If the current state has all note events finished, finish completing it and generate a new empty state.
+        if self.open_notes == 0 and not self.first_event:
+            completed_state = self.state
+            completed_state['off_duration'] = delta_to_beat(self.delta_accum, self.ticks_per_beat) \
+                - completed_state['on_duration']
+            completed_state['total_duration'] = delta_to_beat(self.delta_accum, self.ticks_per_beat)
+            self.delta_accum = 0
+            self.state = _new_state()
+        # Create a new note event and add it to the current state
+        note_event = dict(pitch=pitch, velocity=velocity,
+                          start_delta=delta_to_beat(self.delta_accum, self.ticks_per_beat), end_delta=None)
+        self.state['pitches'].add(pitch)
+        self.state['note_events'].append(note_event)
+        self.pending_note_events[pitch].append(note_event)
+        self.open_notes += 1
+        self.first_event = False
+        return completed_state
+
+    def note_off(self, delta, pitch):
+        """Adds a note off event."""
+        self.delta_accum += delta
+        # End the first pending note_event with the same pitch
+        pending_note_events = self.pending_note_events.get(pitch)
+        if pending_note_events:
+            pending_note_events.popleft()['end_delta'] = delta_to_beat(self.delta_accum, self.ticks_per_beat)
+            self.open_notes -= 1
+        # If all note_events have finished, set the on_duration of the current state
+        if self.open_notes == 0:
+            self.state['on_duration'] = delta_to_beat(self.delta_accum, self.ticks_per_beat)
+        self.first_event = False
+
+    def flush(self):
+        """Completes and returns the current state, or None if it has no note events. The last state has no
+        off duration."""
+        state = self.state
+        self.__init__(self.ticks_per_beat)
+        if not state['note_events']:
+            return None
+        state['off_duration'] = 0
+        state['total_duration'] = state['on_duration']
+        return state
+
+
+def _abstime_messages(track: mido.MidiTrack):
+    """Yields the messages of a track with their absolute time in ticks."""
+    now = 0
+    for msg in track:
+        now += msg.time
+        yield now, msg
+
+
+_NO_STATES = ()  # Returned when a message completes no state
+
+
+class TimedMessagesClusterer:
+    """Clusters note messages with absolute times in ticks into states, one message at a time.
+    Only note messages are kept, 0 velocity note ons are treated as note offs and simultaneous note offs are
+    processed before simultaneous note ons. A group of simultaneous messages is clustered when a later message
+    arrives, so feed returns the states completed by the previous group."""
+
+    def __init__(self, ticks_per_beat):
+        self.state_clusterer = StateClusterer(ticks_per_beat)
+        self.previous_time = 0
+        self.group_delta = None  # Delta of the current group of simultaneous messages, None before the first message
+        self.note_offs = list()
+        self.note_ons = list()
+
+    def _cluster_group(self) -> List[dict]:
+        """Feeds the current group to the state clusterer, note offs first, and returns the completed states."""
+        states = list()
+        delta = self.group_delta
+        for pitch in self.note_offs:
+            self.state_clusterer.note_off(delta, pitch)
+            delta = 0
+        for pitch, velocity in self.note_ons:
+            state = self.state_clusterer.note_on(delta, pitch, velocity)
+            delta = 0
+            if state is not None:
+                states.append(state)
+        self.note_offs, self.note_ons = list(), list()
+        self.group_delta = None
+        return states
+
+    def feed(self, time, msg: mido.Message) -> List[dict]:
+        """Adds a message and returns the states it completed."""
+        if msg.type != 'note_on' and msg.type != 'note_off':
+            return _NO_STATES
+        delta = time - self.previous_time
+        self.previous_time = time
+        states = _NO_STATES
+        if self.group_delta is not None and delta != 0:
+            states = self._cluster_group()
+        if self.group_delta is None:
+            self.group_delta = delta
+        if msg.type == 'note_off' or msg.velocity == 0:
+            self.note_offs.append(msg.note)
+        else:
+            self.note_ons.append((msg.note, msg.velocity))
+        return states
+
+    def flush(self) -> List[dict]:
+        """Clusters the last group and returns the remaining states."""
+        states = self._cluster_group() if self.group_delta is not None else list()
+        state = self.state_clusterer.flush()
+        if state is not None:
+            states.append(state)
+        return states
+
+
+def iter_timed_messages_states(timed_messages: Iterable[Tuple[int, mido.Message]], ticks_per_beat):
+    """Converts messages with absolute times in ticks into states in a single streaming pass.
+    States are yielded as soon as they are complete (see TimedMessagesClusterer)."""
+    clusterer = TimedMessagesClusterer(ticks_per_beat)
+    for time, msg in timed_messages:
+        yield from clusterer.feed(time, msg)
+    yield from clusterer.flush()
+
+
+def iter_track_states(track: mido.MidiTrack, ticks_per_beat):
+    """A generator converting a mido MidiTrack into states usable by the MVVOMM."""
+    return iter_timed_messages_states(_abstime_messages(track), ticks_per_beat)
+
+
 def midi_track_to_states(track: mido.MidiTrack, ticks_per_beat):
     """Converts a mido Miditrack into a state sequence usable by the MVVOMM."""
-
-    # "Clean" the midi track
-    track = keep_only_messages_by_type(track, ['note_on', 'note_off'])
-    track = force_note_off(track)
-    track = prioritize_note_offs(track)
-
-    sequence = list()
-
-    delta_accum = 0
-    state = dict(pitches=set(), note_events=list(), on_duration=None, off_duration=None, total_duration=None)
-
-    for i, msg in enumerate(track):
-        delta_accum += msg.time
-        if msg.type == 'note_on':
-            # If the current state has all note events finished, finish completing it, append it to the sequence and
-            # generate a new empty state.
-            if all(note_event['end_delta'] is not None for note_event in state['note_events']) and i != 0:
-                state["off_duration"] = delta_to_beat(delta_accum, ticks_per_beat) - state['on_duration']
-                state['total_duration'] = delta_to_beat(delta_accum, ticks_per_beat)
-                sequence.append(state)
-                delta_accum = 0
-                state = dict(pitches=set(), note_events=list(),
-                             on_duration=None, off_duration=None, total_duration=None)
-            # Create a new note event and add it to the current state
-            note_event = dict(pitch=msg.note, velocity=msg.velocity,
-                              start_delta=delta_to_beat(delta_accum, ticks_per_beat), end_delta=None)
-            state['pitches'].add(msg.note)
-            state['note_events'].append(note_event)
-        if msg.type == 'note_off':
-            # Find first occurence of note_event with same pitch but no end_delta and set its delta
-            matching_note_event = next((note_event for note_event in state['note_events']
-                                        if note_event['pitch'] == msg.note and note_event['end_delta'] is None), None)
-            if matching_note_event is not None:
-                matching_note_event['end_delta'] = delta_to_beat(delta_accum, ticks_per_beat)
-            # If all note_events have finished, set the on_duration of the current state
-            if all(note_event['end_delta'] is not None for note_event in state['note_events']):
-                state['on_duration'] = delta_to_beat(delta_accum, ticks_per_beat)
-    state['off_duration'] = 0
-    state['total_duration'] = state['on_duration']
-    sequence.append(state)
-    return sequence
+    return list(iter_track_states(track, ticks_per_beat))
     #TODO: Add support for a legato delay.
-    #TODO: Rewrite as a generator function
     #TODO: Add support for tempo changes, key and time signature changes, ...
 
 
-def states_to_midi_track(states, ticks_per_beat):
-    midi_track = mido.MidiTrack()
+NOTE_ON = 0x90
+NOTE_OFF = 0x80
+
+
+def note_events_messages(note_events: List[dict], ticks_per_beat, last_end_delta=0) -> List[Tuple[int, int, int, int]]:
+    """Returns the note messages of the note events of a state as (delta, status, pitch, velocity) tuples.
+    The note events are sorted once by time, note ons and note offs at the same time keep the order of their note
+    events. The first message is delayed by last_end_delta, the off duration of the previous state."""
+    messages = list()
+    for i, note_event in enumerate(note_events):
+        pitch = note_event['pitch']
+        start_delta = note_event['start_delta']
+        end_delta = note_event['end_delta']
+        messages.append((start_delta, 2 * i, int(start_delta * ticks_per_beat), NOTE_ON, pitch, note_event['velocity']))
+        messages.append((end_delta, 2 * i + 1, int(end_delta * ticks_per_beat), NOTE_OFF, pitch, 0))
+    messages.sort()
+    note_messages = list()
+    previous_time = None
+    for _, _, time, status, pitch, velocity in messages:
+        if previous_time is None:
+            note_messages.append((int(last_end_delta * ticks_per_beat), status, pitch, velocity))
+        else:
+            note_messages.append((time - previous_time, status, pitch, velocity))
+        previous_time = time
+    return note_messages
+
+
+def state_note_messages(state: dict, ticks_per_beat, last_end_delta=0) -> List[Tuple[int, int, int, int]]:
+    """Returns the note messages of a state as (delta, status, pitch, velocity) tuples (see note_events_messages)."""
+    return note_events_messages(state['note_events'], ticks_per_beat, last_end_delta)
+
+
+def iter_note_messages(states: Iterable[dict], ticks_per_beat) -> Iterable[Tuple[int, int, int, int]]:
+    """A generator yielding the note messages of states as (delta, status, pitch, velocity) tuples."""
     last_end_delta = 0
     for state in states:
-        priority_queue = queue.PriorityQueue()
-        unique = itertools.count()
-        for i, note_event in enumerate(state['note_events']):
-            pitch = note_event['pitch']
-            velocity = note_event['velocity']
-            start_delta = note_event['start_delta']
-            end_delta = note_event['end_delta']
-            on_message = mido.Message('note_on', note=pitch, velocity=velocity, time=int(start_delta * ticks_per_beat))
-            off_message = mido.Message('note_off', note=pitch, velocity=0, time=int(end_delta * ticks_per_beat))
-            priority_queue.put((start_delta, next(unique), on_message))
-            priority_queue.put((end_delta, next(unique), off_message))
-        priority, count, first_msg = priority_queue.get()
-        previous_time = first_msg.time
-        first_msg.time = int(last_end_delta * ticks_per_beat)
-        midi_track.append(first_msg)
-        while not priority_queue.empty():
-            priority, count, msg = priority_queue.get()
-            time_tmp = msg.time
-            msg.time -= previous_time
-            previous_time = time_tmp
-            midi_track.append(msg)
+        yield from note_events_messages(state['note_events'], ticks_per_beat, last_end_delta)
         last_end_delta = state['off_duration']
+
+
+def iter_note_events_messages(note_events_sequence: Iterable[List[dict]], off_durations: Iterable[float],
+                              ticks_per_beat) -> Iterable[Tuple[int, int, int, int]]:
+    """iter_note_messages on the note events and off durations of the states, given as two columns."""
+    last_end_delta = 0
+    for note_events, off_duration in zip(note_events_sequence, off_durations):
+        yield from note_events_messages(note_events, ticks_per_beat, last_end_delta)
+        last_end_delta = off_duration
+
+
+def _note_messages_to_midi_track(note_messages: Iterable[Tuple[int, int, int, int]]) -> mido.MidiTrack:
+    midi_track = mido.MidiTrack()
+    for delta, status, pitch, velocity in note_messages:
+        message_type = 'note_on' if status == NOTE_ON else 'note_off'
+        midi_track.append(mido.Message(message_type, note=pitch, velocity=velocity, time=delta))
     midi_track.append(mido.MetaMessage('end_of_track', time=0))
     return midi_track
 
 
+def states_to_midi_track(states, ticks_per_beat):
+    return _note_messages_to_midi_track(iter_note_messages(states, ticks_per_beat))
+
+
+def note_events_to_midi_track(note_events_sequence: Iterable[List[dict]], off_durations: Iterable[float],
+                              ticks_per_beat) -> mido.MidiTrack:
+    """states_to_midi_track on the note events and off durations of the states, given as two columns.
+    With the values of generated state indexes (see MVVOMM.generate_idxs and MVVOMM.get_values), a generated sequence
+    is exported without building state dicts."""
+    return _note_messages_to_midi_track(iter_note_events_messages(note_events_sequence, off_durations, ticks_per_beat))
+
+
+_TRACK_NAME = 0x03
+_SET_TEMPO = 0x51
+_TIME_SIGNATURE = 0x58
+_KEY_SIGNATURE = 0x59
+
+
+def _read_variable_int(data, position):
+    """Returns a variable length integer read at position and the position following it."""
+    value = 0
+    while True:
+        byte = data[position]
+        position += 1
+        value = value << 7 | byte & 0x7f
+        if byte < 0x80:
+            return value, position
+
+
+def _scan_track(data):
+    """Walks the events of a track chunk without decoding them.
+    Returns the number of messages, the name of the track and the (tick, meta message) of its tempo, time signature
+    and key signature events. Running status follows mido: every status but meta events sets it."""
+    n_messages = 0
+    name = None
+    meta_events = list()
+    tick = 0
+    position = 0
+    last_status = None
+    while position < len(data):
+        delta, position = _read_variable_int(data, position)
+        tick += delta
+        n_messages += 1
+        status = data[position]
+        if status < 0x80:
+            if last_status is None:
+                raise IOError('running status without last_status')
+            status = last_status
+        else:
+            position += 1
+            if status != 0xff:
+                last_status = status
+        if status == 0xff:
+            meta_type = data[position]
+            length, position = _read_variable_int(data, position + 1)
+            if meta_type in (_SET_TEMPO, _TIME_SIGNATURE, _KEY_SIGNATURE) \
+                    or (meta_type == _TRACK_NAME and name is None):
+                meta_message = build_meta_message(meta_type, list(data[position:position + length]))
+                if meta_type == _TRACK_NAME:
+                    name = meta_message.name
+                else:
+                    meta_events.append((tick, meta_message))
+            position += length
+        elif status in (0xf0, 0xf7):
+            length, position = _read_variable_int(data, position)
+            position += length
+        else:
+            try:
+                position += SPEC_BY_STATUS[status]['length'] - 1
+            except LookupError:
+                raise IOError('undefined status byte 0x{:02x}'.format(status))
+    return n_messages, name or '', meta_events
+
+
 class MidiFileParser():
+    """Parses the states of a midi file.
+    Opening a file reads its chunks and indexes every tempo, time signature and key signature change in a single pass
+    over the raw bytes. Tracks are only decoded to mido messages when they are parsed."""
+
     def __init__(self, filepath):
         self.filepath = filepath
-        self.midi_file = mido.MidiFile(filepath)
-        self.time_signature = self._find_time_signature()
-        self.tempo = self._find_tempo()
-        self.key_signature = self._find_key_signature()
-        self.ticks_per_beat = self.midi_file.ticks_per_beat
-
-    def _find_time_signature(self):
-        """Search for a time signature in the file.
-        Defaults to 4/4 if none found."""
-        for track in self.midi_file.tracks:
-            for msg in track:
-                if msg.type == 'time_signature':
-                    return msg.numerator, msg.denominator
-        return 4, 4
-
-    def _find_tempo(self):
-        """Search for a tempo and returns it or none."""
-        for track in self.midi_file.tracks:
-            for msg in track:
-                if msg.type == 'set_tempo':
-                    return mido.bpm2tempo(msg.tempo)
-        return None
-
-    def _find_key_signature(self):
-        """Search for a key signature and returns it or none."""
-        for track in self.midi_file.tracks:
-            for msg in track:
-                if msg.type == 'key_signature':
-                    return msg.key
-        return None
+        with open(filepath, 'rb') as file:
+            self.data = file.read()
+        if self.data[:4] != b'MThd':
+            raise IOError('MThd not found. Probably not a MIDI file')
+        header_length, = struct.unpack_from('>L', self.data, 4)
+        self.type, n_tracks, self.ticks_per_beat = struct.unpack_from('>hhh', self.data, 8)
+        self.track_chunks = list()  # (offset, length) of the data of each track chunk
+        position = 8 + header_length
+        for _ in range(n_tracks):
+            name, length = struct.unpack_from('>4sL', self.data, position)
+            if name != b'MTrk':
+                raise IOError('no MTrk header at start of track')
+            self.track_chunks.append((position + 8, length))
+            position += 8 + length
+        self.tracks = [None] * n_tracks  # Decoded tracks
+        self.track_names = list()
+        self.track_lengths = list()
+        # Meta events changes as (absolute tick, value) sorted by tick
+        self.tempo_changes = list()
+        self.time_signature_changes = list()
+        self.key_signature_changes = list()
+        self.time_signature = None
+        self.tempo = None
+        self.key_signature = None
+        meta_events_by_track = list()
+        for offset, length in self.track_chunks:
+            n_messages, name, meta_events = _scan_track(memoryview(self.data)[offset:offset + length])
+            self.track_names.append(name)
+            self.track_lengths.append(n_messages)
+            meta_events_by_track.append(meta_events)
+        for tick, msg in heapq.merge(*meta_events_by_track, key=lambda meta_event: meta_event[0]):
+            if msg.type == 'set_tempo':
+                self.tempo_changes.append((tick, msg.tempo))
+            elif msg.type == 'time_signature':
+                self.time_signature_changes.append((tick, (msg.numerator, msg.denominator)))
+            else:
+                self.key_signature_changes.append((tick, msg.key))
+        # The first meta events found in track order describe the whole file
+        for meta_events in meta_events_by_track:
+            for tick, msg in meta_events:
+                if msg.type == 'set_tempo' and self.tempo is None:
+                    self.tempo = mido.bpm2tempo(msg.tempo)
+                elif msg.type == 'time_signature' and self.time_signature is None:
+                    self.time_signature = msg.numerator, msg.denominator
+                elif msg.type == 'key_signature' and self.key_signature is None:
+                    self.key_signature = msg.key
+        if self.time_signature is None:
+            self.time_signature = 4, 4
+        self._midi_file = None
+
+    @property
+    def midi_file(self) -> mido.MidiFile:
+        """The midi file with all its tracks decoded, built on first access."""
+        if self._midi_file is None:
+            self._midi_file = mido.MidiFile(self.filepath, type=self.type, ticks_per_beat=self.ticks_per_beat,
+                                            tracks=[self.get_track(track_idx) for track_idx in range(len(self.tracks))])
+        return self._midi_file
+
+    def get_track(self, track_idx) -> mido.MidiTrack:
+        """Decodes a track once and returns it."""
+        if self.tracks[track_idx] is None:
+            offset, length = self.track_chunks[track_idx]
+            self.tracks[track_idx] = read_track(io.BytesIO(self.data[offset - 8:offset + length]))
+        return self.tracks[track_idx]
+
+    def iter_states_from_tracks(self, track_idxs):
+        """A generator converting midi tracks to states, yielding each state as soon as it is complete.
+        If several midi tracks are queried, their messages are merged lazily in playback order."""
+        tracks = [_abstime_messages(self.get_track(idx)) for idx in track_idxs]
+        timed_messages = heapq.merge(*tracks, key=lambda timed_message: timed_message[0])
+        for state in iter_timed_messages_states(timed_messages, self.ticks_per_beat):
+            state['dynamic'] = reduce_dynamic(state)
+            state['time_signature'] = self.time_signature
+            state['key_signature'] = self.key_signature
+            yield state
+
+    def get_state_sequence(self, track_idxs):
+        """Converts midi tracks to a columnar StateSequence, with the same states as get_states_from_tracks."""
+        tracks = [_abstime_messages(self.get_track(idx)) for idx in track_idxs]
+        timed_messages = heapq.merge(*tracks, key=lambda timed_message: timed_message[0])
+        state_sequence = StateSequence.from_states(iter_timed_messages_states(timed_messages, self.ticks_per_beat))
+        state_sequence.add_derived_viewpoint('dynamic', reduce_dynamic)
+        state_sequence.set_column('time_signature', [self.time_signature] * len(state_sequence))
+        state_sequence.set_column('key_signature', [self.key_signature] * len(state_sequence))
+        return state_sequence
 
     def get_states_from_tracks(self, track_idxs):
         """Convert midi track to states.
         If several midi tracks are queried, they are merged before conversion."""
-        tracks = [self.midi_file.tracks[idx] for idx in track_idxs]
-        merged_track = mido.merge_tracks(tracks)
-        sequence = midi_track_to_states(merged_track, self.ticks_per_beat)
-        add_derived_viewpoint(sequence, 'dynamic', reduce_dynamic)
-        add_viewpoint_for_all(sequence, 'time_signature', self.time_signature)
-        add_viewpoint_for_all(sequence, 'key_signature', self.key_signature)
-
-        return sequence
+        return list(self.iter_states_from_tracks(track_idxs))
 
     def __str__(self):
         first_line = 'File {}: ({}/{}, {} BPM, {} TPB)'.format(self.filepath,
                                                                self.time_signature[0], self.time_signature[1],
                                                                self.tempo, self.ticks_per_beat)
-        track_lines = ['\tTrack {}: {} ({} messages)'.format(i, track.name, len(track))
-                       for i, track in enumerate(self.midi_file.tracks)]
+        track_lines = ['\tTrack {}: {} ({} messages)'.format(i, name, n_messages)
+                       for i, (name, n_messages) in enumerate(zip(self.track_names, self.track_lengths))]
         return '\n'.join((first_line, *track_lines))
 
 
-__all__ = ['MidiFileParser', 'states_to_midi_track']
+__all__ = ['MidiFileParser', 'StateClusterer', 'TimedMessagesClusterer', 'states_to_midi_track', 'state_note_messages',
+           'midi_track_to_states', 'iter_track_states', 'iter_timed_messages_states', 'iter_note_messages',
+           'note_events_messages', 'iter_note_events_messages', 'note_events_to_midi_track']
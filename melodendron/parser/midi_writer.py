@@ -0,0 +1,101 @@
+from __future__ import annotations
+from typing import BinaryIO, Iterable, List, Sequence
+import struct
+import mido
+from mido.midifiles.midifiles import write_chunk, write_track
+from .midi_file_parser import note_events_messages
+
+
+_END_OF_TRACK = b'\x00\xff\x2f\x00'
+_BUFFER_SIZE = 1 << 16
+
+
+def _encode_variable_int(value: int) -> bytes:
+    if value < 0:
+        raise ValueError('message time must be non-negative in MIDI file')
+    if value < 0x80:
+        return bytes((value,))
+    encoded = [value & 0x7f]
+    value >>= 7
+    while value:
+        encoded.append(0x80 | value & 0x7f)
+        value >>= 7
+    return bytes(reversed(encoded))
+
+
+class MidiFileWriter:
+    """Writes states to a Standard MIDI File as they come.
+    The note messages of the states are encoded straight to bytes in a single track, written after the given mido
+    tracks (a tempo track for example). The file is byte for byte the one mido saves for a MidiFile holding these tracks
+    and the track returned by states_to_midi_track.
+    The length of the streamed track is written when the writer is closed, so the file must be seekable."""
+
+    def __init__(self, file: str | BinaryIO, ticks_per_beat=480, tracks: Sequence[mido.MidiTrack] = (), midi_type=1):
+        self.owns_file = isinstance(file, str)
+        self.file = open(file, 'wb') if self.owns_file else file
+        self.ticks_per_beat = ticks_per_beat
+        self.last_end_delta = 0
+        self.running_status = None
+        self.buffer = bytearray()
+        self.track_length = 0
+        write_chunk(self.file, b'MThd', struct.pack('>hhh', midi_type, len(tracks) + 1, ticks_per_beat))
+        for track in tracks:
+            write_track(self.file, track)
+        self.file.write(b'MTrk')
+        self.track_length_offset = self.file.tell()
+        self.file.write(struct.pack('>L', 0))
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write_state(self, state: dict):
+        self.write_note_events(state['note_events'], state['off_duration'])
+
+    def write_note_events(self, note_events: List[dict], off_duration: float):
+        """Writes the note events of a state followed by its off duration, without needing a state dict."""
+        buffer = self.buffer
+        for delta, status, pitch, velocity in note_events_messages(note_events, self.ticks_per_beat,
+                                                                   self.last_end_delta):
+            if not 0 <= pitch < 0x80 or not 0 <= velocity < 0x80:
+                raise ValueError('note and velocity must be in range 0..127')
+            buffer += _encode_variable_int(delta)
+            if status != self.running_status:
+                buffer.append(status)
+                self.running_status = status
+            buffer.append(pitch)
+            buffer.append(velocity)
+        self.last_end_delta = off_duration
+        if len(buffer) >= _BUFFER_SIZE:
+            self.flush()
+
+    def write_states(self, states: Iterable[dict]):
+        """Writes states, which can be generated lazily (see MVVOMM.iter_generate)."""
+        for state in states:
+            self.write_state(state)
+
+    def flush(self):
+        self.file.write(self.buffer)
+        self.track_length += len(self.buffer)
+        self.buffer.clear()
+        self.file.flush()
+
+    def close(self):
+        """Ends the track and writes its length."""
+        if self.closed:
+            return
+        self.buffer += _END_OF_TRACK
+        self.flush()
+        end = self.file.tell()
+        self.file.seek(self.track_length_offset)
+        self.file.write(struct.pack('>L', self.track_length))
+        self.file.seek(end)
+        if self.owns_file:
+            self.file.close()
+        self.closed = True
+
+
+__all__ = ['MidiFileWriter']
@@ -0,0 +1,123 @@
+from __future__ import annotations
+from typing import AsyncIterable, AsyncIterator, List, Tuple
+import asyncio
+import time
+import mido
+from melodendron.model.MVVOMM import MVVOMM
+from melodendron.model.stats import LatencyStats
+from .midi_file_parser import TimedMessagesClusterer, _abstime_messages
+from .reduction_functions import reduce_dynamic
+
+
+"""
+Real time parsing.
+A RealtimeParser consumes an asynchronous iterator of (timestamp in seconds, mido message) and clusters the messages
+into states as they are played. Sources can be a midi input port (port_source) or a scripted track (scripted_source),
+which makes a live session reproducible without hardware.
+"""
+
+
+class RealtimeParser:
+    """Parses timestamped midi messages into states as they are played.
+    Messages are clustered with the rules of midi_track_to_states (see TimedMessagesClusterer). Each completed state
+    is learned by the model, if any, and pushed to every subscribed queue. Queues are bounded: when a consumer lags
+    behind, its oldest state is dropped so that the parser never waits. The time spent processing each message is
+    recorded in event_latency."""
+
+    def __init__(self, ticks_per_beat=480, tempo=500000, model: MVVOMM | None = None, max_order=8,
+                 time_signature=(4, 4), key_signature=None):
+        self.ticks_per_beat = ticks_per_beat
+        self.tempo = tempo
+        self.model = model
+        self.max_order = max_order
+        self.time_signature = time_signature
+        self.key_signature = key_signature
+        self.clusterer = TimedMessagesClusterer(ticks_per_beat)
+        self.queues = list()
+        self.start_timestamp = None  # Timestamp of the first message
+        self.n_states = 0
+        self.event_latency = LatencyStats()
+
+    def __repr__(self):
+        return 'RealtimeParser(states={}, consumers={})'.format(self.n_states, len(self.queues))
+
+    def subscribe(self, maxsize=64) -> asyncio.Queue:
+        """Returns a queue receiving the completed states, then None when the source is exhausted."""
+        queue = asyncio.Queue(maxsize=maxsize)
+        self.queues.append(queue)
+        return queue
+
+    def _push(self, item):
+        for queue in self.queues:
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(item)
+
+    def _publish(self, states: List[dict]):
+        for state in states:
+            state['dynamic'] = reduce_dynamic(state)
+            state['time_signature'] = self.time_signature
+            state['key_signature'] = self.key_signature
+            if self.model is not None:
+                self.model.learn(state, max_order=self.max_order)
+            self._push(state)
+            self.n_states += 1
+
+    def feed(self, timestamp: float, msg: mido.Message) -> List[dict]:
+        """Processes a message played at timestamp, in seconds, and returns the states it completed."""
+        start_time = time.perf_counter()
+        if self.start_timestamp is None:
+            self.start_timestamp = timestamp
+        tick = round(mido.second2tick(timestamp - self.start_timestamp, self.ticks_per_beat, self.tempo))
+        states = self.clusterer.feed(tick, msg)
+        self._publish(states)
+        self.event_latency.record(time.perf_counter() - start_time)
+        return states
+
+    def close(self) -> List[dict]:
+        """Completes the last state, ends the learned sequence and notifies the consumers."""
+        states = self.clusterer.flush()
+        self._publish(states)
+        if self.model is not None:
+            self.model.end_learned_sequence()
+        self._push(None)
+        return states
+
+    async def run(self, source: AsyncIterable[Tuple[float, mido.Message]]) -> int:
+        """Parses every message of a source, then closes the parser. Returns the number of states."""
+        async for timestamp, msg in source:
+            if self.feed(timestamp, msg):
+                # Let consumers handle the new states
+                await asyncio.sleep(0)
+        self.close()
+        return self.n_states
+
+
+async def scripted_source(track: mido.MidiTrack, ticks_per_beat, tempo=500000,
+                          speed: float | None = None) -> AsyncIterator[Tuple[float, mido.Message]]:
+    """Plays a mido track as a source of (timestamp, message).
+    With a speed, each message is released at its time (a speed of 2 plays twice as fast), otherwise all messages are
+    released at once."""
+    start_time = time.perf_counter()
+    for tick, msg in _abstime_messages(track):
+        timestamp = mido.tick2second(tick, ticks_per_beat, tempo)
+        if speed is not None:
+            delay = start_time + timestamp / speed - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        yield timestamp, msg
+
+
+async def port_source(port: mido.ports.BaseInput) -> AsyncIterator[Tuple[float, mido.Message]]:
+    """Yields the messages received by an open mido input port, timestamped on reception."""
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    port.callback = lambda msg: loop.call_soon_threadsafe(queue.put_nowait, (time.perf_counter(), msg))
+    try:
+        while True:
+            yield await queue.get()
+    finally:
+        port.callback = None
+
+
+__all__ = ['RealtimeParser', 'scripted_source', 'port_source']
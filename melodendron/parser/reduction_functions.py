@@ -2,12 +2,20 @@ import statistics
 
 
 def add_viewpoint_for_all(sequence, viewpoint, value):
+    if hasattr(sequence, 'set_column'):
+        # States of columnar sequences (see StateSequence) are built on access, the column is set instead
+        sequence.set_column(viewpoint, [value] * len(sequence))
+        return sequence
     for state in sequence:
         state[viewpoint] = value
     return sequence
 
 
 def add_derived_viewpoint(sequence, viewpoint, reduction):
+    if hasattr(sequence, 'add_derived_viewpoint'):
+        # Columnar sequences (see StateSequence) reduce whole columns
+        sequence.add_derived_viewpoint(viewpoint, reduction)
+        return sequence
     for state in sequence:
         state[viewpoint] = reduction(state)
     return sequence
@@ -0,0 +1,221 @@
+from __future__ import annotations
+from collections.abc import Sequence
+from typing import Any, Callable, Dict, Iterable, List, Tuple
+import numpy as np
+from melodendron.model.alphabet import canonical_key
+from .reduction_functions import reduce_density, reduce_dynamic
+
+
+"""
+Columnar state sequences.
+A StateSequence stores states as a struct of arrays: float arrays for durations, offsets into a flat note events table,
+a chord id column for pitches and one column per other key. Reductions run on whole columns and MVVOMM inserts it
+without building dicts. Indexing or iterating gives the usual state dicts.
+"""
+
+
+_DURATIONS = ('on_duration', 'off_duration', 'total_duration')
+_DYNAMICS = np.array(['ppp', 'pp', 'p', 'mp', 'mf', 'f', 'ff', 'fff', None], dtype=object)
+
+
+def _factorize(values: Iterable[Any]) -> Tuple[List[Any], List[int]]:
+    """Returns the distinct values in order of first occurrence and the code of each value.
+    Values are compared by canonical form, as in Alphabet."""
+    distinct_values = list()
+    codes = list()
+    code_by_key = dict()
+    for value in values:
+        key = canonical_key(value)
+        code = code_by_key.get(key)
+        if code is None:
+            code = code_by_key[key] = len(distinct_values)
+            distinct_values.append(value)
+        codes.append(code)
+    return distinct_values, codes
+
+
+def _to_list(column) -> List[Any]:
+    """Returns the values of a column as Python objects, missing durations (NaN) as None."""
+    if isinstance(column, np.ndarray):
+        if column.dtype.kind == 'f':
+            return [None if value != value else value for value in column.tolist()]
+        return column.tolist()
+    return list(column)
+
+
+class StateSequence(Sequence):
+    """A sequence of states stored as columns."""
+
+    def __init__(self):
+        self.keys = ['pitches', 'note_events', *_DURATIONS]        # Keys of the states, in order
+        self.chords = list()                                        # Distinct pitch sets
+        self.chord_ids = np.zeros(0, dtype=np.int32)                # Pitch set of each state
+        self.note_offsets = np.zeros(1, dtype=np.int64)             # Note events of state i are in [offsets[i], [i+1])
+        self.note_pitches = np.zeros(0, dtype=np.uint8)
+        self.note_velocities = np.zeros(0, dtype=np.uint8)
+        self.note_start_deltas = np.zeros(0, dtype=np.float64)
+        self.note_end_deltas = np.zeros(0, dtype=np.float64)        # NaN when the note never ended
+        self.columns = {duration: np.zeros(0, dtype=np.float64) for duration in _DURATIONS}  # Other keys
+
+    @classmethod
+    def from_states(cls, states: Iterable[Dict[str, Any]]) -> StateSequence:
+        """Builds a StateSequence from state dicts, which must all have the same keys."""
+        state_sequence = cls()
+        chord_ids, note_counts = list(), list()
+        pitches, velocities, start_deltas, end_deltas = list(), list(), list(), list()
+        chord_id_by_pitches = dict()
+        other_keys = None
+        other_columns = None
+        durations = {duration: list() for duration in _DURATIONS}
+        for state in states:
+            if other_keys is None:
+                other_keys = [key for key in state if key not in state_sequence.keys and key != 'id']
+                other_columns = {key: list() for key in other_keys}
+                state_sequence.keys.extend(other_keys)
+            chord = frozenset(state['pitches'])
+            chord_id = chord_id_by_pitches.get(chord)
+            if chord_id is None:
+                chord_id = chord_id_by_pitches[chord] = len(state_sequence.chords)
+                state_sequence.chords.append(chord)
+            chord_ids.append(chord_id)
+            note_counts.append(len(state['note_events']))
+            for note_event in state['note_events']:
+                pitches.append(note_event['pitch'])
+                velocities.append(note_event['velocity'])
+                start_deltas.append(note_event['start_delta'])
+                end_deltas.append(np.nan if note_event['end_delta'] is None else note_event['end_delta'])
+            for duration in _DURATIONS:
+                durations[duration].append(np.nan if state[duration] is None else state[duration])
+            for key in other_keys:
+                other_columns[key].append(state[key])
+        state_sequence.chord_ids = np.array(chord_ids, dtype=np.int32)
+        state_sequence.note_offsets = np.concatenate(([0], np.cumsum(note_counts, dtype=np.int64)))
+        state_sequence.note_pitches = np.array(pitches, dtype=np.uint8)
+        state_sequence.note_velocities = np.array(velocities, dtype=np.uint8)
+        state_sequence.note_start_deltas = np.array(start_deltas, dtype=np.float64)
+        state_sequence.note_end_deltas = np.array(end_deltas, dtype=np.float64)
+        for duration in _DURATIONS:
+            state_sequence.columns[duration] = np.array(durations[duration], dtype=np.float64)
+        state_sequence.columns.update(other_columns or dict())
+        return state_sequence
+
+    def __repr__(self):
+        return 'StateSequence(keys={}, length={})'.format(self.keys, len(self))
+
+    def __len__(self):
+        return len(self.chord_ids)
+
+    @property
+    def note_counts(self) -> np.ndarray:
+        return np.diff(self.note_offsets)
+
+    def _note_events(self, start: int, end: int) -> List[Dict[str, Any]]:
+        return [dict(pitch=pitch, velocity=velocity, start_delta=start_delta,
+                     end_delta=None if end_delta != end_delta else end_delta)
+                for pitch, velocity, start_delta, end_delta in zip(
+                    self.note_pitches[start:end].tolist(), self.note_velocities[start:end].tolist(),
+                    self.note_start_deltas[start:end].tolist(), self.note_end_deltas[start:end].tolist())]
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        if not -len(self) <= idx < len(self):
+            raise IndexError('StateSequence index out of range')
+        idx %= len(self)
+        state = dict()
+        for key in self.keys:
+            if key == 'pitches':
+                state[key] = set(self.chords[self.chord_ids[idx]])
+            elif key == 'note_events':
+                state[key] = self._note_events(self.note_offsets[idx], self.note_offsets[idx + 1])
+            else:
+                state[key] = _to_list(self.columns[key][idx:idx + 1])[0]
+        return state
+
+    def __iter__(self):
+        columns = {key: _to_list(column) for key, column in self.columns.items()}
+        offsets = self.note_offsets.tolist()
+        for idx, chord_id in enumerate(self.chord_ids.tolist()):
+            state = dict()
+            for key in self.keys:
+                if key == 'pitches':
+                    state[key] = set(self.chords[chord_id])
+                elif key == 'note_events':
+                    state[key] = self._note_events(offsets[idx], offsets[idx + 1])
+                else:
+                    state[key] = columns[key][idx]
+            yield state
+
+    def to_states(self) -> List[Dict[str, Any]]:
+        """Returns the states as dicts."""
+        return list(self)
+
+    def set_column(self, key: str, values):
+        """Sets the values of a key for all states. NumPy arrays are kept as is."""
+        if len(values) != len(self):
+            raise ValueError('Column {} has {} values for {} states'.format(key, len(values), len(self)))
+        if key in ('pitches', 'note_events'):
+            raise ValueError('Column {} cannot be set'.format(key))
+        if key not in self.keys:
+            self.keys.append(key)
+        self.columns[key] = values if isinstance(values, np.ndarray) else list(values)
+
+    def add_derived_viewpoint(self, viewpoint: str, reduction: Callable):
+        """Adds a viewpoint computed by a reduction, on whole columns when it has a vectorized version."""
+        vectorized_reduction = VECTORIZED_REDUCTIONS.get(reduction)
+        if vectorized_reduction is not None:
+            self.set_column(viewpoint, vectorized_reduction(self))
+        else:
+            self.set_column(viewpoint, [reduction(state) for state in self])
+
+    def factorize(self) -> Dict[str, Tuple[List[Any], List[int]]]:
+        """Returns, for each key, its distinct values in order of first occurrence and the code of each state.
+        This is what MVVOMM.insert_sequence uses to encode each distinct value once."""
+        factorized = dict()
+        for key in self.keys:
+            if key == 'pitches':
+                factorized[key] = [set(chord) for chord in self.chords], self.chord_ids.tolist()
+            elif key == 'note_events':
+                offsets = self.note_offsets.tolist()
+                rows = list(zip(self.note_pitches.tolist(), self.note_velocities.tolist(),
+                                self.note_start_deltas.tolist(), self.note_end_deltas.tolist()))
+                # Rows of equal note events are equal tuples, except for NaN end deltas which are compared as None
+                rows = [row if row[3] == row[3] else row[:3] + (None,) for row in rows]
+                distinct_rows, codes = _factorize(tuple(rows[start:end]) for start, end in zip(offsets, offsets[1:]))
+                note_events = [[dict(pitch=pitch, velocity=velocity, start_delta=start_delta, end_delta=end_delta)
+                                for pitch, velocity, start_delta, end_delta in note_rows]
+                               for note_rows in distinct_rows]
+                factorized[key] = note_events, codes
+            else:
+                factorized[key] = _factorize(_to_list(self.columns[key]))
+        return factorized
+
+
+def reduce_dynamic_columns(state_sequence: StateSequence) -> List[str | None]:
+    """reduce_dynamic on whole columns: mean velocities are bucketed with integer arithmetic on velocity sums."""
+    note_counts = state_sequence.note_counts
+    if np.any(note_counts == 0):
+        raise ValueError('Cannot reduce the dynamic of a state without note events')
+    if len(state_sequence) == 0:
+        return list()
+    velocity_sums = np.add.reduceat(state_sequence.note_velocities.astype(np.int64), state_sequence.note_offsets[:-1])
+    # mean in (16 * k, 16 * (k + 1)] gives the k-th dynamic, a mean above 127 gives None
+    buckets = np.maximum(-(-velocity_sums // (16 * note_counts)) - 1, 0)
+    buckets[velocity_sums > 127 * note_counts] = len(_DYNAMICS) - 1
+    return _DYNAMICS[buckets].tolist()
+
+
+def reduce_density_columns(state_sequence: StateSequence) -> np.ndarray:
+    """reduce_density on whole columns. Missing (NaN) or zero on durations raise the errors of reduce_density."""
+    on_durations = np.asarray(state_sequence.columns['on_duration'], dtype=np.float64)
+    if np.any(np.isnan(on_durations)):
+        raise TypeError('Cannot reduce the density of a state without on duration')
+    if np.any(on_durations == 0):
+        raise ZeroDivisionError('Cannot reduce the density of a state with a zero on duration')
+    return state_sequence.note_counts / on_durations
+
+
+VECTORIZED_REDUCTIONS = {reduce_dynamic: reduce_dynamic_columns, reduce_density: reduce_density_columns}
+
+
+__all__ = ['StateSequence', 'reduce_dynamic_columns', 'reduce_density_columns']